@@ -59,12 +59,17 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.timing.ServerTimingMiddleware',
+    'core.slowqueries.QueryOriginMiddleware',
+    'core.profiling.ProfilingMiddleware',
+    'core.querybudget.QueryBudgetMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'core.timing.RequestPhaseMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -73,7 +78,8 @@ ROOT_URLCONF = 'boundless.urls'
 
 TEMPLATES = [
     {
-        "BACKEND": "django.template.backends.django.DjangoTemplates",
+        # DjangoTemplates that reports rendering time to core.timing
+        "BACKEND": "core.timing.TimedDjangoTemplates",
         "DIRS": [BASE_DIR / "templates"],
         "APP_DIRS": True,
         "OPTIONS": {
@@ -149,8 +155,16 @@ STORAGES = {
     "staticfiles": {
         "BACKEND": "whitenoise.storage.CompressedManifestStaticFilesStorage",
     },
+    # Uploaded avatars and server icons, stored once per content under MEDIA_ROOT/blobs
+    "blobs": {
+        "BACKEND": "core.storage.ContentAddressedStorage",
+    },
 }
 
+# Django only serves MEDIA_URL with DEBUG on. In production the front proxy
+# serves MEDIA_ROOT under it, and adds
+# "Cache-Control: public, max-age=31536000, immutable" (core.storage.IMMUTABLE_CACHE_CONTROL)
+# to blobs/ and thumbnails/blobs/, whose URLs change whenever their content does.
 MEDIA_URL = "/media/"
 MEDIA_ROOT = BASE_DIR / "media"
 
@@ -175,18 +189,118 @@ EMAIL_HOST_USER = os.getenv("EMAIL_HOST_USER", "")
 EMAIL_HOST_PASSWORD = os.getenv("EMAIL_HOST_PASSWORD", "")
 DEFAULT_FROM_EMAIL = os.getenv("DEFAULT_FROM_EMAIL", "noreply@boundless.onl")
 
-# Channel layer — use Redis when REDIS_URL is set, else in-memory for dev
+# Channel layer — use Redis when REDIS_URL is set, else in-memory for dev.
+# CHANNEL_LAYER_MODE=fanout publishes each group message once per worker process
+# and fans it out to local sockets in memory (core.layers) instead of queueing
+# one copy per member connection in Redis; CHANNEL_LAYER_MODE=pubsub is the stock
+# channels_redis layer it builds on.
 _redis_url = os.getenv("REDIS_URL")
+# Seconds a channel layer Redis read may take. It must outlast channels_redis's
+# 5 s blocking pop (BZPOPMIN), or consumers idle for 5 s fail with
+# "Timeout reading from" Redis under redis-py's 5 s default.
+CHANNEL_LAYER_SOCKET_TIMEOUT = float(os.getenv("CHANNEL_LAYER_SOCKET_TIMEOUT", "10"))
+_channel_layer_backends = {
+    "redis": "channels_redis.core.RedisChannelLayer",
+    "pubsub": "channels_redis.pubsub.RedisPubSubChannelLayer",
+    "fanout": "core.layers.LocalFanoutChannelLayer",
+}
 if _redis_url:
     CHANNEL_LAYERS = {
         "default": {
-            "BACKEND": "channels_redis.core.RedisChannelLayer",
-            "CONFIG": {"hosts": [_redis_url]},
+            "BACKEND": _channel_layer_backends[os.getenv("CHANNEL_LAYER_MODE", "redis")],
+            "CONFIG": {"hosts": [{"address": _redis_url, "socket_timeout": CHANNEL_LAYER_SOCKET_TIMEOUT}]},
         }
     }
 else:
     CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
 
+# Query budgets — views declare them with core.querybudget.query_budget;
+# "warn" logs requests that exceed theirs, "raise" fails them (tests), "off"
+QUERY_BUDGET_MODE = os.getenv("QUERY_BUDGET_MODE", "warn" if DEBUG else "off")
+
+# Request timing — Server-Timing header and per-view histograms served at
+# /metrics (Prometheus text format). The endpoint requires
+# "Authorization: Bearer <METRICS_TOKEN>" and is closed when no token is set,
+# except with DEBUG on. Outside DEBUG the header only carries the total unless
+# SERVER_TIMING_PHASES is set
+SERVER_TIMING = os.getenv("SERVER_TIMING", "True").lower() in ("true", "1", "yes")
+SERVER_TIMING_PHASES = os.getenv("SERVER_TIMING_PHASES", str(DEBUG)).lower() in ("true", "1", "yes")
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# On-demand profiling — staff get a signed token with
+# `manage.py profile_token <username>` and pass it as ?_profile=<token> or the
+# X-Profile-Token header (WebSocket: on the connect request); samples are
+# taken every PROFILE_SAMPLE_INTERVAL_MS and stored as ProfileRecords in the admin
+PROFILE_TOKEN_MAX_AGE = int(os.getenv("PROFILE_TOKEN_MAX_AGE", "3600"))
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5"))
+PROFILE_MAX_RECORDS_PER_CONNECTION = int(os.getenv("PROFILE_MAX_RECORDS_PER_CONNECTION", "50"))
+
+# Slow-query log — queries slower than SLOW_QUERY_MS (0 disables) are logged
+# with their view or consumer, parameters and EXPLAIN plan to the
+# core.slowqueries logger, kept in a per-process ring buffer of
+# SLOW_QUERY_BUFFER_SIZE entries (shown at /debug/slow-queries to staff) and,
+# when SLOW_QUERY_LOG_FILE is set, written to that file, rotated at 10 MB
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+SLOW_QUERY_BUFFER_SIZE = int(os.getenv("SLOW_QUERY_BUFFER_SIZE", "100"))
+SLOW_QUERY_LOG_FILE = os.getenv("SLOW_QUERY_LOG_FILE", "")
+
+# Cache — shared through Redis when REDIS_URL is set so invalidations reach
+# every worker, else per-process memory for dev
+if _redis_url:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": _redis_url,
+        }
+    }
+else:
+    CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+# Seconds a user's compiled permissions on a server and their membership stay
+# cached; role and membership changes invalidate them sooner
+PERMISSIONS_CACHE_TIMEOUT = int(os.getenv("PERMISSIONS_CACHE_TIMEOUT", "300"))
+MEMBERSHIP_CACHE_TIMEOUT = int(os.getenv("MEMBERSHIP_CACHE_TIMEOUT", "300"))
+
+# Seconds a server's category/channel sidebar stays cached; edits to
+# categories, channels and roles invalidate it sooner
+SIDEBAR_CACHE_TIMEOUT = int(os.getenv("SIDEBAR_CACHE_TIMEOUT", "3600"))
+
+# Seconds a sender's profile card (name and avatar shown next to messages)
+# stays cached; profile edits invalidate it sooner
+PROFILE_CARD_CACHE_TIMEOUT = int(os.getenv("PROFILE_CARD_CACHE_TIMEOUT", "60"))
+
+# Avatar and server icon derivatives (core.thumbnails) — encoded as
+# THUMBNAIL_FORMAT (webp, avif or png; png when Pillow cannot encode the
+# choice) by THUMBNAIL_WORKERS background threads per process; with 0 threads
+# only `manage.py build_thumbnails` makes them
+THUMBNAIL_FORMAT = os.getenv("THUMBNAIL_FORMAT", "webp")
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", "2"))
+
+# Chat persistence — when enabled, each process batches message inserts and
+# flushes them every CHAT_WRITE_BEHIND_INTERVAL_MS or CHAT_WRITE_BEHIND_MAX_BATCH messages
+CHAT_WRITE_BEHIND = os.getenv("CHAT_WRITE_BEHIND", "False").lower() in ("true", "1", "yes")
+CHAT_WRITE_BEHIND_INTERVAL_MS = int(os.getenv("CHAT_WRITE_BEHIND_INTERVAL_MS", "50"))
+CHAT_WRITE_BEHIND_MAX_BATCH = int(os.getenv("CHAT_WRITE_BEHIND_MAX_BATCH", "200"))
+
+# Chat resume — recent events kept per channel for reconnecting clients, and the
+# most a client may catch up on before it is told to reload instead
+CHAT_REPLAY_BUFFER_SIZE = int(os.getenv("CHAT_REPLAY_BUFFER_SIZE", "200"))
+CHAT_REPLAY_MAX_CHANNELS = int(os.getenv("CHAT_REPLAY_MAX_CHANNELS", "1000"))
+CHAT_RESUME_MAX_MESSAGES = int(os.getenv("CHAT_RESUME_MAX_MESSAGES", "500"))
+
+# Chat backpressure — outgoing frames queued per connection before the policy
+# kicks in: "coalesce" (merge into one array frame), "drop_oldest", or "close"
+# (evict the connection and tell the client to retry after the given delay).
+# Only effective under an ASGI server whose WebSocket sends wait for the
+# socket to drain, such as Uvicorn; see core.backpressure.
+CHAT_OUTBOUND_QUEUE_SIZE = int(os.getenv("CHAT_OUTBOUND_QUEUE_SIZE", "256"))
+CHAT_BACKPRESSURE_POLICY = os.getenv("CHAT_BACKPRESSURE_POLICY", "coalesce")
+CHAT_BACKPRESSURE_RETRY_AFTER_MS = int(os.getenv("CHAT_BACKPRESSURE_RETRY_AFTER_MS", "5000"))
+
+# Chat coalescing — messages published to a busy channel within this many
+# milliseconds are delivered as one array frame (0 disables batching)
+CHAT_COALESCE_WINDOW_MS = int(os.getenv("CHAT_COALESCE_WINDOW_MS", "0"))
+
 TAILWIND_APP_NAME = "theme"
 TAILWIND_CLI_COMMAND = "npm run build:tailwind"
 
@@ -222,5 +336,19 @@ LOGGING = {
             "level": "ERROR",
             "propagate": False,
         },
+        "core.slowqueries": {
+            "handlers": ["console"],
+            "level": "WARNING",
+            "propagate": False,
+        },
     },
 }
+
+if SLOW_QUERY_LOG_FILE:
+    LOGGING["handlers"]["slow_query_file"] = {
+        "class": "logging.handlers.RotatingFileHandler",
+        "filename": SLOW_QUERY_LOG_FILE,
+        "maxBytes": 10 * 1024 * 1024,
+        "backupCount": 5,
+    }
+    LOGGING["loggers"]["core.slowqueries"]["handlers"].append("slow_query_file")
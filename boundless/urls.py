@@ -14,11 +14,14 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+import re
+
 from django.contrib import admin
-from django.urls import path
+from django.urls import path, re_path
 from django.urls import include
 from django.contrib.auth import views as auth_views
 from core import views as core_views
+from core.storage import BLOB_PATH_PATTERN
 from django.conf import settings
 from django.conf.urls.static import static
 
@@ -29,4 +32,12 @@ urlpatterns = [
     path("login/", auth_views.LoginView.as_view(template_name="login.html"), name="login"),
     path("logout/", auth_views.LogoutView.as_view(next_page="home"), name="logout"),
     path('signup/', core_views.signup, name='signup'),
+    path("metrics", core_views.metrics, name="metrics"),
+    path("debug/slow-queries", core_views.slow_queries, name="slow_queries"),
+    # Content-addressed uploads (core.storage) and their thumbnails, cached as immutable.
+    re_path(
+        rf"^{re.escape(settings.MEDIA_URL.lstrip('/'))}(?P<path>{BLOB_PATH_PATTERN})$",
+        core_views.media_blob,
+        name="media_blob",
+    ),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
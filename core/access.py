@@ -0,0 +1,227 @@
+# Copyright (C) 2025 TG11
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import uuid
+from collections import defaultdict, namedtuple
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Q
+
+from .models import Channel, Role, Server
+from .permissions import ALL_PERMISSIONS, Permission
+
+# What a chat connection needs to know about the channel it is attached to;
+# ``permissions`` are the user's Permission bits in that channel.
+ChannelAccess = namedtuple("ChannelAccess", ["channel_id", "server_id", "category_id", "permissions"])
+
+
+class ServerPermissions(namedtuple("ServerPermissions", ["bits", "hidden_channel_ids"])):
+    """
+    A user's effective permissions on one server: the OR of their roles' bits,
+    and the restricted channels none of their roles may see.
+    """
+
+    __slots__ = ()
+
+    def for_channel(self, channel_id):
+        if str(channel_id) in self.hidden_channel_ids:
+            return 0
+        return self.bits
+
+    def has(self, permission, channel_id=None):
+        bits = self.bits if channel_id is None else self.for_channel(channel_id)
+        return bits & permission == permission
+
+
+NO_PERMISSIONS = ServerPermissions(0, frozenset())
+
+
+def server_access_group(server_id):
+    return f"server_access_{server_id}"
+
+
+def user_group(user_id):
+    return f"user_{user_id}"
+
+
+def _membership_key(server_id, user_id):
+    return f"member:{server_id}:{user_id}"
+
+
+def is_server_member(user, server_id):
+    """
+    Returns whether ``user`` is a member of the server, from the cache or a
+    single indexed EXISTS query on the membership table.
+    """
+    if not user.is_authenticated:
+        return False
+    key = _membership_key(server_id, user.pk)
+    cached = cache.get(key)
+    if cached is not None:
+        return bool(cached)
+    is_member = Server.members.through.objects.filter(server_id=server_id, user_id=user.pk).exists()
+    # Stored as 0/1 so a cached "no" is not mistaken for a miss.
+    cache.set(key, int(is_member), getattr(settings, "MEMBERSHIP_CACHE_TIMEOUT", 300))
+    return is_member
+
+
+def invalidate_membership(server_id, user_ids):
+    """Drops cached membership of ``user_ids`` in the server once the current transaction commits."""
+    keys = [_membership_key(server_id, user_id) for user_id in user_ids]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def cache_version(key):
+    """
+    Returns the current version stored under ``key``. Cache entries that
+    embed it in their own key are all dropped at once by bump_cache_version.
+    """
+    version = cache.get(key)
+    if version is None:
+        # A fresh random version can never match entries cached before an eviction.
+        cache.add(key, uuid.uuid4().hex, timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_cache_version(key):
+    """Moves ``key`` to a new version once the current transaction commits."""
+    transaction.on_commit(lambda: cache.set(key, uuid.uuid4().hex, timeout=None))
+
+
+def _permissions_version_key(server_id):
+    return f"perms:version:{server_id}"
+
+
+def _permissions_key(server_id, user_id):
+    return f"perms:{server_id}:{cache_version(_permissions_version_key(server_id))}:{user_id}"
+
+
+def get_server_permissions(user, server_id):
+    """
+    Returns the ServerPermissions of ``user`` on the server, computed once per
+    (user, server) and cached until the server's roles or members change.
+    """
+    if not user.is_authenticated:
+        return NO_PERMISSIONS
+    key = _permissions_key(server_id, user.pk)
+    cached = cache.get(key)
+    if cached is not None:
+        return ServerPermissions(cached[0], frozenset(cached[1]))
+    permissions = _compute_server_permissions(user, server_id)
+    cache.set(
+        key,
+        (permissions.bits, tuple(permissions.hidden_channel_ids)),
+        getattr(settings, "PERMISSIONS_CACHE_TIMEOUT", 300),
+    )
+    return permissions
+
+
+def _compute_server_permissions(user, server_id):
+    owner_id = Server.objects.filter(id=server_id).values_list("owner_id", flat=True).first()
+    if owner_id is None:
+        return NO_PERMISSIONS
+    if owner_id == user.pk:
+        return ServerPermissions(int(ALL_PERMISSIONS), frozenset())
+    if not is_server_member(user, server_id):
+        return NO_PERMISSIONS
+
+    # @everyone applies to every member, whether or not they were added to it.
+    bits = 0
+    role_ids = set()
+    roles = Role.objects.filter(Q(users=user) | Q(name="@everyone"), server_id=server_id).distinct()
+    for role_id, role_bits in roles.values_list("id", "permission_bits"):
+        bits |= role_bits
+        role_ids.add(role_id)
+    if bits & Permission.ADMINISTRATOR:
+        return ServerPermissions(int(ALL_PERMISSIONS), frozenset())
+
+    allowed_roles = defaultdict(set)
+    for channel_id, role_id in Channel.allowed_roles.through.objects.filter(
+        channel__server_id=server_id
+    ).values_list("channel_id", "role_id"):
+        allowed_roles[str(channel_id)].add(role_id)
+    hidden = frozenset(channel_id for channel_id, roles in allowed_roles.items() if not roles & role_ids)
+    return ServerPermissions(bits, hidden)
+
+
+def invalidate_server_permissions(server_id, user_ids=None):
+    """
+    Drops the cached ServerPermissions of ``user_ids`` on the server, or of
+    everyone on it when not given, once the current transaction commits.
+    """
+    if user_ids is None:
+        bump_cache_version(_permissions_version_key(server_id))
+        return
+    user_ids = list(user_ids)
+    if user_ids:
+        transaction.on_commit(
+            lambda: cache.delete_many([_permissions_key(server_id, user_id) for user_id in user_ids])
+        )
+
+
+def resolve_channel_access(user, channel_id, server_id=None, category_id=None):
+    """
+    Returns a ChannelAccess for ``user`` on the channel, or None if the channel
+    does not exist (under the given server/category) or the user may not view it.
+
+    Members can use channels without allowed roles; restricted channels also
+    require one of the allowed roles. The server owner can use every channel.
+    """
+    if not user.is_authenticated:
+        return None
+    lookup = {"id": channel_id}
+    if server_id is not None:
+        lookup["server_id"] = server_id
+    if category_id is not None:
+        lookup["category_id"] = category_id
+    try:
+        channel = Channel.objects.only("id", "server_id", "category_id").get(**lookup)
+    except (Channel.DoesNotExist, ValidationError, ValueError):
+        return None
+
+    bits = get_server_permissions(user, channel.server_id).for_channel(channel.id)
+    if not bits & Permission.VIEW_CHANNELS:
+        return None
+    return ChannelAccess(channel.id, channel.server_id, channel.category_id, bits)
+
+
+def notify_access_changed(server_id, user_ids=None):
+    """
+    Tells chat connections on the server to re-resolve their access once the
+    current transaction commits: only those of ``user_ids`` when given (their
+    membership or roles changed), otherwise every connection on the server.
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    event = {"type": "access.invalidate", "server_id": str(server_id)}
+    if user_ids is None:
+        groups = [server_access_group(server_id)]
+    else:
+        groups = [user_group(user_id) for user_id in user_ids]
+
+    def send():
+        for group in groups:
+            async_to_sync(channel_layer.group_send)(group, event)
+
+    if groups:
+        transaction.on_commit(send)
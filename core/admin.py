@@ -1,5 +1,9 @@
+from collections import Counter
+
 from django.contrib import admin
-from .models import User, Server, Category, Channel, Message, Role, MessageEditHistory
+from django.http import HttpResponse
+from django.utils.html import format_html
+from .models import User, Server, Category, Channel, Message, Role, MessageEditHistory, ProfileRecord, MediaBlob
 
 # Register your models here.
 
@@ -31,7 +35,7 @@ class ChannelAdmin(admin.ModelAdmin):
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
-    list_display = ("id", "sender", "channel", "created_at", "edited_at", "deleted")
+    list_display = ("id", "sender", "channel", "sequence", "created_at", "edited_at", "deleted")
     search_fields = ("content", "sender__username")
 
 
@@ -45,3 +49,49 @@ class MessageEditHistoryAdmin(admin.ModelAdmin):
 class RoleAdmin(admin.ModelAdmin):
     list_display = ("id", "name", "server", "color")
     search_fields = ("name", "server__name")
+
+
+@admin.register(ProfileRecord)
+class ProfileRecordAdmin(admin.ModelAdmin):
+    list_display = ("target", "kind", "duration_ms", "samples", "requested_by", "created_at")
+    list_filter = ("kind",)
+    search_fields = ("target",)
+    readonly_fields = (
+        "id", "kind", "target", "requested_by", "created_at", "duration_ms", "interval_ms", "samples",
+        "hottest_functions", "folded_stacks",
+    )
+    actions = ["download_folded_stacks"]
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.display(description="Hottest functions (self samples)")
+    def hottest_functions(self, obj):
+        leaves = Counter()
+        for line in obj.folded_stacks.splitlines():
+            stack, _, count = line.rpartition(" ")
+            leaves[stack.rsplit(";", 1)[-1]] += int(count)
+        rows = "\n".join(f"{count:>6}  {frame}" for frame, count in leaves.most_common(20))
+        return format_html("<pre>{}</pre>", rows)
+
+    @admin.action(description="Download folded stacks (flamegraph.pl / speedscope)")
+    def download_folded_stacks(self, request, queryset):
+        # Folded stacks concatenate, so several records merge into one flame graph.
+        body = "\n".join(record.folded_stacks for record in queryset if record.folded_stacks)
+        response = HttpResponse(body + "\n", content_type="text/plain; charset=utf-8")
+        response["Content-Disposition"] = 'attachment; filename="profile.folded"'
+        return response
+
+
+@admin.register(MediaBlob)
+class MediaBlobAdmin(admin.ModelAdmin):
+    list_display = ("name", "size", "references", "created_at")
+    search_fields = ("name", "digest")
+    # Reference counts are kept by core.storage; editing them by hand loses files.
+    readonly_fields = ("name", "digest", "size", "references", "created_at")
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,123 @@
+# Copyright (C) 2025 TG11
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+from collections import deque
+
+from django.conf import settings
+
+from .metrics import registry
+
+# Close code for connections evicted by the "close" policy; the close reason
+# carries the retry hint as "retry_after_ms=<n>".
+CLOSE_SLOW_CONSUMER = 4429
+
+COALESCE = "coalesce"
+DROP_OLDEST = "drop_oldest"
+CLOSE = "close"
+POLICIES = (COALESCE, DROP_OLDEST, CLOSE)
+
+# === Metrics (per worker process, served at /metrics) ===
+BACKPRESSURE_TRIGGERED = registry.counter(
+    "boundless_ws_backpressure_total", "Frames that found the outbound queue full, by policy applied.", ["policy"]
+)
+BACKPRESSURE_DROPPED = registry.counter(
+    "boundless_ws_backpressure_dropped_frames_total",
+    "Frames discarded because the outbound queue was full, by policy applied.",
+    ["policy"],
+)
+
+
+class OutboundQueue:
+    """
+    Bounded per-connection queue of outgoing text frames.
+
+    A writer task sends frames in order. When ``max_frames`` are already
+    waiting, the next frame triggers the policy:
+
+    - coalesce: everything queued plus the new frame becomes one JSON array
+      frame of at most ``max_frames`` items (older items beyond that are dropped)
+    - drop_oldest: the oldest queued frame is discarded
+    - close: the queue is dropped and the socket is closed with a retry hint
+
+    The queue only fills when ``send`` itself waits, i.e. on servers that
+    apply transport flow control to WebSocket sends. Uvicorn, which
+    docker/entrypoint.sh runs, does; Daphne returns at once and buffers
+    without bound in its transport, so no policy ever fires under it.
+    """
+
+    def __init__(self, consumer, max_frames=None, policy=None, retry_after_ms=None):
+        self.consumer = consumer
+        self.max_frames = max_frames or getattr(settings, "CHAT_OUTBOUND_QUEUE_SIZE", 256)
+        self.policy = policy or getattr(settings, "CHAT_BACKPRESSURE_POLICY", COALESCE)
+        self.retry_after_ms = retry_after_ms or getattr(settings, "CHAT_BACKPRESSURE_RETRY_AFTER_MS", 5000)
+        if self.policy not in POLICIES:
+            raise ValueError(f"Unknown backpressure policy {self.policy!r}; expected one of {POLICIES}")
+        self.frames = deque()
+        self.closed = False
+        self._ready = asyncio.Event()
+        self._writer = None
+
+    def start(self):
+        self._writer = asyncio.ensure_future(self._drain())
+
+    async def stop(self):
+        self.closed = True
+        if self._writer is not None:
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+            self._writer = None
+
+    async def put(self, frame):
+        if self.closed:
+            return
+        # Each queued entry is a list of JSON frames sent together; one frame is
+        # sent as is, several as an array.
+        if len(self.frames) < self.max_frames:
+            self.frames.append([frame])
+        elif self.policy == COALESCE:
+            BACKPRESSURE_TRIGGERED.inc(policy=COALESCE)
+            merged = [f for entry in self.frames for f in entry]
+            merged.append(frame)
+            # A coalesced frame is capped too, so memory stays bounded.
+            if len(merged) > self.max_frames:
+                BACKPRESSURE_DROPPED.inc(len(merged) - self.max_frames, policy=COALESCE)
+                merged = merged[-self.max_frames:]
+            self.frames.clear()
+            self.frames.append(merged)
+        elif self.policy == DROP_OLDEST:
+            BACKPRESSURE_TRIGGERED.inc(policy=DROP_OLDEST)
+            BACKPRESSURE_DROPPED.inc(len(self.frames.popleft()), policy=DROP_OLDEST)
+            self.frames.append([frame])
+        else:
+            BACKPRESSURE_TRIGGERED.inc(policy=CLOSE)
+            BACKPRESSURE_DROPPED.inc(sum(map(len, self.frames)) + 1, policy=CLOSE)
+            self.closed = True
+            self.frames.clear()
+            await self.consumer.close(code=CLOSE_SLOW_CONSUMER, reason=f"retry_after_ms={self.retry_after_ms}")
+            return
+        self._ready.set()
+
+    async def _drain(self):
+        while True:
+            await self._ready.wait()
+            while self.frames:
+                entry = self.frames.popleft()
+                text = entry[0] if len(entry) == 1 else "[" + ",".join(entry) + "]"
+                await self.consumer.send(text_data=text)
+            self._ready.clear()
@@ -14,56 +14,387 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import json
+import time
+import uuid
 from channels.generic.websocket import AsyncWebsocketConsumer
 from django.contrib.auth import get_user_model
 from asgiref.sync import sync_to_async
-from .models import Message, Channel
+from .access import resolve_channel_access, server_access_group, user_group
+from .backpressure import OutboundQueue
+from .coalescing import chat_event, message_frame, publish_chat_event
+from .metrics import registry
+from .models import Message
+from .permissions import Permission
+from .profiles import get_profile_card
+from .profiling import ProfiledConsumerMixin
+from .replay import missed_events, replay_buffer
+from .slowqueries import query_origin
+from .writebehind import get_message_buffer
 
 User = get_user_model()
 
+# Close code sent when the user may not (or may no longer) use the channel.
+CLOSE_FORBIDDEN = 4403
 
-class ChatConsumer(AsyncWebsocketConsumer):
+# Upper bound on channels a single gateway connection may follow at once.
+GATEWAY_MAX_SUBSCRIPTIONS = 100
+
+
+# === Metrics (per worker process, served at /metrics) ===
+WS_OPEN_CONNECTIONS = registry.gauge("boundless_ws_open_connections", "Open WebSocket connections.", ["consumer"])
+WS_CONNECTS = registry.counter("boundless_ws_connects_total", "Accepted WebSocket connections.", ["consumer"])
+WS_DISCONNECTS = registry.counter(
+    "boundless_ws_disconnects_total", "Closed accepted WebSocket connections.", ["consumer", "code"]
+)
+WS_MESSAGES_RECEIVED = registry.counter(
+    "boundless_ws_messages_received_total", "Frames received from clients.", ["consumer"]
+)
+WS_SAVE_MESSAGE_SECONDS = registry.histogram(
+    "boundless_ws_save_message_seconds", "Time to store a chat message.", ["mode"]
+)
+WS_GROUP_SEND_SECONDS = registry.histogram(
+    "boundless_ws_group_send_seconds", "Time to publish a chat event to the channel layer.", ["layer"]
+)
+WS_FANOUT_DELAY_SECONDS = registry.histogram(
+    "boundless_ws_fanout_delay_seconds",
+    "Time from publishing a chat event to handing it to a recipient's outbound queue.",
+    ["layer"],
+)
+
+
+def channel_group(channel_id):
+    return f"channel_{channel_id}"
+
+
+get_sender_card = sync_to_async(get_profile_card)
+
+
+def parse_sequence(value):
+    """Returns a client-sent sequence number; raises TypeError unless it is a JSON integer."""
+    # json.loads gives floats (1e999 is inf) and booleans that int() would accept or choke on.
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise TypeError(f"sequence must be an integer, not {type(value).__name__}")
+    return value
+
+
+async def persist_message(user, channel_id, message_content):
+    """Stores the message and returns its channel sequence number."""
+    started = time.perf_counter()
+    message = Message(sender=user, channel_id=channel_id, content=message_content)
+    buffer = get_message_buffer()
+    if buffer is not None:
+        # The number is needed for the broadcast now; only the insert is deferred.
+        message.sequence = await buffer.sequences.allocate(channel_id)
+        await buffer.add(message)
+    else:
+        await sync_to_async(message.save)()
+    WS_SAVE_MESSAGE_SECONDS.observe(
+        time.perf_counter() - started, mode="write_behind" if buffer is not None else "direct"
+    )
+    return message.sequence
+
+
+class ChatDeliveryMixin:
+    """
+    Delivers channel events through a bounded outbound queue and replays the
+    ones a reconnecting client missed.
+
+    Consumers implement ``send_resync(channel_id)`` and send their own
+    frames with ``send_frame``.
+    """
+
+    outbound = None
+
+    async def accept(self, *args, **kwargs):
+        await super().accept(*args, **kwargs)
+        self.outbound = OutboundQueue(self)
+        self.outbound.start()
+        WS_CONNECTS.inc(consumer=type(self).__name__)
+        WS_OPEN_CONNECTIONS.inc(consumer=type(self).__name__)
+
+    async def dispatch(self, message):
+        # Slow queries run by a handler are attributed to it, e.g. "ChatConsumer.websocket.receive".
+        with query_origin(f"{type(self).__name__}.{message['type']}"):
+            await super().dispatch(message)
+
+    async def websocket_receive(self, message):
+        WS_MESSAGES_RECEIVED.inc(consumer=type(self).__name__)
+        await super().websocket_receive(message)
+
+    async def websocket_disconnect(self, message):
+        if self.outbound is not None:
+            await self.outbound.stop()
+            WS_DISCONNECTS.inc(consumer=type(self).__name__, code=message.get("code", ""))
+            WS_OPEN_CONNECTIONS.dec(consumer=type(self).__name__)
+        await super().websocket_disconnect(message)
+
+    async def send_frame(self, frame):
+        await self.outbound.put(frame)
+
+    async def publish(self, group, event):
+        """Publishes a live chat event, stamped for the fan-out delay histogram."""
+        event["sent_at"] = time.time()
+        started = time.perf_counter()
+        await publish_chat_event(self.channel_layer, group, event)
+        WS_GROUP_SEND_SECONDS.observe(time.perf_counter() - started, layer=type(self.channel_layer).__name__)
+
+    def observe_fanout_delay(self, event):
+        # Wall clock, since publisher and recipient may be different processes.
+        sent_at = event.get("sent_at")
+        if sent_at is not None:
+            WS_FANOUT_DELAY_SECONDS.observe(max(0.0, time.time() - sent_at), layer=type(self.channel_layer).__name__)
+
+    async def chat_message(self, event):
+        self.observe_fanout_delay(event)
+        replay_buffer.record(event)
+        # Skip live events the resume replay already sent.
+        replayed_upto = self.replayed_upto.get(event["channel"])
+        if replayed_upto is not None and event["sequence"] <= replayed_upto:
+            return
+        await self.deliver(event)
+
+    async def chat_batch(self, event):
+        for item in event["events"]:
+            self.observe_fanout_delay(item)
+            replay_buffer.record(item)
+        replayed_upto = self.replayed_upto.get(event["channel"])
+        if replayed_upto is None or event["events"][0]["sequence"] > replayed_upto:
+            await self.send_frame(event["text"])
+            return
+        for item in event["events"]:
+            if item["sequence"] > replayed_upto:
+                await self.deliver(item)
+
+    async def deliver(self, event):
+        # Events taken out of a batch handed their serialized frame to the batch.
+        await self.send_frame(event.get("text") or message_frame(event))
+
+    async def resume(self, channel_id, after):
+        events = await missed_events(channel_id, after)
+        if events is None:
+            await self.send_resync(str(channel_id))
+            return
+        replayed_upto = after
+        for event in events:
+            await self.deliver(event)
+            if event["sequence"] == replayed_upto + 1:
+                replayed_upto += 1
+        self.replayed_upto[str(channel_id)] = replayed_upto
+
+
+class ChatConsumer(ProfiledConsumerMixin, ChatDeliveryMixin, AsyncWebsocketConsumer):
     async def connect(self):
         self.server_id = self.scope["url_route"]["kwargs"]["server_id"]
         self.category_id = self.scope["url_route"]["kwargs"]["category_id"]
         self.channel_id = self.scope["url_route"]["kwargs"]["channel_id"]
-        self.room_group_name = f"channel_{self.channel_id}"
+        self.replayed_upto = {}
+        self.access = None
+
+        self.access = await self.resolve_access()
+        if self.access is None:
+            await self.close(code=CLOSE_FORBIDDEN)
+            return
 
+        self.room_group_name = channel_group(self.access.channel_id)
+        # Role and channel edits reach every connection on the server;
+        # membership and role changes only the affected user's.
+        self.access_group_names = [server_access_group(self.access.server_id), user_group(self.scope["user"].pk)]
+        for group in self.access_group_names:
+            await self.channel_layer.group_add(group, self.channel_name)
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
         await self.accept()
 
     async def disconnect(self, close_code):
+        if self.access is None:
+            return
+        await self.leave_groups()
+
+    async def leave_groups(self):
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        for group in self.access_group_names:
+            await self.channel_layer.group_discard(group, self.channel_name)
 
     async def receive(self, text_data):
-        data = json.loads(text_data)
-        message_content = data["message"]
+        if self.access is None:
+            return
+        try:
+            data = json.loads(text_data)
+            # {"type": "resume", "last_sequence": N} right after reconnecting.
+            resume = data.get("type") == "resume"
+            if resume:
+                after = parse_sequence(data["last_sequence"])
+            else:
+                message_content = data["message"]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            await self.send_error("bad_request")
+            return
+        if resume:
+            await self.resume(self.access.channel_id, after)
+            return
+        if not isinstance(message_content, str) or not message_content.strip():
+            await self.send_error("bad_request")
+            return
+        if not self.access.permissions & Permission.SEND_MESSAGES:
+            await self.send_error("forbidden")
+            return
         user = self.scope["user"]
 
         # Save the message to the database
-        await self.save_message(user, message_content)
+        sequence = await self.save_message(user, message_content)
 
         # Broadcast the message to the group
-        await self.channel_layer.group_send(
+        await self.publish(
             self.room_group_name,
-            {
-                "type": "chat_message",
-                "message": message_content,
-                "user": user.username,
-            },
+            chat_event(self.access.channel_id, sequence, message_content, await get_sender_card(user)),
         )
 
-    async def chat_message(self, event):
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "message": event["message"],
-                    "user": event["user"],
-                }
-            )
-        )
+    async def send_error(self, code):
+        await self.send_frame(json.dumps({"type": "error", "code": code}))
+
+    async def send_resync(self, channel_id):
+        await self.send_frame(json.dumps({"type": "resync"}))
+
+    async def access_invalidate(self, event):
+        # Roles, membership or the channel itself changed on this server.
+        self.access = await self.resolve_access()
+        if self.access is None:
+            await self.leave_groups()
+            await self.close(code=CLOSE_FORBIDDEN)
 
     @sync_to_async
-    def save_message(self, user, message_content):
-        channel = Channel.objects.get(id=self.channel_id)
-        Message.objects.create(sender=user, channel=channel, content=message_content)
+    def resolve_access(self):
+        return resolve_channel_access(
+            self.scope["user"], self.channel_id, server_id=self.server_id, category_id=self.category_id
+        )
+
+    async def save_message(self, user, message_content):
+        return await persist_message(user, self.access.channel_id, message_content)
+
+
+class GatewayConsumer(ProfiledConsumerMixin, ChatDeliveryMixin, AsyncWebsocketConsumer):
+    """
+    One socket per user, multiplexing any number of channels.
+
+    Client frames are JSON objects with an ``op``:
+      {"op": "subscribe", "channel": "<id>", "last_sequence": N}  (last_sequence optional)
+      {"op": "unsubscribe", "channel": "<id>"}
+      {"op": "message", "channel": "<id>", "message": "..."}
+
+    A subscribe carrying ``last_sequence`` first replays what the client
+    missed, or answers with a "resync" op if that is too much to replay.
+    The server answers with "subscribed", "unsubscribed" and "error" ops, and
+    pushes {"op": "message", "channel": ..., "sequence": ..., "message": ..., "user": ...}
+    (or an array of those when coalescing) for every subscribed channel plus
+    {"op": "notify", ...} for user-level events.
+    """
+
+    async def connect(self):
+        self.user = self.scope["user"]
+        self.subscriptions = {}  # channel id -> ChannelAccess
+        self.replayed_upto = {}
+        if not self.user.is_authenticated:
+            await self.close(code=CLOSE_FORBIDDEN)
+            return
+        self.user_group_name = user_group(self.user.pk)
+        await self.channel_layer.group_add(self.user_group_name, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        if not self.user.is_authenticated:
+            return
+        for channel_id in list(self.subscriptions):
+            await self.unsubscribe(channel_id)
+        await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
+
+    async def receive(self, text_data):
+        try:
+            data = json.loads(text_data)
+            op = data["op"]
+            channel_id = str(uuid.UUID(str(data["channel"])))
+        except (ValueError, KeyError, TypeError):
+            await self.send_op("error", code="bad_request")
+            return
+
+        if op == "subscribe":
+            await self.subscribe(channel_id)
+            if channel_id in self.subscriptions and data.get("last_sequence") is not None:
+                try:
+                    after = parse_sequence(data["last_sequence"])
+                except (ValueError, TypeError):
+                    await self.send_op("error", channel=channel_id, code="bad_request")
+                    return
+                await self.resume(channel_id, after)
+        elif op == "unsubscribe":
+            if await self.unsubscribe(channel_id):
+                await self.send_op("unsubscribed", channel=channel_id)
+        elif op == "message":
+            await self.post_message(channel_id, data.get("message"))
+        else:
+            await self.send_op("error", channel=channel_id, code="unknown_op")
+
+    async def subscribe(self, channel_id):
+        if channel_id in self.subscriptions:
+            await self.send_op("subscribed", channel=channel_id)
+            return
+        if len(self.subscriptions) >= GATEWAY_MAX_SUBSCRIPTIONS:
+            await self.send_op("error", channel=channel_id, code="too_many_subscriptions")
+            return
+        access = await sync_to_async(resolve_channel_access)(self.user, channel_id)
+        if access is None:
+            await self.send_op("error", channel=channel_id, code="forbidden")
+            return
+        if access.server_id not in self.subscribed_servers():
+            await self.channel_layer.group_add(server_access_group(access.server_id), self.channel_name)
+        self.subscriptions[channel_id] = access
+        await self.channel_layer.group_add(channel_group(channel_id), self.channel_name)
+        await self.send_op("subscribed", channel=channel_id)
+
+    async def unsubscribe(self, channel_id):
+        access = self.subscriptions.pop(channel_id, None)
+        if access is None:
+            return False
+        self.replayed_upto.pop(channel_id, None)
+        await self.channel_layer.group_discard(channel_group(channel_id), self.channel_name)
+        if access.server_id not in self.subscribed_servers():
+            await self.channel_layer.group_discard(server_access_group(access.server_id), self.channel_name)
+        return True
+
+    async def post_message(self, channel_id, message_content):
+        access = self.subscriptions.get(channel_id)
+        if access is None:
+            await self.send_op("error", channel=channel_id, code="not_subscribed")
+            return
+        if not isinstance(message_content, str) or not message_content.strip():
+            await self.send_op("error", channel=channel_id, code="bad_request")
+            return
+        if not access.permissions & Permission.SEND_MESSAGES:
+            await self.send_op("error", channel=channel_id, code="forbidden")
+            return
+        sequence = await persist_message(self.user, access.channel_id, message_content)
+        await self.publish(
+            channel_group(channel_id),
+            chat_event(channel_id, sequence, message_content, await get_sender_card(self.user)),
+        )
+
+    def subscribed_servers(self):
+        return {access.server_id for access in self.subscriptions.values()}
+
+    async def send_op(self, op, **fields):
+        await self.send_frame(json.dumps({"op": op, **fields}))
+
+    async def send_resync(self, channel_id):
+        await self.send_op("resync", channel=channel_id)
+
+    async def user_notify(self, event):
+        await self.send_op("notify", **event["payload"])
+
+    async def access_invalidate(self, event):
+        for channel_id, access in list(self.subscriptions.items()):
+            if str(access.server_id) != event["server_id"]:
+                continue
+            refreshed = await sync_to_async(resolve_channel_access)(self.user, channel_id)
+            if refreshed is None:
+                await self.unsubscribe(channel_id)
+                await self.send_op("unsubscribed", channel=channel_id, reason="forbidden")
+            else:
+                self.subscriptions[channel_id] = refreshed
@@ -0,0 +1,89 @@
+# Copyright (C) 2025 TG11
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+
+from channels_redis.pubsub import (
+    RedisPubSubChannelLayer,
+    RedisPubSubLoopLayer,
+    RedisSingleShardConnection,
+)
+from channels_redis.utils import _wrap_close
+
+
+class LocalFanoutChannelLayer(RedisPubSubChannelLayer):
+    """
+    Channel layer that sends each group message through Redis once per worker.
+
+    group_send is a single PUBLISH on the group's pub/sub channel. Every
+    worker process with members in the group receives it once, decodes it
+    once and puts the same message object on each local member's queue, so
+    a line in a 5,000-member channel costs one Redis command plus one
+    delivery per worker instead of one queued copy per member.
+
+    Consumers receive shared message dicts and must treat them as read-only.
+
+    Built on channels_redis.pubsub internals (the per-loop layer and shard
+    connection classes, _wrap_close), so requirements.txt caps channels-redis
+    below 5. tools/benchmarks/channel_layers.py compares it against the stock
+    RedisPubSubChannelLayer.
+    """
+
+    def _get_layer(self):
+        loop = asyncio.get_running_loop()
+
+        try:
+            layer = self._layers[loop]
+        except KeyError:
+            layer = LocalFanoutLoopLayer(
+                *self._args,
+                **self._kwargs,
+                channel_layer=self,
+            )
+            self._layers[loop] = layer
+            _wrap_close(self, loop)
+
+        return layer
+
+    def deserialize(self, message):
+        # Group messages are decoded once by the shard before fan-out.
+        if isinstance(message, dict):
+            return message
+        return super().deserialize(message)
+
+
+class LocalFanoutLoopLayer(RedisPubSubLoopLayer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._shards = [LocalFanoutShardConnection(shard.host, self) for shard in self._shards]
+
+
+class LocalFanoutShardConnection(RedisSingleShardConnection):
+    def _receive_message(self, message):
+        if message is None:
+            return
+        name = message["channel"]
+        data = message["data"]
+        if isinstance(name, bytes):
+            name = name.decode()
+        layer = self.channel_layer
+        if name in layer.channels:
+            layer.channels[name].put_nowait(data)
+        elif name in layer.groups:
+            decoded = layer.channel_layer.deserialize(data)
+            for channel_name in layer.groups[name]:
+                queue = layer.channels.get(channel_name)
+                if queue is not None:
+                    queue.put_nowait(decoded)
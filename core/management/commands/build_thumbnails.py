@@ -0,0 +1,73 @@
+# Copyright (C) 2025 TG11
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+
+from django.contrib.staticfiles import finders
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import SERVER_ICON_CHOICES, USER_ICON_CHOICES, Server, User
+from core.thumbnails import (
+    DEFAULT_FORMAT,
+    SIZES,
+    ThumbnailPool,
+    default_thumbnail_path,
+    render_thumbnails,
+    thumbnail_format,
+)
+
+
+class Command(BaseCommand):
+    help = "Generates the missing derivatives of every uploaded avatar and server icon."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="images processed in parallel")
+        parser.add_argument(
+            "--defaults",
+            action="store_true",
+            help="instead, rewrite the derivatives of the default images kept next to them in static/",
+        )
+
+    def handle(self, *args, **options):
+        if options["defaults"]:
+            self.build_defaults()
+            return
+        names = set(User.objects.exclude(avatar="").exclude(avatar=None).values_list("avatar", flat=True))
+        names |= set(Server.objects.exclude(icon="").exclude(icon=None).values_list("icon", flat=True))
+
+        pool = ThumbnailPool(options["workers"])
+        futures = {name: pool.submit(name) for name in sorted(names)}
+        written = failed = 0
+        for name, future in futures.items():
+            generated = future.result()
+            if generated is None:
+                failed += 1
+                self.stderr.write(f"Could not process {name}.")
+            else:
+                written += len(generated)
+        self.stdout.write(f"{len(names)} images, {written} {thumbnail_format()} derivatives written, {failed} failed.")
+
+    def build_defaults(self):
+        for path in USER_ICON_CHOICES + SERVER_ICON_CHOICES:
+            source = finders.find(path)
+            if source is None:
+                raise CommandError(f"Default image {path} is not in any static directory.")
+            with open(source, "rb") as f:
+                rendered = render_thumbnails(f, SIZES.values(), DEFAULT_FORMAT)
+            for size, edge in SIZES.items():
+                target = os.path.join(os.path.dirname(source), os.path.basename(default_thumbnail_path(path, size)))
+                with open(target, "wb") as f:
+                    f.write(rendered[edge])
+                self.stdout.write(f"{target} ({len(rendered[edge]):,} bytes)")
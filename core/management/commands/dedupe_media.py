@@ -0,0 +1,78 @@
+# Copyright (C) 2025 TG11
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from collections import defaultdict
+
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from core.models import Server, User
+from core.storage import BLOB_PREFIX, content_digest
+
+IMAGE_FIELDS = ((User, "avatar"), (Server, "icon"))
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves avatars and server icons uploaded before content-addressed storage into blobs, "
+        "so identical files are stored once, and deletes the old copies."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="only report what would be saved")
+        parser.add_argument("--keep-files", action="store_true", help="leave the old files in place")
+
+    def handle(self, *args, **options):
+        # Old file name -> [(model, field, pk)] of the rows referencing it.
+        references = defaultdict(list)
+        for model, field in IMAGE_FIELDS:
+            rows = model.objects.exclude(Q(**{field: ""}) | Q(**{f"{field}__isnull": True}))
+            rows = rows.exclude(**{f"{field}__startswith": BLOB_PREFIX})
+            for pk, name in rows.values_list("pk", field):
+                references[name].append((model, field, pk))
+
+        digests = {}
+        missing = 0
+        for name in references:
+            if not default_storage.exists(name):
+                missing += 1
+                self.stderr.write(f"Missing file {name}, left as is.")
+                continue
+            with default_storage.open(name) as f:
+                digests[name] = (content_digest(File(f)), default_storage.size(name))
+
+        unique = {digest: size for digest, size in digests.values()}
+        before = sum(size for _, size in digests.values())
+        after = sum(unique.values())
+        self.stdout.write(
+            f"{len(digests)} files ({before:,} bytes) hold {len(unique)} distinct images ({after:,} bytes); "
+            f"{missing} missing."
+        )
+        if options["dry_run"]:
+            return
+
+        for name in digests:
+            for model, field, pk in references[name]:
+                storage = model._meta.get_field(field).storage
+                # One save per referencing row: each adds the row's reference to the blob.
+                with default_storage.open(name) as f:
+                    blob = storage.save(name, File(f))
+                model.objects.filter(pk=pk).update(**{field: blob})
+            if not options["keep_files"]:
+                default_storage.delete(name)
+        freed = 0 if options["keep_files"] else before - after
+        self.stdout.write(f"Moved {len(digests)} files into blobs, freeing {freed:,} bytes.")
@@ -0,0 +1,35 @@
+# Copyright (C) 2025 TG11
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import User
+from core.profiling import PROFILE_HEADER, PROFILE_PARAM, make_profile_token
+
+
+class Command(BaseCommand):
+    help = "Prints a signed token that makes requests and WebSocket connections record a profile."
+
+    def add_arguments(self, parser):
+        parser.add_argument("username", help="staff user the profiles are attributed to")
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options["username"], is_staff=True, is_active=True)
+        except User.DoesNotExist:
+            raise CommandError(f"No active staff user named {options['username']!r}.")
+        token = make_profile_token(user)
+        self.stdout.write(token)
+        self.stderr.write(f"Add ?{PROFILE_PARAM}=<token> to a URL or send the {PROFILE_HEADER} header.")
@@ -0,0 +1,351 @@
+# Copyright (C) 2025 TG11
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import random
+import time
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+from itertools import islice
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Max, OuterRef, Subquery
+from django.utils import timezone
+
+from core.models import (
+    Category,
+    Channel,
+    FriendRequest,
+    Message,
+    MessageEditHistory,
+    Role,
+    Server,
+    User,
+)
+from core.permissions import compile_permissions
+
+# Extra roles handed out on every server, after @everyone.
+ROLE_TEMPLATES = [
+    ("Admin", {"administrator": True}, "#E74C3C"),
+    ("Moderator", {"manage_messages": True, "manage_channels": True}, "#3498DB"),
+    ("Regular", {}, "#2ECC71"),
+    ("Muted", {"send_messages": False}, "#95A5A6"),
+]
+
+WORDS = (
+    "the a to and of is in it you that for on with this are be was have just not what we can so but "
+    "lol yes no ok maybe tonight tomorrow server channel raid build patch update bug fix deploy game "
+    "music stream video meme vote event party link check thanks please sorry nice cool great idea"
+).split()
+
+
+def rng_uuid(rng):
+    return uuid.UUID(int=rng.getrandbits(128), version=4)
+
+
+def skewed_index(rng, size, skew):
+    """An index into ``size`` items that favours the front of the list more as ``skew`` grows."""
+    return min(size - 1, int(size * rng.random() ** (1 + skew)))
+
+
+def zipf_sizes(count, mean, skew, lowest, highest):
+    """``count`` sizes around ``mean``, the first ones largest, following a Zipf-like curve."""
+    weights = [1 / (rank + 1) ** skew for rank in range(count)]
+    scale = mean * count / sum(weights)
+    return [max(lowest, min(highest, round(weight * scale))) for weight in weights]
+
+
+def _copy_value(value):
+    if value is None:
+        return r"\N"
+    if value is True:
+        return "t"
+    if value is False:
+        return "f"
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def load_rows(model, fields, rows, batch_size):
+    """
+    Inserts ``rows`` (tuples in ``fields`` order, by attname) into ``model``'s
+    table: with COPY on PostgreSQL, in bulk_create batches elsewhere. COPY
+    keeps the given timestamps; bulk_create replaces auto_now_add ones.
+    Returns the number of rows written.
+    """
+    rows = iter(rows)
+    written = 0
+    column_by_attname = {field.attname: field.column for field in model._meta.concrete_fields}
+    columns = [column_by_attname[field] for field in fields]
+    while batch := list(islice(rows, batch_size)):
+        if connection.vendor == "postgresql":
+            buffer = io.StringIO()
+            for row in batch:
+                buffer.write("\t".join(_copy_value(value) for value in row))
+                buffer.write("\n")
+            buffer.seek(0)
+            with connection.cursor() as cursor:
+                table = connection.ops.quote_name(model._meta.db_table)
+                column_list = ", ".join(connection.ops.quote_name(column) for column in columns)
+                cursor.cursor.copy_expert(f"COPY {table} ({column_list}) FROM STDIN", buffer)
+        else:
+            model.objects.bulk_create(model(**dict(zip(fields, row))) for row in batch)
+        written += len(batch)
+    return written
+
+
+class Command(BaseCommand):
+    help = (
+        "Fills the core models with a synthetic dataset at production scale: users, servers with "
+        "members, roles and channels, a friend graph and message history with edits. Popularity "
+        "and activity are skewed; a few hot channels take a large share of the messages."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=10_000)
+        parser.add_argument("--servers", type=int, default=1_000)
+        parser.add_argument("--members-per-server", type=int, default=50, help="mean; sizes follow --skew")
+        parser.add_argument("--categories-per-server", type=int, default=3)
+        parser.add_argument("--channels-per-server", type=int, default=8)
+        parser.add_argument("--private-channels", type=float, default=0.1, help="fraction limited to roles")
+        parser.add_argument("--messages", type=int, default=1_000_000)
+        parser.add_argument("--hot-channels", type=float, default=0.01, help="fraction of channels that are hot")
+        parser.add_argument("--hot-share", type=float, default=0.5, help="share of messages in hot channels")
+        parser.add_argument(
+            "--skew", type=float, default=1.0,
+            help="0 is uniform; higher concentrates members, messages and friend requests on fewer rows",
+        )
+        parser.add_argument("--friend-requests", type=float, default=10, help="mean sent per user")
+        parser.add_argument("--accepted", type=float, default=0.7, help="fraction of friend requests accepted")
+        parser.add_argument("--edited", type=float, default=0.03, help="fraction of messages with edits")
+        parser.add_argument("--deleted", type=float, default=0.01, help="fraction of messages soft-deleted")
+        parser.add_argument("--days", type=int, default=365, help="history spans this many days up to now")
+        parser.add_argument("--prefix", default="seed-", help="username prefix of the generated users")
+        parser.add_argument("--password", default="password", help="password of every generated user")
+        parser.add_argument("--seed", type=int, default=0, help="random seed; the same seed gives the same data")
+        parser.add_argument("--batch-size", type=int, default=20_000)
+        parser.add_argument(
+            "--replace", action="store_true", help="delete users with --prefix (and their servers) first"
+        )
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.rng = random.Random(options["seed"])
+        prefix = options["prefix"]
+        if User.objects.filter(username__startswith=prefix).exists():
+            if not options["replace"]:
+                raise CommandError(f"Users named {prefix}* already exist; pass --replace to regenerate them.")
+            self.step("Deleting the previous dataset", self.delete_previous)
+
+        self.now = timezone.now()
+        with transaction.atomic():
+            users = self.step("Users", self.create_users)
+            servers = self.step("Servers, members and roles", self.create_servers, users)
+            channels = self.step("Categories and channels", self.create_channels, servers)
+            self.step("Friend requests", self.create_friend_graph, users)
+            self.step("Messages and edits", self.create_messages, channels)
+        if connection.vendor == "postgresql":
+            self.step("ANALYZE", self.analyze)
+
+    def step(self, label, function, *args):
+        started = time.perf_counter()
+        self.stdout.write(f"{label}...", ending="")
+        self.stdout.flush()
+        result = function(*args)
+        self.stdout.write(f" {time.perf_counter() - started:.1f}s")
+        return result
+
+    def delete_previous(self):
+        users = User.objects.filter(username__startswith=self.options["prefix"])
+        servers = Server.objects.filter(owner__in=users)
+        # One DELETE each for the big tables; the cascading delete() below
+        # would load every row into memory first.
+        for queryset in (
+            MessageEditHistory.objects.filter(message__channel__server__in=servers),
+            Message.objects.filter(channel__server__in=servers),
+            FriendRequest.objects.filter(from_user__in=users),
+            Server.members.through.objects.filter(server__in=servers),
+        ):
+            queryset._raw_delete(connection.alias)
+        servers.delete()
+        users.delete()
+
+    def created_at(self, position):
+        """Timestamps spread over --days, ``position`` running from 0 (oldest) to 1 (now)."""
+        return self.now - timedelta(days=self.options["days"]) * (1 - position)
+
+    def create_users(self):
+        password = make_password(self.options["password"])
+        count = self.options["users"]
+        users = [
+            User(
+                id=rng_uuid(self.rng),
+                username=f"{self.options['prefix']}{i}",
+                display_name=f"Seed User {i}",
+                password=password,
+                date_joined=self.created_at(i / count * 0.5),
+            )
+            for i in range(count)
+        ]
+        User.objects.bulk_create(users, batch_size=self.options["batch_size"])
+        # Position in this list is activity rank: the first users send the most.
+        self.activity_rank = {user.id: rank for rank, user in enumerate(users)}
+        return [user.id for user in users]
+
+    def create_servers(self, users):
+        options, rng = self.options, self.rng
+        sizes = zipf_sizes(options["servers"], options["members_per_server"], options["skew"], 1, len(users))
+        servers, roles, memberships, role_users = [], [], [], []
+        self.server_members, self.server_roles = {}, {}
+        for i, size in enumerate(sizes):
+            owner = users[skewed_index(rng, len(users), options["skew"])]
+            server = Server(
+                id=rng_uuid(rng),
+                owner_id=owner,
+                name=f"Seed Server {i}",
+                community=rng.random() < 0.2,
+                join_code=str(rng_uuid(rng)),
+            )
+            # Members in activity order, so skewed picks favour the active ones.
+            members = sorted({owner, *rng.sample(users, size)}, key=self.activity_rank.__getitem__)
+            self.server_members[server.id] = members
+            servers.append(server)
+            memberships.extend((server.id, member) for member in members)
+
+            server_roles = self.server_roles[server.id] = []
+            for name, permissions, color in [("@everyone", {}, "#FFFFFF"), *ROLE_TEMPLATES]:
+                role = Role(
+                    id=rng_uuid(rng),
+                    server_id=server.id,
+                    name=name,
+                    permissions=permissions,
+                    permission_bits=compile_permissions(permissions),
+                    color=color,
+                )
+                roles.append(role)
+                server_roles.append(role)
+                if name != "@everyone":
+                    holders = rng.sample(members, max(1, len(members) // 20))
+                    role_users.extend((role.id, holder) for holder in holders)
+
+        # Server.save would add @everyone itself; bulk_create skips it, so it is in ``roles``.
+        Server.objects.bulk_create(servers, batch_size=options["batch_size"])
+        Role.objects.bulk_create(roles, batch_size=options["batch_size"])
+        load_rows(Server.members.through, ["server_id", "user_id"], memberships, options["batch_size"])
+        load_rows(Role.users.through, ["role_id", "user_id"], role_users, options["batch_size"])
+        return servers
+
+    def create_channels(self, servers):
+        options, rng = self.options, self.rng
+        categories, channels, allowed = [], [], []
+        for server in servers:
+            server_categories = [
+                Category(id=rng_uuid(rng), server_id=server.id, name=f"Category {i}")
+                for i in range(options["categories_per_server"])
+            ]
+            categories.extend(server_categories)
+            for i in range(options["channels_per_server"]):
+                channel = Channel(
+                    id=rng_uuid(rng),
+                    server_id=server.id,
+                    category_id=server_categories[i % len(server_categories)].id if server_categories else None,
+                    name=f"channel-{i}",
+                    is_private=rng.random() < options["private_channels"],
+                )
+                channels.append(channel)
+                if channel.is_private:
+                    # Admins and moderators only.
+                    allowed.extend((channel.id, role.id) for role in self.server_roles[server.id][1:3])
+        Category.objects.bulk_create(categories, batch_size=options["batch_size"])
+        Channel.objects.bulk_create(channels, batch_size=options["batch_size"])
+        load_rows(Channel.allowed_roles.through, ["channel_id", "role_id"], allowed, options["batch_size"])
+        return channels
+
+    def create_friend_graph(self, users):
+        options, rng = self.options, self.rng
+        total = round(len(users) * options["friend_requests"])
+        pairs = set()
+        # Senders are spread evenly; recipients are skewed, so popular users get fan-in.
+        for _ in range(total):
+            sender = users[rng.randrange(len(users))]
+            recipient = users[skewed_index(rng, len(users), options["skew"])]
+            if sender != recipient and (recipient, sender) not in pairs:
+                pairs.add((sender, recipient))
+        requests, friendships = [], []
+        for position, (sender, recipient) in enumerate(sorted(pairs)):
+            accepted = rng.random() < options["accepted"]
+            requests.append(
+                (rng_uuid(rng), sender, recipient, "accepted" if accepted else "pending",
+                 self.created_at(0.5 + position / max(1, len(pairs)) * 0.5))
+            )
+            if accepted:
+                # User.friends is symmetrical: one row per direction.
+                friendships.append((sender, recipient))
+                friendships.append((recipient, sender))
+        batch_size = options["batch_size"]
+        load_rows(FriendRequest, ["id", "from_user_id", "to_user_id", "status", "created_at"], requests, batch_size)
+        load_rows(User.friends.through, ["from_user_id", "to_user_id"], friendships, batch_size)
+
+    def create_messages(self, channels):
+        options, rng = self.options, self.rng
+        total = options["messages"]
+        if not channels or not total:
+            return
+        hot_count = max(1, round(len(channels) * options["hot_channels"]))
+        # The busiest servers' channels come first, so hot channels sit on big servers.
+        hot, cold = channels[:hot_count], channels[hot_count:] or channels
+        last_sequence = defaultdict(int)
+        edits = []
+
+        def messages():
+            for n in range(total):
+                pool = hot if rng.random() < options["hot_share"] else cold
+                channel = pool[skewed_index(rng, len(pool), options["skew"])]
+                members = self.server_members[channel.server_id]
+                sender = members[skewed_index(rng, len(members), options["skew"])]
+                last_sequence[channel.id] += 1
+                created = self.created_at(0.5 + n / total * 0.5)
+                message_id = rng_uuid(rng)
+                content = " ".join(rng.choices(WORDS, k=1 + int(rng.expovariate(1 / 12))))
+                edited_at = deleted_at = None
+                if rng.random() < options["edited"]:
+                    edited_at = created + timedelta(minutes=rng.randrange(1, 120))
+                    for revision in range(1 + int(rng.expovariate(1))):
+                        edits.append((rng_uuid(rng), message_id, sender, f"{content} (revision {revision})", edited_at))
+                deleted = rng.random() < options["deleted"]
+                if deleted:
+                    deleted_at = created + timedelta(hours=rng.randrange(1, 48))
+                yield (
+                    message_id, sender, channel.id, content, created, edited_at, deleted, deleted_at,
+                    last_sequence[channel.id],
+                )
+
+        fields = ["id", "sender_id", "channel_id", "content", "created_at", "edited_at", "deleted", "deleted_at", "sequence"]
+        load_rows(Message, fields, messages(), options["batch_size"])
+        load_rows(
+            MessageEditHistory, ["id", "message_id", "editor_id", "old_content", "edited_at"], edits,
+            options["batch_size"],
+        )
+        # Keep the counters Channel.allocate_sequences hands out ahead of the history.
+        highest = Message.objects.filter(channel=OuterRef("pk")).values("channel").annotate(last=Max("sequence"))
+        Channel.objects.filter(id__in=list(last_sequence)).update(last_sequence=Subquery(highest.values("last")))
+
+    def analyze(self):
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
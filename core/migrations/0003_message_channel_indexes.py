@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:19
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('core', '0002_user_date_of_birth_user_guardian_allows_16plus_and_more'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='message',
+            index=models.Index(fields=['channel', 'created_at', 'id'], name='core_msg_channel_created_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='message',
+            index=models.Index(condition=models.Q(('deleted', False)), fields=['channel', 'created_at', 'id'], name='core_msg_channel_live_idx'),
+        ),
+    ]
@@ -0,0 +1,117 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:41
+
+from django.db import migrations, models, transaction
+
+# Messages numbered per transaction while backfilling; each batch briefly locks
+# its channel's row and the messages it numbers, never the whole table.
+BACKFILL_BATCH_SIZE = 5000
+
+# Numbers the next batch of a channel's unnumbered messages, in (created_at, id)
+# order after the keyset cursor, on top of the channel's counter. The
+# (channel, created_at, id) index from 0003 serves the inner query.
+NUMBER_BATCH_SQL = """
+UPDATE core_message AS m
+SET sequence = %(base)s + batch.n
+FROM (
+    SELECT id, row_number() OVER (ORDER BY created_at, id) AS n
+    FROM core_message
+    WHERE channel_id = %(channel)s AND sequence IS NULL {after}
+    ORDER BY created_at, id
+    LIMIT %(limit)s
+) AS batch
+WHERE m.id = batch.id
+RETURNING batch.n, m.created_at, m.id
+"""
+
+
+def number_channel(cursor, channel_id):
+    after = None
+    while True:
+        with transaction.atomic(using=cursor.db.alias):
+            cursor.execute("SELECT last_sequence FROM core_channel WHERE id = %s FOR UPDATE", [channel_id])
+            (base,) = cursor.fetchone()
+            params = {"base": base, "channel": channel_id, "limit": BACKFILL_BATCH_SIZE}
+            keyset = ""
+            if after is not None:
+                keyset = "AND (created_at, id) > (%(after_created_at)s, %(after_id)s)"
+                params["after_created_at"], params["after_id"] = after
+            cursor.execute(NUMBER_BATCH_SQL.format(after=keyset), params)
+            numbered = cursor.fetchall()
+            if not numbered:
+                return
+            count, *after = max(numbered)
+            cursor.execute(
+                "UPDATE core_channel SET last_sequence = %s WHERE id = %s", [base + count, channel_id]
+            )
+        if count < BACKFILL_BATCH_SIZE:
+            return
+
+
+def backfill_sequences(apps, schema_editor):
+    """
+    Numbers existing messages per channel in (created_at, id) order and moves
+    each channel's counter past its highest message, one short transaction
+    per batch so chat keeps writing while this runs.
+    """
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT id FROM core_channel ORDER BY id")
+        for (channel_id,) in cursor.fetchall():
+            number_channel(cursor, channel_id)
+        # Messages written meanwhile behind a channel's cursor.
+        cursor.execute("SELECT DISTINCT channel_id FROM core_message WHERE sequence IS NULL")
+        for (channel_id,) in cursor.fetchall():
+            number_channel(cursor, channel_id)
+
+
+class Migration(migrations.Migration):
+
+    # The backfill commits per batch, and the NOT NULL constraint is
+    # validated without holding a write-blocking lock.
+    atomic = False
+
+    dependencies = [
+        ('core', '0003_message_channel_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channel',
+            name='last_sequence',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='sequence',
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_sequences, reverse_code=migrations.RunPython.noop),
+        # SET NOT NULL would scan the table under an exclusive lock; a
+        # validated CHECK constraint lets Postgres skip that scan.
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='message',
+                    name='sequence',
+                    field=models.BigIntegerField(editable=False),
+                ),
+            ],
+            database_operations=[
+                migrations.RunSQL(
+                    'ALTER TABLE "core_message" ADD CONSTRAINT "core_msg_sequence_not_null" CHECK ("sequence" IS NOT NULL) NOT VALID;',
+                    reverse_sql='ALTER TABLE "core_message" DROP CONSTRAINT IF EXISTS "core_msg_sequence_not_null";',
+                ),
+                migrations.RunSQL(
+                    'ALTER TABLE "core_message" VALIDATE CONSTRAINT "core_msg_sequence_not_null";',
+                    reverse_sql=migrations.RunSQL.noop,
+                ),
+                migrations.RunSQL(
+                    'ALTER TABLE "core_message" ALTER COLUMN "sequence" SET NOT NULL;',
+                    reverse_sql='ALTER TABLE "core_message" ALTER COLUMN "sequence" DROP NOT NULL;',
+                ),
+                migrations.RunSQL(
+                    'ALTER TABLE "core_message" DROP CONSTRAINT "core_msg_sequence_not_null";',
+                    reverse_sql=migrations.RunSQL.noop,
+                ),
+            ],
+        ),
+    ]
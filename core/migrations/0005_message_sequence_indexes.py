@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:41
+
+from django.contrib.postgres.operations import AddIndexConcurrently, RemoveIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # CREATE/DROP INDEX CONCURRENTLY cannot run inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('core', '0004_message_sequence'),
+    ]
+
+    operations = [
+        # Build the unique index without blocking writes, then attach it as the constraint.
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddConstraint(
+                    model_name='message',
+                    constraint=models.UniqueConstraint(fields=('channel', 'sequence'), name='core_msg_channel_sequence_uniq'),
+                ),
+            ],
+            database_operations=[
+                migrations.RunSQL(
+                    'CREATE UNIQUE INDEX CONCURRENTLY "core_msg_channel_sequence_uniq" ON "core_message" ("channel_id", "sequence");',
+                    reverse_sql='DROP INDEX CONCURRENTLY IF EXISTS "core_msg_channel_sequence_uniq";',
+                ),
+                migrations.RunSQL(
+                    'ALTER TABLE "core_message" ADD CONSTRAINT "core_msg_channel_sequence_uniq" UNIQUE USING INDEX "core_msg_channel_sequence_uniq";',
+                    reverse_sql='ALTER TABLE "core_message" DROP CONSTRAINT "core_msg_channel_sequence_uniq";',
+                ),
+            ],
+        ),
+        AddIndexConcurrently(
+            model_name='message',
+            index=models.Index(condition=models.Q(('deleted', False)), fields=['channel', 'sequence'], name='core_msg_channel_live_seq_idx'),
+        ),
+        RemoveIndexConcurrently(
+            model_name='message',
+            name='core_msg_channel_created_idx',
+        ),
+        RemoveIndexConcurrently(
+            model_name='message',
+            name='core_msg_channel_live_idx',
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 22:05
+
+from django.db import migrations, models
+
+from core.permissions import compile_permissions
+
+
+def compile_role_permissions(apps, schema_editor):
+    Role = apps.get_model('core', 'Role')
+    roles = list(Role.objects.only('id', 'permissions'))
+    for role in roles:
+        role.permission_bits = compile_permissions(role.permissions)
+    Role.objects.bulk_update(roles, ['permission_bits'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_message_sequence_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='role',
+            name='permission_bits',
+            field=models.BigIntegerField(default=3, editable=False),
+        ),
+        migrations.RunPython(compile_role_permissions, migrations.RunPython.noop),
+    ]
@@ -6,28 +6,39 @@ from django.contrib.auth.models import AbstractUser
 from django.templatetags.static import static
 from django.utils.crypto import get_random_string
 from django.utils import timezone
-from django.db import models
-import uuid, random, secrets
+from django.db import connection, models, transaction
+import uuid, secrets
+
+from .permissions import DEFAULT_PERMISSIONS, compile_permissions
+from .storage import blob_storage
+from .thumbnails import default_thumbnail_path, thumbnail_url
 
 # Create your models here.
 
+# Default images, as static paths; see core.thumbnails.DEFAULT_FORMAT.
 SERVER_ICON_CHOICES = [
-    "/media/server_icons/server-default-1.png",
-    "/media/server_icons/server-default-2.png",
-    "/media/server_icons/server-default-3.png",
+    "images/server_icons/server-default-1.png",
+    "images/server_icons/server-default-2.png",
+    "images/server_icons/server-default-3.png",
 ]
 
 USER_ICON_CHOICES = [
-    "/media/avatars/user-default-1.png",
-    "/media/avatars/user-default-2.png",
-    "/media/avatars/user-default-3.png",
+    "images/avatars/user-default-1.png",
+    "images/avatars/user-default-2.png",
+    "images/avatars/user-default-3.png",
 ]
 
+
+def default_image(choices, pk):
+    """The one of ``choices`` for this user or server id: the same on every render and in every process."""
+    return choices[uuid.UUID(str(pk)).int % len(choices)]
+
+
 # === User Model ===
 class User(AbstractUser):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     display_name = models.CharField(max_length=100, blank=True, null=True)
-    avatar = models.ImageField(upload_to="avatars/", blank=True, null=True)
+    avatar = models.ImageField(upload_to="avatars/", storage=blob_storage, blank=True, null=True)
     bio = models.TextField(blank=True, null=True)
     online_status = models.CharField(max_length=10, default="offline")
     created_at = models.DateTimeField(auto_now_add=True)
@@ -131,9 +142,28 @@ class User(AbstractUser):
 
     @property
     def avatar_or_random(self):
+        # No longer random: a user without an avatar always gets the same default.
         if self.avatar and hasattr(self.avatar, "url"):
             return self.avatar.url
-        return random.choice(USER_ICON_CHOICES)
+        return static(default_image(USER_ICON_CHOICES, self.pk))
+
+    def avatar_thumbnail(self, size):
+        if self.avatar:
+            return thumbnail_url(self.avatar.name, size)
+        return static(default_thumbnail_path(default_image(USER_ICON_CHOICES, self.pk), size))
+
+    # Scaled-down avatars; see core.thumbnails.SIZES for where each is shown.
+    @property
+    def avatar_small(self):
+        return self.avatar_thumbnail("small")
+
+    @property
+    def avatar_medium(self):
+        return self.avatar_thumbnail("medium")
+
+    @property
+    def avatar_large(self):
+        return self.avatar_thumbnail("large")
 
 
 class FriendRequest(models.Model):
@@ -164,7 +194,7 @@ class Server(models.Model):
     name = models.CharField(max_length=100)
     description = models.TextField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
-    icon = models.ImageField(upload_to="server_icons/", blank=True, null=True)
+    icon = models.ImageField(upload_to="server_icons/", storage=blob_storage, blank=True, null=True)
     community = models.BooleanField(default=False)
     join_code = models.CharField(max_length=72, unique=True, default=generate_join_code)
     members = models.ManyToManyField(User, related_name="servers", blank=True)
@@ -183,9 +213,28 @@ class Server(models.Model):
 
     @property
     def icon_or_random(self):
+        # No longer random: a server without an icon always gets the same default.
         if self.icon and hasattr(self.icon, "url"):
             return self.icon.url
-        return random.choice(SERVER_ICON_CHOICES)
+        return static(default_image(SERVER_ICON_CHOICES, self.pk))
+
+    def icon_thumbnail(self, size):
+        if self.icon:
+            return thumbnail_url(self.icon.name, size)
+        return static(default_thumbnail_path(default_image(SERVER_ICON_CHOICES, self.pk), size))
+
+    # Scaled-down icons; see core.thumbnails.SIZES for where each is shown.
+    @property
+    def icon_small(self):
+        return self.icon_thumbnail("small")
+
+    @property
+    def icon_medium(self):
+        return self.icon_thumbnail("medium")
+
+    @property
+    def icon_large(self):
+        return self.icon_thumbnail("large")
 
 
 class Category(models.Model):
@@ -206,12 +255,21 @@ class Role(models.Model):
     server = models.ForeignKey(Server, on_delete=models.CASCADE, related_name="roles")
     name = models.CharField(max_length=100)
     permissions = models.JSONField(default=dict)  # JSON for flexibility
+    # core.permissions.Permission bits compiled from ``permissions`` on save.
+    permission_bits = models.BigIntegerField(default=int(DEFAULT_PERMISSIONS), editable=False)
     users = models.ManyToManyField(User, related_name="roles", blank=True)
     color = models.CharField(max_length=7, default="#FFFFFF")
 
     def __str__(self):
         return f"{self.name} - {self.server.name}"
 
+    def save(self, *args, **kwargs):
+        self.permission_bits = compile_permissions(self.permissions)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "permissions" in update_fields:
+            kwargs["update_fields"] = {*update_fields, "permission_bits"}
+        super().save(*args, **kwargs)
+
 
 # === Channel Model ===
 class Channel(models.Model):
@@ -251,10 +309,30 @@ class Channel(models.Model):
     allowed_roles = models.ManyToManyField(Role, related_name="channels", blank=True)
     is_private = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Highest Message.sequence handed out in this channel.
+    last_sequence = models.BigIntegerField(default=0, editable=False)
 
     def __str__(self):
         return f"{self.server.name} - {self.name}"
 
+    @classmethod
+    def allocate_sequences(cls, channel_id, count=1):
+        """
+        Atomically reserves ``count`` message sequence numbers in the channel
+        and returns the highest one; the block is ``last - count + 1 .. last``.
+        The channel row stays locked until the surrounding transaction ends.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {cls._meta.db_table} SET last_sequence = last_sequence + %s "
+                "WHERE id = %s RETURNING last_sequence",
+                [count, channel_id],
+            )
+            row = cursor.fetchone()
+        if row is None:
+            raise cls.DoesNotExist(f"Channel {channel_id} does not exist.")
+        return row[0]
+
 
 # === Message Model ===
 class Message(models.Model):
@@ -268,10 +346,37 @@ class Message(models.Model):
     edited_at = models.DateTimeField(blank=True, null=True)
     deleted = models.BooleanField(default=False)
     deleted_at = models.DateTimeField(blank=True, null=True)
+    # Per-channel, monotonically increasing position assigned on insert; see Channel.allocate_sequences.
+    sequence = models.BigIntegerField(editable=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["channel", "sequence"], name="core_msg_channel_sequence_uniq"),
+        ]
+        indexes = [
+            # Channel history is always read newest-first within one channel.
+            models.Index(
+                fields=["channel", "sequence"],
+                condition=models.Q(deleted=False),
+                name="core_msg_channel_live_seq_idx",
+            ),
+        ]
 
     def __str__(self):
         return f"Message from {self.sender} in {self.channel}"
 
+    def save(self, *args, **kwargs):
+        if self.sequence is not None:
+            return super().save(*args, **kwargs)
+        # Allocate and insert in one transaction so a failed insert gives the number back.
+        try:
+            with transaction.atomic():
+                self.sequence = Channel.allocate_sequences(self.channel_id)
+                super().save(*args, **kwargs)
+        except Exception:
+            self.sequence = None
+            raise
+
 
 class MessageEditHistory(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -327,3 +432,42 @@ class GuardianEmailVerificationToken(models.Model):
 
     def __str__(self):
         return f"GuardianToken for {self.user.username}"
+
+
+# === Request Profiles ===
+class ProfileRecord(models.Model):
+    """A sampled profile of one HTTP request or WebSocket handler; see core.profiling."""
+
+    HTTP = "http"
+    WEBSOCKET = "websocket"
+    KIND_CHOICES = [(HTTP, "HTTP"), (WEBSOCKET, "WebSocket")]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    target = models.CharField(max_length=255)  # "GET /path" or "Consumer.handler"
+    requested_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name="+")
+    created_at = models.DateTimeField(auto_now_add=True)
+    duration_ms = models.FloatField()
+    interval_ms = models.FloatField()
+    samples = models.PositiveIntegerField()
+    # Folded stacks ("outer;inner;leaf <count>" per line), as read by flamegraph.pl and speedscope.
+    folded_stacks = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return f"{self.target} ({self.duration_ms:.0f} ms)"
+
+
+class MediaBlob(models.Model):
+    """One stored file of core.storage.ContentAddressedStorage and how many fields reference it."""
+
+    name = models.CharField(max_length=255, primary_key=True)  # "blobs/ab/<sha256>.png"
+    digest = models.CharField(max_length=64, db_index=True)
+    size = models.PositiveBigIntegerField()
+    references = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.references} references)"
@@ -0,0 +1,56 @@
+# Copyright (C) 2025 TG11
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import enum
+
+
+class Permission(enum.IntFlag):
+    VIEW_CHANNELS = 1 << 0
+    SEND_MESSAGES = 1 << 1
+    MANAGE_MESSAGES = 1 << 2
+    MANAGE_CHANNELS = 1 << 3
+    MANAGE_ROLES = 1 << 4
+    MANAGE_SERVER = 1 << 5
+    ADMINISTRATOR = 1 << 6
+
+
+ALL_PERMISSIONS = Permission(0)
+for _permission in Permission:
+    ALL_PERMISSIONS |= _permission
+
+# What a role grants when its JSON does not say otherwise.
+DEFAULT_PERMISSIONS = Permission.VIEW_CHANNELS | Permission.SEND_MESSAGES
+
+
+def compile_permissions(permissions):
+    """
+    Compiles a Role.permissions JSON object into a bitset.
+
+    Keys are permission names in lower case ("send_messages"); a truthy value
+    grants the permission and a falsy one withholds a default. Unknown keys
+    are ignored. ADMINISTRATOR implies every permission.
+    """
+    bits = DEFAULT_PERMISSIONS
+    for name, granted in (permissions or {}).items():
+        permission = Permission.__members__.get(str(name).upper())
+        if permission is None:
+            continue
+        if granted:
+            bits |= permission
+        else:
+            bits &= ~permission
+    if bits & Permission.ADMINISTRATOR:
+        bits = ALL_PERMISSIONS
+    return int(bits)
@@ -0,0 +1,82 @@
+# Copyright (C) 2025 TG11
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import User
+
+# User fields a profile card is built from; saves touching none of them keep the card.
+CARD_FIELDS = ("username", "display_name", "avatar")
+
+
+class ProfileCard(namedtuple("ProfileCard", ["id", "username", "display_name", "avatar_url"])):
+    """What message rendering needs to know about a sender."""
+
+    __slots__ = ()
+
+    @property
+    def name(self):
+        return self.display_name or self.username
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.username, user.display_name or "", user.avatar_medium)
+
+
+def _card_key(user_id):
+    return f"profile_card:{user_id}"
+
+
+def get_profile_cards(user_ids):
+    """
+    Returns ``{user_id: ProfileCard}`` for the given users: one cache read for
+    all of them, then one query for the ones not cached.
+    """
+    user_ids = set(user_ids)
+    if not user_ids:
+        return {}
+    keys = {_card_key(user_id): user_id for user_id in user_ids}
+    cards = {keys[key]: ProfileCard(*card) for key, card in cache.get_many(keys).items()}
+    missing = user_ids - cards.keys()
+    if missing:
+        fetched = {}
+        for user in User.objects.filter(id__in=missing).only("id", *CARD_FIELDS):
+            cards[user.id] = fetched[_card_key(user.id)] = ProfileCard.from_user(user)
+        cache.set_many(
+            {key: tuple(card) for key, card in fetched.items()},
+            getattr(settings, "PROFILE_CARD_CACHE_TIMEOUT", 60),
+        )
+    return cards
+
+
+def get_profile_card(user):
+    return get_profile_cards([user.pk])[user.pk]
+
+
+def attach_profile_cards(messages):
+    """Sets ``sender_card`` on every message of the page with one batched lookup."""
+    cards = get_profile_cards(message.sender_id for message in messages)
+    for message in messages:
+        message.sender_card = cards[message.sender_id]
+    return messages
+
+
+def invalidate_profile_card(user_id):
+    """Drops the user's cached card once the current transaction commits."""
+    transaction.on_commit(lambda: cache.delete(_card_key(user_id)))
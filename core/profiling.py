@@ -0,0 +1,200 @@
+# Copyright (C) 2025 TG11
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import sys
+import threading
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core import signing
+
+from .models import ProfileRecord, User
+
+# Query parameter and header that carry a profiling token.
+PROFILE_PARAM = "_profile"
+PROFILE_HEADER = "X-Profile-Token"
+
+_SALT = "core.profiling"
+MAX_STACK_DEPTH = 128
+
+
+def make_profile_token(user):
+    """Signs a profiling token for a staff user; see PROFILE_TOKEN_MAX_AGE."""
+    if not user.is_staff:
+        raise ValueError("Only staff users can request profiles.")
+    return signing.TimestampSigner(salt=_SALT).sign(str(user.pk))
+
+
+def profile_requester(token):
+    """Returns the staff user a valid, unexpired token was issued to, or None."""
+    if not token:
+        return None
+    try:
+        user_id = signing.TimestampSigner(salt=_SALT).unsign(
+            token, max_age=getattr(settings, "PROFILE_TOKEN_MAX_AGE", 3600)
+        )
+    except signing.BadSignature:
+        return None
+    return User.objects.filter(pk=user_id, is_staff=True, is_active=True).first()
+
+
+class StackSampler:
+    """
+    Samples the Python stack of one thread from a background thread every
+    ``interval`` seconds and counts identical stacks, which is exactly the
+    folded-stack input flame graph tools expect.
+
+    With ``all_threads`` every thread but the sampler is sampled, each stack
+    rooted at its thread's name; async code hands its database work to
+    executor threads, so that is where its time goes.
+    """
+
+    def __init__(self, thread_id=None, interval=None, all_threads=False):
+        self.thread_id = thread_id or threading.get_ident()
+        self.all_threads = all_threads
+        self.interval = interval or getattr(settings, "PROFILE_SAMPLE_INTERVAL_MS", 5) / 1000
+        self.stacks = Counter()
+        self.samples = 0
+        self.duration = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = None
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self._started
+        return self
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            if self.all_threads:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                targets = [(names.get(ident, str(ident)), frame) for ident, frame in frames.items() if ident != own_id]
+            else:
+                targets = [(None, frames.get(self.thread_id))]
+            for thread_name, frame in targets:
+                stack = []
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    stack.append(f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_qualname}")
+                    frame = frame.f_back
+                if thread_name is not None:
+                    stack.append(f"thread:{thread_name}")
+                if stack:
+                    self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def folded(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+    def to_record(self, kind, target, requested_by):
+        return ProfileRecord(
+            kind=kind,
+            target=target[:255],
+            requested_by=requested_by,
+            duration_ms=self.duration * 1000,
+            interval_ms=self.interval * 1000,
+            samples=self.samples,
+            folded_stacks=self.folded(),
+        )
+
+
+class ProfilingMiddleware:
+    """
+    Profiles a request when it carries a valid token in the ``_profile``
+    query parameter or the X-Profile-Token header, and stores the result as
+    a ProfileRecord for the admin. Requests without a token only pay for
+    looking the token up.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = request.GET.get(PROFILE_PARAM) or request.headers.get(PROFILE_HEADER)
+        requester = profile_requester(token) if token else None
+        if requester is None:
+            return self.get_response(request)
+        sampler = StackSampler().start()
+        try:
+            response = self.get_response(request)
+        finally:
+            sampler.stop()
+            record = sampler.to_record(ProfileRecord.HTTP, f"{request.method} {request.path}", requester)
+            record.save()
+        response["X-Profile-Id"] = str(record.pk)
+        return response
+
+
+class ProfiledConsumerMixin:
+    """
+    Profiles the connect and receive handlers of a WebSocket consumer when
+    the connection was opened with a valid token in the ``_profile`` query
+    parameter or the X-Profile-Token header; one ProfileRecord per handled
+    frame, up to PROFILE_MAX_RECORDS_PER_CONNECTION.
+
+    The sampler watches every thread of the process: the event loop and the
+    executor threads that run the handler's database work. Other
+    connections served by the process at the time show up too.
+    """
+
+    PROFILED_TYPES = ("websocket.connect", "websocket.receive")
+
+    profiling_requester = None
+    profile_records = 0
+
+    async def dispatch(self, message):
+        if message["type"] == "websocket.connect":
+            # Connections without a token skip the hop to a database thread.
+            token = self._profile_token()
+            if token:
+                self.profiling_requester = await database_sync_to_async(profile_requester)(token)
+        if (
+            self.profiling_requester is None
+            or message["type"] not in self.PROFILED_TYPES
+            or self.profile_records >= getattr(settings, "PROFILE_MAX_RECORDS_PER_CONNECTION", 50)
+        ):
+            return await super().dispatch(message)
+
+        self.profile_records += 1
+        sampler = StackSampler(all_threads=True).start()
+        try:
+            return await super().dispatch(message)
+        finally:
+            sampler.stop()
+            target = f"{type(self).__name__}.{message['type'].replace('.', '_')}"
+            record = sampler.to_record(ProfileRecord.WEBSOCKET, target, self.profiling_requester)
+            await database_sync_to_async(record.save)()
+
+    def _profile_token(self):
+        tokens = parse_qs(self.scope.get("query_string", b"").decode()).get(PROFILE_PARAM)
+        if tokens:
+            return tokens[0]
+        header = PROFILE_HEADER.lower().encode()
+        for name, value in self.scope.get("headers", []):
+            if name == header:
+                return value.decode()
+        return None
@@ -0,0 +1,141 @@
+# Copyright (C) 2025 TG11
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import time
+from collections import Counter, namedtuple
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+OFF = "off"
+WARN = "warn"
+RAISE = "raise"
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryStats:
+    """Counts the SQL statements run while installed as a connection execute wrapper."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.count += 1
+            self.statements[sql] += 1
+
+    @property
+    def duration_ms(self):
+        return self.duration * 1000
+
+    @property
+    def duplicates(self):
+        """Statements that repeated an earlier one with the same SQL (parameters aside)."""
+        return sum(count - 1 for count in self.statements.values() if count > 1)
+
+    def most_repeated(self, limit=3):
+        return [(sql, count) for sql, count in self.statements.most_common(limit) if count > 1]
+
+
+@contextmanager
+def capture_queries():
+    """Yields a QueryStats that records every query run on any database inside the block."""
+    stats = QueryStats()
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(stats))
+        yield stats
+
+
+class QueryBudget(namedtuple("QueryBudget", ["queries", "duplicates", "time_ms"])):
+    """Limits for one request; None leaves a limit unchecked."""
+
+    __slots__ = ()
+
+    def violations(self, stats):
+        problems = []
+        if self.queries is not None and stats.count > self.queries:
+            problems.append(f"{stats.count} queries (budget {self.queries})")
+        if self.duplicates is not None and stats.duplicates > self.duplicates:
+            problems.append(f"{stats.duplicates} duplicate queries (budget {self.duplicates})")
+        if self.time_ms is not None and stats.duration_ms > self.time_ms:
+            problems.append(f"{stats.duration_ms:.1f} ms in the database (budget {self.time_ms} ms)")
+        return problems
+
+
+def query_budget(queries, duplicates=None, time_ms=None):
+    """
+    Declares the most queries, duplicate queries and database milliseconds a
+    request to the decorated view may use; QueryBudgetMiddleware enforces it.
+    """
+    budget = QueryBudget(queries, duplicates, time_ms)
+
+    def decorator(view_func):
+        view_func.query_budget = budget
+        return view_func
+
+    return decorator
+
+
+def check_budget(budget, stats, label):
+    """Warns or raises, per QUERY_BUDGET_MODE, when ``stats`` exceed ``budget``."""
+    mode = getattr(settings, "QUERY_BUDGET_MODE", OFF)
+    problems = budget.violations(stats)
+    if mode == OFF or not problems:
+        return
+    message = f"{label} exceeded its query budget: {'; '.join(problems)}"
+    repeated = stats.most_repeated()
+    if repeated:
+        message += "\nMost repeated:\n" + "\n".join(f"  {count}x {sql}" for sql, count in repeated)
+    if mode == RAISE:
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
+
+
+class QueryBudgetMiddleware:
+    """
+    Counts the queries of every request and checks them against the budget
+    the view declared with @query_budget. QUERY_BUDGET_MODE is "off", "warn"
+    (log the offending request) or "raise" (fail it; meant for tests).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if getattr(settings, "QUERY_BUDGET_MODE", OFF) == OFF:
+            return self.get_response(request)
+        with capture_queries() as stats:
+            response = self.get_response(request)
+        budget = getattr(request, "query_budget", None)
+        if budget is not None:
+            check_budget(budget, stats, f"{request.method} {request.path}")
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_budget = getattr(view_func, "query_budget", None)
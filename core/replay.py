@@ -0,0 +1,108 @@
+# Copyright (C) 2025 TG11
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+from collections import OrderedDict, deque
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .coalescing import chat_event
+from .models import Message
+from .profiles import get_profile_cards
+from .writebehind import get_message_buffer
+
+
+class ReplayBuffer:
+    """
+    Recent chat events per channel, kept by every process that has subscribers.
+
+    Each channel holds at most ``per_channel`` events with consecutive
+    sequence numbers; an event that does not follow the newest one restarts
+    the window, so whatever the buffer returns has no holes. Only the
+    ``max_channels`` most recently active channels are kept.
+    """
+
+    def __init__(self, per_channel, max_channels):
+        self.per_channel = per_channel
+        self.max_channels = max_channels
+        self._channels = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, event):
+        channel_id = event["channel"]
+        sequence = event["sequence"]
+        with self._lock:
+            events = self._channels.get(channel_id)
+            if events is None:
+                events = self._channels[channel_id] = deque(maxlen=self.per_channel)
+                while len(self._channels) > self.max_channels:
+                    self._channels.popitem(last=False)
+            else:
+                self._channels.move_to_end(channel_id)
+            if events and sequence <= events[-1]["sequence"]:
+                return  # Already recorded through another local subscriber.
+            if events and sequence != events[-1]["sequence"] + 1:
+                events.clear()
+            events.append(event)
+
+    def clear(self):
+        with self._lock:
+            self._channels.clear()
+
+    def since(self, channel_id, after):
+        """Returns the events after ``after``, or None if the buffer does not reach back that far."""
+        with self._lock:
+            events = self._channels.get(channel_id)
+            if not events or events[0]["sequence"] > after + 1:
+                return None
+            return [event for event in events if event["sequence"] > after]
+
+
+replay_buffer = ReplayBuffer(
+    per_channel=getattr(settings, "CHAT_REPLAY_BUFFER_SIZE", 200),
+    max_channels=getattr(settings, "CHAT_REPLAY_MAX_CHANNELS", 1000),
+)
+
+
+async def missed_events(channel_id, after):
+    """
+    Returns the chat events a client that last saw sequence ``after`` missed,
+    from the replay buffer when it reaches back far enough and from the
+    database otherwise. Returns None if more than CHAT_RESUME_MAX_MESSAGES
+    were missed and the client should reload instead.
+    """
+    channel_id = str(channel_id)
+    events = replay_buffer.since(channel_id, after)
+    if events is not None:
+        return events
+
+    buffer = get_message_buffer()
+    if buffer is not None:
+        await buffer.flush()
+    limit = getattr(settings, "CHAT_RESUME_MAX_MESSAGES", 500)
+    return await sync_to_async(_missed_rows)(channel_id, after, limit)
+
+
+def _missed_rows(channel_id, after, limit):
+    rows = list(
+        Message.objects.filter(channel_id=channel_id, sequence__gt=after, deleted=False)
+        .order_by("sequence")
+        .values_list("sequence", "content", "sender_id")[: limit + 1]
+    )
+    if len(rows) > limit:
+        return None
+    cards = get_profile_cards(sender_id for _, _, sender_id in rows)
+    return [chat_event(channel_id, sequence, content, cards[sender_id]) for sequence, content, sender_id in rows]
@@ -21,4 +21,5 @@ websocket_urlpatterns = [
         r"ws/servers/(?P<server_id>[^/]+)/(?P<category_id>[^/]+)/(?P<channel_id>[^/]+)/$",
         consumers.ChatConsumer.as_asgi(),
     ),
+    re_path(r"ws/gateway/$", consumers.GatewayConsumer.as_asgi()),
 ]
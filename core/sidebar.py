@@ -0,0 +1,72 @@
+# Copyright (C) 2025 TG11
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .access import bump_cache_version, cache_version
+from .models import Category
+from .permissions import Permission
+
+
+def _sidebar_version_key(server_id):
+    return f"sidebar:version:{server_id}"
+
+
+def get_server_sidebar(server_id, permissions):
+    """
+    Returns the server's category/channel tree as a list of
+    ``{"id", "name", "channels": [{"id", "name", "channel_type"}]}`` dicts,
+    without the channels ``permissions`` hides. Without VIEW_CHANNELS (e.g.
+    visitors of a community server) every category is empty.
+
+    The tree is read in one query and cached per server and per set of
+    hidden channels, so users who see the same channels share an entry.
+    """
+    show_channels = permissions.has(Permission.VIEW_CHANNELS)
+    hidden = sorted(permissions.hidden_channel_ids)
+    digest = hashlib.sha1(",".join(hidden).encode()).hexdigest()[:16] if show_channels else "none"
+    key = f"sidebar:{server_id}:{cache_version(_sidebar_version_key(server_id))}:{digest}"
+    tree = cache.get(key)
+    if tree is None:
+        tree = _build_sidebar(server_id, frozenset(hidden), show_channels)
+        cache.set(key, tree, getattr(settings, "SIDEBAR_CACHE_TIMEOUT", 3600))
+    return tree
+
+
+def _build_sidebar(server_id, hidden_channel_ids, show_channels=True):
+    rows = (
+        Category.objects.filter(server_id=server_id)
+        .order_by("name", "id", "channels__created_at")
+        .values_list("id", "name", "channels__id", "channels__name", "channels__channel_type")
+    )
+    tree = []
+    categories = {}
+    for category_id, category_name, channel_id, channel_name, channel_type in rows:
+        category = categories.get(category_id)
+        if category is None:
+            category = categories[category_id] = {"id": category_id, "name": category_name, "channels": []}
+            tree.append(category)
+        # Empty categories come back once with NULL channel columns.
+        if show_channels and channel_id is not None and str(channel_id) not in hidden_channel_ids:
+            category["channels"].append({"id": channel_id, "name": channel_name, "channel_type": channel_type})
+    return tree
+
+
+def invalidate_sidebar(server_id):
+    """Drops every cached sidebar of the server once the current transaction commits."""
+    bump_cache_version(_sidebar_version_key(server_id))
@@ -13,12 +13,150 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from django.db.models.signals import post_save
+from django.db.backends.signals import connection_created
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
 from django.dispatch import receiver
-from .models import Server, Role
+from .access import invalidate_membership, invalidate_server_permissions, notify_access_changed
+from .models import Server, Role, Channel, Category, User
+from .profiles import CARD_FIELDS, invalidate_profile_card
+from .sidebar import invalidate_sidebar
+from .slowqueries import SlowQueryLogger
+from .thumbnails import schedule_thumbnails
+from .timing import record_query
 
+M2M_ACTIONS = ("post_add", "post_remove", "pre_clear")
 
+# Image field of each model whose files live in core.storage's blobs.
+IMAGE_FIELDS = {User: "avatar", Server: "icon"}
+
+
+def access_changed(server_id, user_ids=None):
+    # Invalidate first: both run on commit, in order, and live connections
+    # re-resolve their access through the permission cache. Membership and
+    # role assignments only concern ``user_ids``; role and channel edits
+    # concern everyone on the server.
+    invalidate_server_permissions(server_id, user_ids)
+    notify_access_changed(server_id, user_ids)
+
+
+@receiver(m2m_changed, sender=Server.members.through)
+def server_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in M2M_ACTIONS:
+        return
+    if not reverse:
+        # server.members.add/remove/clear(): pk_set holds user ids.
+        user_ids = pk_set if pk_set is not None else set(instance.members.values_list("id", flat=True))
+        memberships = {instance.pk: user_ids}
+    else:
+        # user.servers.add/remove/clear(): pk_set holds server ids.
+        server_ids = pk_set if pk_set is not None else set(instance.servers.values_list("id", flat=True))
+        memberships = {server_id: {instance.pk} for server_id in server_ids}
+    for server_id, user_ids in memberships.items():
+        invalidate_membership(server_id, user_ids)
+        access_changed(server_id, user_ids)
+
+
+@receiver(m2m_changed, sender=Role.users.through)
+def role_users_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in M2M_ACTIONS:
+        return
+    if not reverse:
+        # role.users.add/remove/clear(): pk_set holds user ids.
+        user_ids = pk_set if pk_set is not None else set(instance.users.values_list("id", flat=True))
+        assignments = {instance.server_id: user_ids}
+    else:
+        # user.roles.add/remove/clear(): pk_set holds role ids.
+        roles = Role.objects.filter(id__in=pk_set) if pk_set is not None else instance.roles.all()
+        assignments = {server_id: {instance.pk} for server_id in roles.values_list("server_id", flat=True)}
+    for server_id, user_ids in assignments.items():
+        access_changed(server_id, user_ids)
+
+
+@receiver(m2m_changed, sender=Channel.allowed_roles.through)
+def channel_roles_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in M2M_ACTIONS:
+        access_changed(instance.server_id)
+
+
+@receiver(post_save, sender=Role)
+def role_saved(sender, instance, **kwargs):
+    access_changed(instance.server_id)
+    invalidate_sidebar(instance.server_id)
+
+
+@receiver(post_delete, sender=Role)
+@receiver(post_delete, sender=Channel)
+def server_object_deleted(sender, instance, **kwargs):
+    access_changed(instance.server_id)
+    invalidate_sidebar(instance.server_id)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Channel)
+@receiver(post_delete, sender=Category)
+def sidebar_changed(sender, instance, **kwargs):
+    invalidate_sidebar(instance.server_id)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, update_fields, **kwargs):
+    # Login only touches last_login; cards only change with their own fields.
+    if created or (update_fields is not None and not set(update_fields) & set(CARD_FIELDS)):
+        return
+    invalidate_profile_card(instance.pk)
+
+
+def release_image(sender, name):
+    # Drops the blob's reference once the change is committed; the last one deletes the file.
+    storage = sender._meta.get_field(IMAGE_FIELDS[sender]).storage
+    transaction.on_commit(lambda: storage.delete(name))
+
+
+@receiver(pre_save, sender=User)
+@receiver(pre_save, sender=Server)
+def image_replacing(sender, instance, update_fields, **kwargs):
+    field = IMAGE_FIELDS[sender]
+    image = getattr(instance, field)
+    if instance._state.adding or (update_fields is not None and field not in update_fields):
+        return
+    # Only a new upload or a cleared field can replace the stored image.
+    if image._committed and image.name:
+        return
+    previous = sender.objects.filter(pk=instance.pk).values_list(field, flat=True).first()
+    if previous and previous != image.name:
+        instance._replaced_image = previous
+
+
+@receiver(post_save, sender=User)
 @receiver(post_save, sender=Server)
-def create_default_role(sender, instance, created, **kwargs):
-    if created:
-        Role.objects.create(server=instance, name="@everyone")
+def image_saved(sender, instance, update_fields, **kwargs):
+    field = IMAGE_FIELDS[sender]
+    previous = instance.__dict__.pop("_replaced_image", None)
+    if previous:
+        release_image(sender, previous)
+    # Start on an uploaded avatar's or icon's derivatives before the first page asks for them.
+    image = getattr(instance, field)
+    if image and (update_fields is None or field in update_fields):
+        transaction.on_commit(lambda: schedule_thumbnails(image.name))
+
+
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Server)
+def image_owner_deleted(sender, instance, **kwargs):
+    image = getattr(instance, IMAGE_FIELDS[sender])
+    if image:
+        release_image(sender, image.name)
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    # Counts queries towards the "db" phase of the request being timed. The
+    # wrapper list belongs to the per-thread connection object, which outlives
+    # the database connections it opens, so it is only installed once.
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+    # Logs queries over SLOW_QUERY_MS with their EXPLAIN plan; one logger per
+    # connection object for the same reason.
+    if not any(isinstance(wrapper, SlowQueryLogger) for wrapper in connection.execute_wrappers):
+        connection.execute_wrappers.append(SlowQueryLogger(connection))
@@ -0,0 +1,181 @@
+# Copyright (C) 2025 TG11
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import contextvars
+import json
+import logging
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from itertools import islice
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.utils import timezone
+
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERIES = registry.counter(
+    "boundless_db_slow_queries_total", "Queries slower than SLOW_QUERY_MS.", ["origin"]
+)
+
+# Statements EXPLAIN accepts; anything else (SAVEPOINT, SET, ...) is logged without a plan.
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+MAX_PARAM_LENGTH = 200
+MAX_PARAMS = 20
+MAX_PLAN_LENGTH = 10_000
+EXPLAIN_SAVEPOINT = "slow_query_explain"
+
+_origin = contextvars.ContextVar("query_origin", default=None)
+_explaining = contextvars.ContextVar("explaining_query", default=False)
+
+_buffer_lock = threading.Lock()
+_buffer = deque(maxlen=getattr(settings, "SLOW_QUERY_BUFFER_SIZE", 100))
+
+
+@contextmanager
+def query_origin(label):
+    """Attributes slow queries run inside the block to ``label`` (a view or consumer handler)."""
+    token = _origin.set(label)
+    try:
+        yield
+    finally:
+        _origin.reset(token)
+
+
+def normalize_sql(sql):
+    """Collapses whitespace and IN lists so the same query groups under one line."""
+    sql = re.sub(r"\s+", " ", sql).strip()
+    return re.sub(r"IN \((?:%s, )*%s\)", "IN (...)", sql)
+
+
+def _short(value):
+    text = repr(value)
+    return text if len(text) <= MAX_PARAM_LENGTH else text[:MAX_PARAM_LENGTH] + "..."
+
+
+def explain(connection, sql, params):
+    """Returns the planner's plan for ``sql`` without running it, or the error explaining why not."""
+    if connection.vendor == "postgresql":
+        prefix = connection.ops.explain_query_prefix(analyze=False)
+    else:
+        prefix = connection.ops.explain_query_prefix()
+    # A failed statement aborts the surrounding transaction on PostgreSQL, so
+    # inside one the EXPLAIN runs in a savepoint that is rolled back on error.
+    savepoint = connection.features.uses_savepoints and connection.in_atomic_block
+    token = _explaining.set(True)
+    try:
+        # The raw DB-API cursor skips the execute wrappers, so neither the
+        # EXPLAIN nor its savepoint is logged again or counted against the request.
+        with connection.cursor() as cursor, connection.wrap_database_errors:
+            raw = cursor.cursor
+            if savepoint:
+                raw.execute(connection.ops.savepoint_create_sql(EXPLAIN_SAVEPOINT))
+            try:
+                raw.execute(f"{prefix} {sql}", params)
+                rows = raw.fetchall()
+            except Exception:
+                if savepoint:
+                    raw.execute(connection.ops.savepoint_rollback_sql(EXPLAIN_SAVEPOINT))
+                raise
+            if savepoint:
+                raw.execute(connection.ops.savepoint_commit_sql(EXPLAIN_SAVEPOINT))
+        plan = "\n".join(" ".join(str(column) for column in row) for row in rows)
+        # Plans repeat long IN lists and arrays verbatim.
+        return plan if len(plan) <= MAX_PLAN_LENGTH else plan[:MAX_PLAN_LENGTH] + "..."
+    except DatabaseError as exc:
+        return f"EXPLAIN failed: {exc}"
+    finally:
+        _explaining.reset(token)
+
+
+def recent_slow_queries():
+    """The slow queries this process logged most recently, newest first."""
+    with _buffer_lock:
+        return list(reversed(_buffer))
+
+
+def clear_slow_queries():
+    with _buffer_lock:
+        _buffer.clear()
+
+
+def _short_params(params):
+    if isinstance(params, dict):
+        return {name: _short(value) for name, value in islice(params.items(), MAX_PARAMS)}
+    shown = [_short(param) for param in islice(params, MAX_PARAMS)]
+    if len(params) > MAX_PARAMS:
+        shown.append(f"... {len(params) - MAX_PARAMS} more")
+    return shown
+
+
+def _record(entry):
+    with _buffer_lock:
+        _buffer.append(entry)
+    SLOW_QUERIES.inc(origin=entry["origin"])
+    logger.warning(json.dumps(entry, default=str))
+
+
+class SlowQueryLogger:
+    """
+    Connection execute wrapper that logs queries slower than SLOW_QUERY_MS
+    with their origin, parameters and EXPLAIN plan; see core.signals.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __call__(self, execute, sql, params, many, context):
+        threshold = getattr(settings, "SLOW_QUERY_MS", 0)
+        if not threshold or _explaining.get():
+            return execute(sql, params, many, context)
+        started = time.perf_counter()
+        result = execute(sql, params, many, context)
+        duration_ms = (time.perf_counter() - started) * 1000
+        if duration_ms >= threshold:
+            plan = None
+            if not many and sql.lstrip().upper().startswith(EXPLAINABLE):
+                plan = explain(self.connection, sql, params)
+            _record(
+                {
+                    "at": timezone.now().isoformat(),
+                    "origin": _origin.get() or "<unknown>",
+                    "database": self.connection.alias,
+                    "duration_ms": round(duration_ms, 2),
+                    "sql": normalize_sql(sql),
+                    "params": _short_params(params) if params and not many else [],
+                    "plan": plan,
+                }
+            )
+        return result
+
+
+class QueryOriginMiddleware:
+    """Labels the queries of each request with its view name (or path, before the URL resolves)."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with query_origin(f"{request.method} {request.path}"):
+            return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # Set again inside the block opened by __call__, which resets it.
+        _origin.set(request.resolver_match.view_name or request.path)
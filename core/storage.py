@@ -0,0 +1,122 @@
+# Copyright (C) 2025 TG11
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, storages
+from django.db import transaction
+from django.db.models import F
+
+BLOB_PREFIX = "blobs/"
+
+# Media paths that are blobs (see blob_name) or their derivatives
+# (core.thumbnails.thumbnail_name); nothing else is served as immutable.
+BLOB_PATH_PATTERN = r"(?:blobs/[0-9a-f]{2}/[0-9a-f]{64}(?:\.\w+)?|thumbnails/blobs/[0-9a-f]{2}/[0-9a-f]{64}-\d+\.\w+)"
+
+# Blob URLs never change content, so browsers and proxies may keep them for a year.
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def content_digest(content):
+    """SHA-256 hex digest of a File's content; leaves it rewound."""
+    digest = hashlib.sha256()
+    content.seek(0)
+    for chunk in content.chunks():
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()
+
+
+def blob_name(digest, original_name):
+    ext = os.path.splitext(original_name)[1].lower()
+    return f"{BLOB_PREFIX}{digest[:2]}/{digest}{ext}"
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Stores every upload once, under its SHA-256 digest (blobs/ab/abcd....png),
+    and counts the references to it in MediaBlob: saving adds one, deleting
+    drops one, and the file goes when the last one does. Identical uploads
+    share a file and a URL, and a URL's content never changes.
+
+    Names this storage did not write (files uploaded before it) are left
+    alone by delete(); ``manage.py dedupe_media`` moves them into blobs.
+    Derivatives (core.thumbnails) are written next to the blobs under their
+    own fixed names, and deleted with the blob they were made from.
+    """
+
+    def __init__(self, **kwargs):
+        # Writing a blob that appeared meanwhile rewrites the same bytes.
+        kwargs.setdefault("allow_overwrite", True)
+        super().__init__(**kwargs)
+
+    def save(self, name, content, max_length=None):
+        from .models import MediaBlob
+
+        if name is None:
+            name = content.name
+        if not hasattr(content, "chunks"):
+            content = File(content, name)
+        digest = content_digest(content)
+        name = blob_name(digest, name)
+        if not self.exists(name):
+            self._save(name, content)
+        _, created = MediaBlob.objects.get_or_create(
+            name=name, defaults={"digest": digest, "size": content.size, "references": 1}
+        )
+        if not created:
+            MediaBlob.objects.filter(pk=name).update(references=F("references") + 1)
+        return name
+
+    def delete(self, name):
+        from .models import MediaBlob
+
+        with transaction.atomic():
+            blob = MediaBlob.objects.select_for_update().filter(pk=name).first()
+            if blob is None:
+                return
+            if blob.references > 1:
+                MediaBlob.objects.filter(pk=name).update(references=F("references") - 1)
+                return
+            blob.delete()
+            transaction.on_commit(lambda: self._delete_unreferenced(name))
+
+    def _delete_unreferenced(self, name):
+        from .models import MediaBlob
+
+        from .thumbnails import delete_thumbnails
+
+        # The same content may have been uploaded again since.
+        if not MediaBlob.objects.filter(pk=name).exists():
+            super().delete(name)
+            delete_thumbnails(name)
+
+    def save_derivative(self, name, content):
+        """Writes ``content`` under exactly ``name``, outside content addressing and reference counts."""
+        return self._save(name, content)
+
+    def delete_derivative(self, name):
+        super().delete(name)
+
+    def get_available_name(self, name, max_length=None):
+        # Blob names are unique by construction; never suffix them.
+        return name
+
+
+def blob_storage():
+    """The storage uploaded avatars and server icons are kept in (STORAGES["blobs"])."""
+    return storages["blobs"]
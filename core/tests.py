@@ -1,3 +1,1138 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from io import BytesIO, StringIO
 
-# Create your tests here.
+from unittest import mock
+
+import uvicorn
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.testing import WebsocketCommunicator
+from channels.routing import URLRouter
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.staticfiles import finders
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.db.models import F, Max
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.http import HttpResponse
+from django.urls import Resolver404, resolve, reverse
+from PIL import Image
+
+from . import thumbnails
+from .access import NO_PERMISSIONS, get_server_permissions, is_server_member
+from .backpressure import BACKPRESSURE_DROPPED, BACKPRESSURE_TRIGGERED, CLOSE_SLOW_CONSUMER, OutboundQueue
+from .coalescing import ChannelBatcher, chat_event
+from .consumers import ChatDeliveryMixin
+from .metrics import Registry
+from .models import (
+    SERVER_ICON_CHOICES,
+    USER_ICON_CHOICES,
+    Category,
+    Channel,
+    FriendRequest,
+    MediaBlob,
+    Message,
+    MessageEditHistory,
+    ProfileRecord,
+    Role,
+    Server,
+    User,
+)
+from .permissions import Permission
+from .profiles import ProfileCard
+from .profiling import make_profile_token, profile_requester
+from .replay import replay_buffer
+from .routing import websocket_urlpatterns
+from .sidebar import get_server_sidebar
+from .storage import blob_storage
+from .timing import record_query
+from .writebehind import MessageWriteBuffer, SequenceAllocator, get_message_buffer
+from .slowqueries import MAX_PARAMS, clear_slow_queries, explain, normalize_sql, recent_slow_queries
+from .querybudget import (
+    QueryBudgetExceeded,
+    QueryBudgetMiddleware,
+    capture_queries,
+    check_budget,
+    query_budget,
+)
+
+
+# Page tests render {% static %} without a collectstatic manifest.
+PLAIN_STATIC_STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+    "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+}
+
+IN_MEMORY_CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+websocket_application = URLRouter(websocket_urlpatterns)
+
+
+def websocket(path, user):
+    """A WebsocketCommunicator for ``path`` with ``user`` logged in, as AuthMiddlewareStack would set it."""
+    communicator = WebsocketCommunicator(websocket_application, path)
+    communicator.scope["user"] = user
+    return communicator
+
+
+@override_settings(QUERY_BUDGET_MODE="raise", STORAGES=PLAIN_STATIC_STORAGES)
+class QueryBudgetViewTests(TestCase):
+    """Every budgeted view stays within its budget, with a cold and a warm cache."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username="owner", password="pw")
+        cls.server = Server.objects.create(owner=cls.owner, name="Budget")
+        cls.server.members.add(cls.owner)
+        cls.senders = [User.objects.create_user(username=f"member{i}", password="pw") for i in range(20)]
+        cls.server.members.add(*cls.senders)
+        cls.category = Category.objects.create(server=cls.server, name="General")
+        cls.channel = Channel.objects.create(server=cls.server, category=cls.category, name="general")
+        for i in range(10):
+            category = Category.objects.create(server=cls.server, name=f"Category {i}")
+            for j in range(5):
+                Channel.objects.create(server=cls.server, category=category, name=f"channel-{i}-{j}")
+        for i in range(120):
+            Message.objects.create(sender=cls.senders[i % 20], channel=cls.channel, content=f"message {i}")
+        cls.edited = Message.objects.filter(channel=cls.channel, sender=cls.senders[0]).first()
+        for i in range(5):
+            MessageEditHistory.objects.create(message=cls.edited, editor=cls.senders[i], old_content=f"draft {i}")
+        cls.role = Role.objects.create(server=cls.server, name="Staff")
+        cls.role.users.add(*cls.senders[:5])
+        for i, sender in enumerate(cls.senders[1:6]):
+            cls.senders[0].friends.add(sender)
+            sender.friends.add(cls.senders[0])
+            FriendRequest.objects.create(from_user=cls.senders[10 + i], to_user=cls.senders[0])
+            community = Server.objects.create(owner=sender, name=f"Community {i}", community=True)
+            community.members.add(sender)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.senders[0])
+
+    def assertWithinBudget(self, url):
+        # Cold cache first, then warm; the middleware raises on a violation.
+        for _ in range(2):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+        return response
+
+    def assertAllWithinBudget(self, urls):
+        for url in urls:
+            with self.subTest(url=url):
+                cache.clear()
+                self.assertWithinBudget(url)
+
+    def test_budgeted_views_declare_budgets(self):
+        for url in self.budgeted_urls() + self.member_urls() + self.owner_urls() + [reverse("home"), reverse("signup")]:
+            with self.subTest(url=url):
+                self.assertIsNotNone(getattr(resolve(url).func, "query_budget", None))
+
+    def test_server_list(self):
+        self.assertWithinBudget(reverse("core:server_list"))
+
+    def test_server_detail(self):
+        self.assertWithinBudget(reverse("core:server_detail", args=[self.server.id]))
+
+    def test_channel_detail(self):
+        response = self.assertWithinBudget(self.channel_url("channel_detail"))
+        self.assertContains(response, "message 119")
+
+    def test_channel_messages(self):
+        response = self.assertWithinBudget(self.channel_url("channel_messages") + "?before=60")
+        self.assertIn("message 58", response.json()["html"])
+
+    def test_member_pages(self):
+        self.assertAllWithinBudget(self.member_urls())
+
+    def test_owner_pages(self):
+        self.client.force_login(self.owner)
+        self.assertAllWithinBudget(self.owner_urls())
+
+    def test_guardian_settings(self):
+        minor = User.objects.create_user(
+            username="minor", password="pw", is_minor_account=True, parental_controls_enabled=True
+        )
+        self.client.force_login(minor)
+        self.assertWithinBudget(reverse("core:guardian_settings"))
+
+    def test_public_pages(self):
+        self.assertAllWithinBudget([reverse("home"), reverse("signup")])
+        self.client.logout()
+        self.assertAllWithinBudget([reverse("home"), reverse("signup")])
+
+    def test_message_history_does_not_grow_with_the_edits(self):
+        url = self.channel_url("message_history", self.edited.id)
+        with capture_queries() as before:
+            self.client.get(url)
+        for i in range(5):
+            MessageEditHistory.objects.create(message=self.edited, editor=self.senders[10 + i], old_content="more")
+        with capture_queries() as after:
+            self.client.get(url)
+        self.assertEqual(before.count, after.count)
+
+    def test_channel_detail_does_not_grow_with_the_page(self):
+        with capture_queries() as before:
+            self.client.get(self.channel_url("channel_detail"))
+        for i in range(30):
+            Message.objects.create(sender=self.senders[i % 20], channel=self.channel, content="more")
+        cache.clear()
+        with capture_queries() as after:
+            self.client.get(self.channel_url("channel_detail"))
+        self.assertEqual(before.count, after.count)
+
+    def budgeted_urls(self):
+        return [
+            reverse("core:server_list"),
+            reverse("core:server_detail", args=[self.server.id]),
+            self.channel_url("channel_detail"),
+            self.channel_url("channel_messages"),
+        ]
+
+    def member_urls(self):
+        me, friend = self.senders[0], self.senders[1]
+        return [
+            reverse("core:discover_community"),
+            reverse("core:profile"),
+            reverse("core:profile", args=[friend.id]),
+            reverse("core:profile", args=[self.senders[15].id]),
+            reverse("core:edit_profile"),
+            reverse("core:friend_requests", args=[me.id]),
+            reverse("core:friends_list", args=[me.id]),
+            reverse("core:parental_controls"),
+            reverse("core:create_server"),
+            reverse("core:category_detail", args=[self.server.id, self.category.id]),
+            self.channel_url("edit_message", self.edited.id),
+            self.channel_url("message_history", self.edited.id),
+        ]
+
+    def owner_urls(self):
+        return [
+            reverse("core:roles_list", args=[self.server.id]),
+            reverse("core:create_role", args=[self.server.id]),
+            reverse("core:edit_role", args=[self.server.id, self.role.id]),
+            reverse("core:assign_role", args=[self.server.id, self.role.id]),
+            reverse("core:create_category", args=[self.server.id]),
+            reverse("core:create_channel", args=[self.server.id]),
+            reverse("core:create_channel", args=[self.server.id, self.category.id]),
+            reverse("core:server_settings", args=[self.server.id]),
+        ]
+
+    def channel_url(self, name, *args):
+        return reverse(f"core:{name}", args=[self.server.id, self.category.id, self.channel.id, *args])
+
+
+@override_settings(STORAGES=PLAIN_STATIC_STORAGES)
+class ChannelPageAccessTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username="owner", password="pw")
+        cls.member = User.objects.create_user(username="member", password="pw")
+        cls.outsider = User.objects.create_user(username="outsider", password="pw")
+        cls.server = Server.objects.create(owner=cls.owner, name="Private", community=True)
+        cls.server.members.add(cls.owner, cls.member)
+        cls.category = Category.objects.create(server=cls.server, name="General")
+        cls.channel = Channel.objects.create(server=cls.server, category=cls.category, name="general")
+        cls.restricted = Channel.objects.create(server=cls.server, category=cls.category, name="staff")
+        cls.restricted.allowed_roles.add(Role.objects.create(server=cls.server, name="Staff"))
+
+    def setUp(self):
+        cache.clear()
+
+    def urls(self, channel):
+        args = [self.server.id, self.category.id, channel.id]
+        return [reverse("core:channel_detail", args=args), reverse("core:channel_messages", args=args)]
+
+    def test_non_members_get_404(self):
+        self.client.force_login(self.outsider)
+        for url in self.urls(self.channel):
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_members_without_an_allowed_role_get_404(self):
+        self.client.force_login(self.member)
+        for url in self.urls(self.channel):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        for url in self.urls(self.restricted):
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class PermissionCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username="owner", password="pw")
+        cls.alice = User.objects.create_user(username="alice", password="pw")
+        cls.bob = User.objects.create_user(username="bob", password="pw")
+        cls.server = Server.objects.create(owner=cls.owner, name="Cached")
+        cls.server.members.add(cls.owner, cls.alice, cls.bob)
+        cls.category = Category.objects.create(server=cls.server, name="General")
+        cls.staff = Role.objects.create(server=cls.server, name="Staff")
+        cls.restricted = Channel.objects.create(server=cls.server, category=cls.category, name="staff")
+        cls.restricted.allowed_roles.add(cls.staff)
+
+    def setUp(self):
+        cache.clear()
+
+    def can_view(self, user):
+        return get_server_permissions(user, self.server.id).has(Permission.VIEW_CHANNELS, self.restricted.id)
+
+    def test_role_assignment_only_drops_the_assignees_entry(self):
+        self.assertFalse(self.can_view(self.alice))
+        self.assertFalse(self.can_view(self.bob))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.staff.users.add(self.alice)
+        self.assertTrue(self.can_view(self.alice))
+        with self.assertNumQueries(0):
+            self.assertFalse(self.can_view(self.bob))
+
+    def test_removed_members_lose_access(self):
+        self.assertNotEqual(get_server_permissions(self.bob, self.server.id).bits, 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.server.members.remove(self.bob)
+        self.assertEqual(get_server_permissions(self.bob, self.server.id).bits, 0)
+
+    def test_role_edits_drop_every_entry(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.staff.users.add(self.alice)
+        self.assertTrue(self.can_view(self.alice))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.restricted.allowed_roles.clear()
+            self.restricted.allowed_roles.add(Role.objects.create(server=self.server, name="Admins"))
+        self.assertFalse(self.can_view(self.alice))
+
+
+class MembershipCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username="owner", password="pw")
+        cls.visitor = User.objects.create_user(username="visitor", password="pw")
+        cls.server = Server.objects.create(owner=cls.owner, name="Members")
+        cls.server.members.add(cls.owner)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_cached_no_is_dropped_on_join(self):
+        self.assertFalse(is_server_member(self.visitor, self.server.id))
+        with self.assertNumQueries(0):
+            self.assertFalse(is_server_member(self.visitor, self.server.id))
+        self.client.force_login(self.visitor)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse("core:join_server", args=[self.server.join_code]))
+        self.assertTrue(is_server_member(self.visitor, self.server.id))
+
+
+class ChannelBatcherTests(TestCase):
+    def test_events_inside_the_window_are_sent_as_one_batch(self):
+        class RecordingLayer:
+            def __init__(self):
+                self.sent = []
+
+            async def group_send(self, group, event):
+                self.sent.append((group, event))
+
+        card = ProfileCard(uuid.uuid4(), "sender", "Sender", "/static/avatar.webp")
+        channel_id = uuid.uuid4()
+
+        async def scenario():
+            batcher = ChannelBatcher(0.01)
+            layer = RecordingLayer()
+            for sequence in (1, 2, 3):
+                await batcher.publish(layer, "channel_a", chat_event(channel_id, sequence, f"m{sequence}", card))
+            await asyncio.gather(*batcher._tasks)
+            return layer.sent
+
+        (_, first), (_, batch) = async_to_sync(scenario)()
+        # The first event goes out at once, the rest together when the window closes.
+        self.assertEqual((first["type"], first["sequence"]), ("chat_message", 1))
+        self.assertEqual(batch["type"], "chat.batch")
+        self.assertEqual([event["sequence"] for event in batch["events"]], [2, 3])
+        self.assertEqual([frame["sequence"] for frame in json.loads(batch["text"])], [2, 3])
+
+    def test_failed_send_reopens_the_group(self):
+        class FailingLayer:
+            def __init__(self):
+                self.sent = []
+
+            async def group_send(self, group, event):
+                if event.get("fail"):
+                    raise ConnectionError("layer down")
+                self.sent.append(event)
+
+        async def scenario():
+            batcher = ChannelBatcher(0.01)
+            layer = FailingLayer()
+            await batcher.publish(layer, "channel_a", {"n": 1})
+            await batcher.publish(layer, "channel_a", {"n": 2, "fail": True})
+            self.assertEqual(len(batcher._tasks), 1)
+            with self.assertLogs("core.coalescing", "ERROR"):
+                await asyncio.gather(*batcher._tasks)
+            self.assertEqual(batcher._open, {})
+            self.assertEqual(batcher._tasks, set())
+            await batcher.publish(layer, "channel_a", {"n": 3})
+            await asyncio.gather(*batcher._tasks)
+            return layer.sent
+
+        self.assertEqual(async_to_sync(scenario)(), [{"n": 1}, {"n": 3}])
+
+
+# Consumers close stale database connections before every handler, which only
+# works outside TestCase's transaction; on_commit callbacks run at once here.
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS,
+    STORAGES=PLAIN_STATIC_STORAGES,
+    CHAT_WRITE_BEHIND=False,
+    CHAT_COALESCE_WINDOW_MS=0,
+)
+class ChatConsumerTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        replay_buffer.clear()
+        self.owner = User.objects.create_user(username="owner", password="pw")
+        self.member = User.objects.create_user(username="member", password="pw")
+        self.other = User.objects.create_user(username="other", password="pw")
+        self.outsider = User.objects.create_user(username="outsider", password="pw")
+        self.server = Server.objects.create(owner=self.owner, name="Chat")
+        self.server.members.add(self.owner, self.member, self.other)
+        self.category = Category.objects.create(server=self.server, name="General")
+        self.channel = Channel.objects.create(server=self.server, category=self.category, name="general")
+        self.restricted = Channel.objects.create(server=self.server, category=self.category, name="staff")
+        self.restricted.allowed_roles.add(Role.objects.create(server=self.server, name="Staff"))
+
+    def path(self, channel=None):
+        channel = channel or self.channel
+        return f"/ws/servers/{self.server.id}/{self.category.id}/{channel.id}/"
+
+    async def test_malformed_frames_get_errors(self):
+        communicator = websocket(self.path(), self.member)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        for frame in ("not json", "[1]", "{}", '{"type": "resume"}', '{"type": "resume", "last_sequence": "x"}',
+                      '{"type": "resume", "last_sequence": 1e999}', '{"message": 5}', '{"message": "  "}'):
+            with self.subTest(frame=frame):
+                await communicator.send_to(text_data=frame)
+                self.assertEqual(await communicator.receive_json_from(), {"type": "error", "code": "bad_request"})
+        # The connection survives all of them.
+        await communicator.send_json_to({"message": "hello"})
+        self.assertEqual((await communicator.receive_json_from())["message"], "hello")
+        await communicator.disconnect()
+
+    async def connected(self, user, channel=None):
+        communicator = websocket(self.path(channel), user)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def post(self, communicator, *contents):
+        """Sends messages and returns the frames echoed back for them."""
+        frames = []
+        for content in contents:
+            await communicator.send_json_to({"message": content})
+            frames.append(await communicator.receive_json_from())
+        return frames
+
+    async def test_users_who_cannot_view_the_channel_are_rejected(self):
+        for user, channel in ((self.outsider, self.channel), (self.member, self.restricted)):
+            with self.subTest(user=user.username, channel=channel.name):
+                connected, code = await websocket(self.path(channel), user).connect()
+                self.assertFalse(connected)
+                self.assertEqual(code, 4403)
+
+    async def test_messages_get_consecutive_sequences(self):
+        communicator = await self.connected(self.member)
+        frames = await self.post(communicator, "one", "two", "three")
+        await communicator.disconnect()
+        self.assertEqual([frame["sequence"] for frame in frames], [1, 2, 3])
+        self.assertEqual([frame["user"] for frame in frames], ["member"] * 3)
+        rows = [row async for row in Message.objects.filter(channel=self.channel).order_by("sequence").values_list("sequence", "content")]
+        self.assertEqual(rows, [(1, "one"), (2, "two"), (3, "three")])
+        await self.channel.arefresh_from_db()
+        self.assertEqual(self.channel.last_sequence, 3)
+
+    async def test_write_behind_numbers_messages_the_same_way(self):
+        with self.settings(CHAT_WRITE_BEHIND=True):
+            communicator = await self.connected(self.member)
+            frames = await self.post(communicator, "one", "two", "three")
+            await communicator.disconnect()
+            await get_message_buffer().drain()
+        self.assertEqual([frame["sequence"] for frame in frames], [1, 2, 3])
+        rows = [row async for row in Message.objects.filter(channel=self.channel).order_by("sequence").values_list("sequence", "content")]
+        self.assertEqual(rows, [(1, "one"), (2, "two"), (3, "three")])
+
+    async def test_removing_a_member_closes_only_their_socket(self):
+        removed = await self.connected(self.member)
+        staying = await self.connected(self.other)
+        await self.server.members.aremove(self.member)
+        self.assertEqual(await removed.receive_output(), {"type": "websocket.close", "code": 4403})
+        self.assertTrue(await staying.receive_nothing())
+        self.assertEqual((await self.post(staying, "still here"))[0]["message"], "still here")
+        await staying.disconnect()
+
+    async def test_resume_replays_what_the_client_missed(self):
+        sender = await self.connected(self.member)
+        await self.post(sender, "one", "two", "three")
+        for after, expected in ((1, [2, 3]), (4, [])):
+            with self.subTest(after=after):
+                late = await self.connected(self.other)
+                await late.send_json_to({"type": "resume", "last_sequence": after})
+                received = [(await late.receive_json_from())["sequence"] for _ in expected]
+                self.assertEqual(received, expected)
+                self.assertTrue(await late.receive_nothing())
+                # Live messages follow without repeating the replayed ones.
+                await self.post(sender, "live")
+                self.assertEqual((await late.receive_json_from())["message"], "live")
+                await late.disconnect()
+        await sender.disconnect()
+
+    async def test_resume_falls_back_to_the_database(self):
+        for i in range(4):
+            await Message.objects.acreate(sender=self.member, channel=self.channel, content=f"stored {i}")
+        communicator = await self.connected(self.other)
+        await communicator.send_json_to({"type": "resume", "last_sequence": 1})
+        frames = [await communicator.receive_json_from() for _ in range(3)]
+        self.assertEqual([(frame["sequence"], frame["message"]) for frame in frames], [(2, "stored 1"), (3, "stored 2"), (4, "stored 3")])
+        with self.settings(CHAT_RESUME_MAX_MESSAGES=2):
+            await communicator.send_json_to({"type": "resume", "last_sequence": 0})
+            self.assertEqual(await communicator.receive_json_from(), {"type": "resync"})
+        await communicator.disconnect()
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS,
+    STORAGES=PLAIN_STATIC_STORAGES,
+    CHAT_WRITE_BEHIND=False,
+    CHAT_COALESCE_WINDOW_MS=0,
+)
+class GatewayConsumerTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        replay_buffer.clear()
+        self.owner = User.objects.create_user(username="owner", password="pw")
+        self.member = User.objects.create_user(username="member", password="pw")
+        self.server = Server.objects.create(owner=self.owner, name="Gateway")
+        self.server.members.add(self.owner, self.member)
+        self.category = Category.objects.create(server=self.server, name="General")
+        self.channels = [
+            Channel.objects.create(server=self.server, category=self.category, name=f"channel-{i}") for i in range(3)
+        ]
+        self.staff = Role.objects.create(server=self.server, name="Staff")
+        self.restricted = Channel.objects.create(server=self.server, category=self.category, name="staff")
+        self.restricted.allowed_roles.add(self.staff)
+
+    async def connected(self, user):
+        communicator = websocket("/ws/gateway/", user)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def request(self, communicator, **frame):
+        await communicator.send_json_to(frame)
+        return await communicator.receive_json_from()
+
+    async def test_anonymous_users_are_rejected(self):
+        connected, code = await websocket("/ws/gateway/", AnonymousUser()).connect()
+        self.assertFalse(connected)
+        self.assertEqual(code, 4403)
+
+    async def test_subscribe_post_and_unsubscribe(self):
+        communicator = await self.connected(self.member)
+        channel = str(self.channels[0].id)
+        self.assertEqual(await self.request(communicator, op="subscribe", channel=channel), {"op": "subscribed", "channel": channel})
+        reply = await self.request(communicator, op="message", channel=channel, message="hi")
+        self.assertEqual((reply["op"], reply["channel"], reply["sequence"], reply["message"]), ("message", channel, 1, "hi"))
+        self.assertEqual(await self.request(communicator, op="unsubscribe", channel=channel), {"op": "unsubscribed", "channel": channel})
+        self.assertEqual(
+            await self.request(communicator, op="message", channel=channel, message="hi"),
+            {"op": "error", "channel": channel, "code": "not_subscribed"},
+        )
+        await communicator.disconnect()
+
+    async def test_subscriptions_are_checked_and_limited(self):
+        communicator = await self.connected(self.member)
+        restricted = str(self.restricted.id)
+        self.assertEqual(
+            await self.request(communicator, op="subscribe", channel=restricted),
+            {"op": "error", "channel": restricted, "code": "forbidden"},
+        )
+        self.assertEqual(
+            await self.request(communicator, op="subscribe", channel="not-a-uuid"), {"op": "error", "code": "bad_request"}
+        )
+        general = str(self.channels[0].id)
+        await communicator.send_to(text_data=f'{{"op": "subscribe", "channel": "{general}", "last_sequence": 1e999}}')
+        self.assertEqual(await communicator.receive_json_from(), {"op": "subscribed", "channel": general})
+        self.assertEqual(await communicator.receive_json_from(), {"op": "error", "channel": general, "code": "bad_request"})
+        await self.request(communicator, op="unsubscribe", channel=general)
+        with mock.patch("core.consumers.GATEWAY_MAX_SUBSCRIPTIONS", 2):
+            replies = [await self.request(communicator, op="subscribe", channel=str(channel.id)) for channel in self.channels]
+        self.assertEqual([reply["op"] for reply in replies], ["subscribed", "subscribed", "error"])
+        self.assertEqual(replies[2]["code"], "too_many_subscriptions")
+        await communicator.disconnect()
+
+    async def test_losing_a_role_unsubscribes_its_channels(self):
+        await self.staff.users.aadd(self.member)
+        communicator = await self.connected(self.member)
+        restricted, general = str(self.restricted.id), str(self.channels[0].id)
+        for channel in (restricted, general):
+            self.assertEqual((await self.request(communicator, op="subscribe", channel=channel))["op"], "subscribed")
+        await self.staff.users.aremove(self.member)
+        self.assertEqual(
+            await communicator.receive_json_from(), {"op": "unsubscribed", "channel": restricted, "reason": "forbidden"}
+        )
+        self.assertTrue(await communicator.receive_nothing())
+        self.assertEqual((await self.request(communicator, op="message", channel=general, message="ok"))["op"], "message")
+        await communicator.disconnect()
+
+
+# bulk_create failing inside TestCase's transaction would abort it before the retry.
+class MessageWriteBufferTests(TransactionTestCase):
+    def setUp(self):
+        owner = User.objects.create_user(username="owner", password="pw")
+        server = Server.objects.create(owner=owner, name="Buffered")
+        category = Category.objects.create(server=server, name="General")
+        self.channel = Channel.objects.create(server=server, category=category, name="general")
+        self.owner = owner
+
+    def message(self, content):
+        sequence = Channel.allocate_sequences(self.channel.id)
+        return Message(sender=self.owner, channel=self.channel, content=content, sequence=sequence)
+
+    def stored(self):
+        return list(Message.objects.order_by("sequence").values_list("content", flat=True))
+
+    def test_flushes_when_the_batch_is_full_or_the_interval_ends(self):
+        buffer = MessageWriteBuffer(interval=0.01, max_batch=2)
+        messages = [self.message(f"m{i}") for i in range(3)]
+
+        async def scenario():
+            await buffer.add(messages[0])
+            await buffer.add(messages[1])  # Full: flushed at once.
+            await asyncio.gather(*buffer._tasks)
+            full = await sync_to_async(self.stored)()
+            await buffer.add(messages[2])  # Flushed when the interval ends.
+            await asyncio.sleep(0.05)
+            return full
+
+        self.assertEqual(async_to_sync(scenario)(), ["m0", "m1"])
+        self.assertEqual(self.stored(), ["m0", "m1", "m2"])
+
+    def test_waiting_messages_share_one_sequence_reservation(self):
+        allocator = SequenceAllocator()
+
+        async def scenario():
+            burst = await asyncio.gather(*(allocator.allocate(self.channel.id) for _ in range(5)))
+            return burst, await allocator.allocate(self.channel.id)
+
+        with capture_queries() as queries:
+            burst, alone = async_to_sync(scenario)()
+        self.assertEqual(burst, [1, 2, 3, 4, 5])
+        self.assertEqual(alone, 6)
+        self.assertEqual(queries.count, 2)
+        self.channel.refresh_from_db()
+        self.assertEqual(self.channel.last_sequence, 6)
+
+    def test_a_failing_batch_is_retried_row_by_row(self):
+        buffer = MessageWriteBuffer(interval=10, max_batch=100)
+        good = [self.message("first"), self.message("second")]
+        # Reuses a sequence number, so the bulk insert violates the unique constraint.
+        clash = Message(sender=self.owner, channel=self.channel, content="clash", sequence=good[0].sequence)
+
+        async def scenario():
+            for message in (good[0], clash, good[1]):
+                await buffer.add(message)
+
+        async_to_sync(scenario)()
+        with self.assertLogs("core.writebehind", "WARNING") as logs:
+            buffer.flush_sync()
+        self.assertEqual(self.stored(), ["first", "second"])
+        self.assertTrue(any("Dropping buffered chat message" in line for line in logs.output))
+
+
+class OutboundQueueTests(TestCase):
+    class StalledConsumer:
+        """Never drains: the queue's writer is not started."""
+
+        closed_with = None
+
+        async def close(self, code=None, reason=None):
+            self.closed_with = (code, reason)
+
+    def fill(self, policy, frames):
+        consumer = self.StalledConsumer()
+        queue = OutboundQueue(consumer, max_frames=3, policy=policy, retry_after_ms=1000)
+        triggered = BACKPRESSURE_TRIGGERED.value(policy=policy)
+        dropped = BACKPRESSURE_DROPPED.value(policy=policy)
+
+        async def put_all():
+            for frame in frames:
+                await queue.put(frame)
+
+        async_to_sync(put_all)()
+        counts = (
+            BACKPRESSURE_TRIGGERED.value(policy=policy) - triggered,
+            BACKPRESSURE_DROPPED.value(policy=policy) - dropped,
+        )
+        return queue, consumer, counts
+
+    def test_coalesce_merges_into_one_capped_frame(self):
+        queue, _, counts = self.fill("coalesce", ["1", "2", "3", "4", "5"])
+        # The merged entry frees room, so the next frame queues normally.
+        self.assertEqual(list(queue.frames), [["2", "3", "4"], ["5"]])
+        # Only the frame cut by the cap is dropped.
+        self.assertEqual(counts, (1, 1))
+
+    def test_drop_oldest_discards_the_oldest_frames(self):
+        queue, _, counts = self.fill("drop_oldest", ["1", "2", "3", "4", "5"])
+        self.assertEqual(list(queue.frames), [["3"], ["4"], ["5"]])
+        self.assertEqual(counts, (2, 2))
+
+    def test_close_evicts_with_a_retry_hint(self):
+        queue, consumer, counts = self.fill("close", ["1", "2", "3", "4", "5"])
+        self.assertTrue(queue.closed)
+        self.assertEqual(list(queue.frames), [])
+        self.assertEqual(consumer.closed_with, (CLOSE_SLOW_CONSUMER, "retry_after_ms=1000"))
+        self.assertEqual(counts, (1, 4))
+
+
+class FloodConsumer(ChatDeliveryMixin, AsyncWebsocketConsumer):
+    """Answers a text frame "<n>" with n frames of FLOOD_FRAME_SIZE characters."""
+
+    async def receive(self, text_data):
+        for _ in range(int(text_data)):
+            await self.send_frame("x" * FLOOD_FRAME_SIZE)
+
+
+FLOOD_FRAME_SIZE = 64 * 1024
+
+
+def websocket_handshake(address):
+    """A raw socket with a small receive buffer, upgraded to a WebSocket; nothing reads from it afterwards."""
+    client = socket.socket()
+    client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    client.settimeout(5)
+    client.connect(address)
+    client.sendall(
+        b"GET / HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+        b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n"
+    )
+    response = b""
+    while b"\r\n\r\n" not in response:
+        response += client.recv(1)
+    assert response.startswith(b"HTTP/1.1 101"), response
+    return client
+
+
+def masked_text_frame(text):
+    payload = text.encode()
+    mask = os.urandom(4)
+    return bytes([0x81, 0x80 | len(payload)]) + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CHAT_OUTBOUND_QUEUE_SIZE=8, CHAT_BACKPRESSURE_POLICY="drop_oldest"
+)
+class StalledTransportTests(TransactionTestCase):
+    """The queue fills under the ASGI server the deployment runs (docker/entrypoint.sh)."""
+
+    def serve(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        config = uvicorn.Config(
+            FloodConsumer.as_asgi(), ws="websockets-sansio", lifespan="off", log_level="warning"
+        )
+        server = uvicorn.Server(config)
+        thread = threading.Thread(target=server.run, kwargs={"sockets": [listener]}, daemon=True)
+        thread.start()
+
+        def stop():
+            server.should_exit = True
+            thread.join(10)
+            listener.close()
+
+        self.addCleanup(stop)
+        while not server.started:
+            time.sleep(0.01)
+        return listener.getsockname()
+
+    def test_a_client_that_stops_reading_triggers_the_policy(self):
+        client = websocket_handshake(self.serve())
+        self.addCleanup(client.close)
+        triggered = BACKPRESSURE_TRIGGERED.value(policy="drop_oldest")
+        # 25 MB, far more than the socket buffers between the two ends hold.
+        client.sendall(masked_text_frame("400"))
+        deadline = time.monotonic() + 10
+        while BACKPRESSURE_TRIGGERED.value(policy="drop_oldest") == triggered and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertGreater(BACKPRESSURE_TRIGGERED.value(policy="drop_oldest"), triggered)
+
+
+class SidebarTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username="owner", password="pw")
+        cls.member = User.objects.create_user(username="member", password="pw")
+        cls.server = Server.objects.create(owner=cls.owner, name="Sidebar", community=True)
+        cls.server.members.add(cls.owner, cls.member)
+        cls.category = Category.objects.create(server=cls.server, name="General")
+        cls.channel = Channel.objects.create(server=cls.server, category=cls.category, name="general")
+        cls.restricted = Channel.objects.create(server=cls.server, category=cls.category, name="staff")
+        cls.restricted.allowed_roles.add(Role.objects.create(server=cls.server, name="Staff"))
+
+    def setUp(self):
+        cache.clear()
+
+    def channel_names(self, permissions):
+        return [channel["name"] for category in get_server_sidebar(self.server.id, permissions) for channel in category["channels"]]
+
+    def test_hidden_channels_are_left_out(self):
+        self.assertEqual(self.channel_names(get_server_permissions(self.owner, self.server.id)), ["general", "staff"])
+        self.assertEqual(self.channel_names(get_server_permissions(self.member, self.server.id)), ["general"])
+
+    def test_no_channels_without_view_channels(self):
+        self.channel_names(get_server_permissions(self.member, self.server.id))
+        self.assertEqual(self.channel_names(NO_PERMISSIONS), [])
+        self.assertEqual([category["name"] for category in get_server_sidebar(self.server.id, NO_PERMISSIONS)], ["General"])
+
+    def test_channel_changes_invalidate_the_cached_tree(self):
+        permissions = get_server_permissions(self.member, self.server.id)
+        self.channel_names(permissions)
+        with self.captureOnCommitCallbacks(execute=True):
+            Channel.objects.create(server=self.server, category=self.category, name="random")
+        self.assertEqual(self.channel_names(permissions), ["general", "random"])
+
+
+class QueryBudgetTests(TestCase):
+    def test_capture_counts_queries_and_duplicates(self):
+        with capture_queries() as stats:
+            for _ in range(3):
+                User.objects.filter(username="nobody").exists()
+            Server.objects.count()
+        self.assertEqual(stats.count, 4)
+        self.assertEqual(stats.duplicates, 2)
+        self.assertGreaterEqual(stats.duration_ms, 0)
+        self.assertEqual(stats.most_repeated()[0][1], 3)
+
+    @override_settings(QUERY_BUDGET_MODE="raise")
+    def test_middleware_raises_over_budget(self):
+        @query_budget(queries=1)
+        def view(request):
+            list(User.objects.all())
+            list(Server.objects.all())
+            return HttpResponse()
+
+        middleware = QueryBudgetMiddleware(lambda request: middleware.process_view(request, view, (), {}) or view(request))
+        with self.assertRaisesMessage(QueryBudgetExceeded, "2 queries (budget 1)"):
+            middleware(RequestFactory().get("/"))
+
+    @override_settings(QUERY_BUDGET_MODE="warn")
+    def test_warn_mode_logs(self):
+        with capture_queries() as stats:
+            connection.cursor().execute("SELECT 1")
+            connection.cursor().execute("SELECT 1")
+        with self.assertLogs("core.querybudget", level="WARNING") as logs:
+            check_budget(query_budget(queries=5, duplicates=0)(lambda request: None).query_budget, stats, "test")
+        self.assertIn("1 duplicate queries (budget 0)", logs.output[0])
+
+    @override_settings(QUERY_BUDGET_MODE="off")
+    def test_off_mode_ignores_budgets(self):
+        with capture_queries() as stats:
+            list(User.objects.all())
+        check_budget(query_budget(queries=0)(lambda request: None).query_budget, stats, "test")
+
+
+@override_settings(STORAGES=PLAIN_STATIC_STORAGES)
+class ServerTimingTests(TestCase):
+    def test_server_timing_header_and_metrics(self):
+        user = User.objects.create_user(username="timed", password="pw")
+        self.client.force_login(user)
+        response = self.client.get(reverse("core:server_list"))
+        for phase in ("session", "auth", "db", "tpl", "total"):
+            self.assertIn(f"{phase};dur=", response["Server-Timing"])
+        with self.settings(SERVER_TIMING_PHASES=False):
+            response = self.client.get(reverse("core:server_list"))
+        self.assertRegex(response["Server-Timing"], r"^total;dur=[0-9.]+$")
+
+        with self.settings(METRICS_TOKEN="secret"):
+            self.assertEqual(self.client.get("/metrics").status_code, 403)
+            metrics = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(metrics.status_code, 200)
+        self.assertIn('boundless_http_requests_total{view="core:server_list",method="GET",status="200"}', metrics.content.decode())
+        # Logged in, but the view never touches the session or the user.
+        self.assertNotIn("Cookie", metrics.get("Vary", ""))
+
+    def test_reconnecting_does_not_add_wrappers(self):
+        # CONN_MAX_AGE=0 closes the connection after every request.
+        wrapper = connections.create_connection(DEFAULT_DB_ALIAS)
+        self.addCleanup(wrapper.close)
+        for _ in range(3):
+            wrapper.ensure_connection()
+            wrapper.close()
+        self.assertEqual(wrapper.execute_wrappers.count(record_query), 1)
+
+    def test_histogram_rendering(self):
+        registry = Registry()
+        histogram = registry.histogram("test_seconds", "Test.", ["view"], buckets=(0.1, 1.0))
+        histogram.observe(0.05, view="a")
+        histogram.observe(0.5, view="a")
+        histogram.observe(5, view="a")
+        lines = registry.render().splitlines()
+        self.assertIn('test_seconds_bucket{view="a",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{view="a",le="1.0"} 2', lines)
+        self.assertIn('test_seconds_bucket{view="a",le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_count{view="a"} 3', lines)
+
+
+@override_settings(STORAGES=PLAIN_STATIC_STORAGES, PROFILE_SAMPLE_INTERVAL_MS=1)
+class ProfilingTests(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create_user(username="staff", password="pw", is_staff=True)
+
+    def test_tokens_are_staff_only(self):
+        self.assertEqual(profile_requester(make_profile_token(self.staff)), self.staff)
+        self.assertIsNone(profile_requester("staff:forged"))
+        with self.assertRaises(ValueError):
+            make_profile_token(User.objects.create_user(username="member", password="pw"))
+
+    def test_profiled_request_stores_a_record(self):
+        self.client.force_login(self.staff)
+        self.assertNotIn("X-Profile-Id", self.client.get(reverse("core:server_list")))
+        response = self.client.get(reverse("core:server_list"), {"_profile": make_profile_token(self.staff)})
+        record = ProfileRecord.objects.get(pk=response["X-Profile-Id"])
+        self.assertEqual(record.kind, ProfileRecord.HTTP)
+        self.assertEqual(record.requested_by, self.staff)
+        self.assertEqual(record.target, "GET " + reverse("core:server_list"))
+
+
+# As for ChatConsumerTests, consumers need to run outside TestCase's transaction.
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ProfiledConsumerTests(TransactionTestCase):
+    async def test_profiled_connection_stores_records(self):
+        staff = await User.objects.acreate(username="staff", is_staff=True)
+        for path, records in (("/ws/gateway/", 0), (f"/ws/gateway/?_profile={make_profile_token(staff)}", 1)):
+            with self.subTest(path=path):
+                communicator = websocket(path, staff)
+                connected, _ = await communicator.connect()
+                self.assertTrue(connected)
+                await communicator.disconnect()
+                count = await ProfileRecord.objects.filter(kind=ProfileRecord.WEBSOCKET).acount()
+                self.assertEqual(count, records)
+
+
+@override_settings(STORAGES=PLAIN_STATIC_STORAGES)
+class SlowQueryLogTests(TestCase):
+    def setUp(self):
+        clear_slow_queries()
+        self.addCleanup(clear_slow_queries)
+
+    def test_slow_queries_carry_origin_and_plan(self):
+        user = User.objects.create_user(username="slow", password="pw")
+        self.client.force_login(user)
+        with self.settings(SLOW_QUERY_MS=0.0001), self.assertLogs("core.slowqueries", level="WARNING"):
+            self.client.get(reverse("core:discover_community"))
+        entries = [entry for entry in recent_slow_queries() if entry["origin"] == "core:discover_community"]
+        server_query = next(entry for entry in entries if 'FROM "core_server"' in entry["sql"])
+        self.assertIn(str(user.pk), server_query["params"][-1])
+        self.assertTrue(server_query["plan"])
+        self.assertNotIn("EXPLAIN failed", server_query["plan"])
+
+    def test_slow_queries_are_staff_only(self):
+        self.client.force_login(User.objects.create_user(username="member", password="pw"))
+        self.assertEqual(self.client.get("/debug/slow-queries").status_code, 302)
+        self.client.force_login(User.objects.create_user(username="staff", password="pw", is_staff=True))
+        self.assertIn("queries", self.client.get("/debug/slow-queries").json())
+
+    def test_normalize_sql_collapses_in_lists(self):
+        self.assertEqual(normalize_sql("SELECT  *\n FROM t WHERE id IN (%s, %s, %s)"), "SELECT * FROM t WHERE id IN (...)")
+
+    def test_failed_explain_leaves_the_transaction_usable(self):
+        # TestCase runs every test inside a transaction.
+        plan = explain(connection, "SELECT * FROM core_no_such_table WHERE id = %s", [1])
+        self.assertTrue(plan.startswith("EXPLAIN failed"))
+        self.assertEqual(User.objects.filter(username="nobody").count(), 0)
+
+    def test_slow_queries_are_logged_once_across_reconnects(self):
+        wrapper = connections.create_connection(DEFAULT_DB_ALIAS)
+        self.addCleanup(wrapper.close)
+        for _ in range(3):
+            wrapper.ensure_connection()
+            wrapper.close()
+        with self.settings(SLOW_QUERY_MS=0.0001), self.assertLogs("core.slowqueries", level="WARNING") as logs:
+            with wrapper.cursor() as cursor:
+                cursor.execute("SELECT 1")
+        self.assertEqual(len(logs.output), 1)
+
+    def test_long_parameter_lists_are_capped(self):
+        ids = [uuid.UUID(int=i) for i in range(MAX_PARAMS * 3)]
+        with self.settings(SLOW_QUERY_MS=0.0001), self.assertLogs("core.slowqueries", level="WARNING"):
+            list(User.objects.filter(pk__in=ids))
+        entry = next(entry for entry in recent_slow_queries() if "IN (...)" in entry["sql"])
+        self.assertEqual(len(entry["params"]), MAX_PARAMS + 1)
+        self.assertEqual(entry["params"][-1], f"... {MAX_PARAMS * 2} more")
+
+
+class SeedDataTests(TestCase):
+    def seed(self, **options):
+        call_command("seed_data", users=40, servers=6, messages=600, stdout=StringIO(), **options)
+
+    def test_seeds_consistent_data(self):
+        self.seed()
+        self.assertEqual(User.objects.filter(username__startswith="seed-").count(), 40)
+        self.assertEqual(Server.objects.count(), 6)
+        self.assertEqual(Role.objects.filter(name="@everyone").count(), 6)
+        self.assertEqual(Message.objects.count(), 600)
+        self.assertTrue(FriendRequest.objects.exists())
+        for channel in Channel.objects.annotate(highest=Max("messages__sequence")).exclude(highest=None):
+            self.assertEqual(channel.last_sequence, channel.highest)
+        # Every sender is a member of the server they wrote in.
+        self.assertFalse(Message.objects.exclude(channel__server__members=F("sender")).exists())
+
+    def test_refuses_to_seed_twice_without_replace(self):
+        self.seed()
+        with self.assertRaises(CommandError):
+            self.seed()
+        self.seed(replace=True, seed=1)
+        self.assertEqual(Message.objects.count(), 600)
+
+
+class ThumbnailTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = self.settings(MEDIA_ROOT=media_root, THUMBNAIL_FORMAT="webp", THUMBNAIL_WORKERS=1)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(thumbnails._ready.clear)
+        buffer = BytesIO()
+        Image.new("RGBA", (600, 400), (200, 40, 40, 255)).save(buffer, "PNG")
+        self.name = default_storage.save("avatars/upload.png", ContentFile(buffer.getvalue()))
+
+    def test_serves_the_original_until_the_derivative_exists(self):
+        self.assertEqual(thumbnails.thumbnail_url(self.name, "medium"), default_storage.url(self.name))
+        thumbnails.schedule_thumbnails(self.name).result()
+        url = thumbnails.thumbnail_url(self.name, "medium")
+        self.assertTrue(url.endswith("thumbnails/avatars/upload-96.webp"))
+        with default_storage.open(thumbnails.thumbnail_name(self.name, "medium")) as f, Image.open(f) as image:
+            self.assertEqual((image.format, image.size), ("WEBP", (96, 96)))
+
+    def test_generates_every_size_once(self):
+        written = thumbnails.generate_thumbnails(self.name)
+        self.assertEqual(len(written), len(thumbnails.SIZES))
+        self.assertEqual(thumbnails.generate_thumbnails(self.name), [])
+
+    def test_user_properties_use_derivatives(self):
+        thumbnails.generate_thumbnails(self.name)
+        user = User(username="pictured", avatar=self.name)
+        self.assertTrue(user.avatar_large.endswith("upload-160.webp"))
+        self.assertTrue(user.avatar_small.endswith("upload-64.webp"))
+
+
+def png_bytes(color):
+    buffer = BytesIO()
+    Image.new("RGB", (8, 8), color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class ContentAddressedStorageTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = self.settings(MEDIA_ROOT=media_root, THUMBNAIL_WORKERS=0)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def user_with_avatar(self, username, content):
+        user = User(username=username)
+        user.avatar = ContentFile(content, name="avatar.png")
+        user.save()
+        return user
+
+    def test_identical_uploads_share_one_counted_blob(self):
+        first = self.user_with_avatar("first", png_bytes("red"))
+        second = self.user_with_avatar("second", png_bytes("red"))
+        self.assertEqual(first.avatar.name, second.avatar.name)
+        self.assertTrue(first.avatar.name.startswith("blobs/"))
+        self.assertEqual(MediaBlob.objects.get(pk=first.avatar.name).references, 2)
+
+        name = first.avatar.name
+        with self.captureOnCommitCallbacks(execute=True):
+            first.avatar = ContentFile(png_bytes("blue"), name="other.png")
+            first.save()
+        self.assertEqual(MediaBlob.objects.get(pk=name).references, 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(MediaBlob.objects.filter(pk=name).exists())
+        self.assertFalse(blob_storage().exists(name))
+
+    def test_blobs_are_served_as_immutable(self):
+        user = self.user_with_avatar("served", png_bytes("green"))
+        with self.settings(DEBUG=True):
+            response = self.client.get(user.avatar.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("immutable", response["Cache-Control"])
+        # Outside DEBUG the front proxy serves media.
+        self.assertEqual(self.client.get(user.avatar.url).status_code, 404)
+
+    def test_derivatives_go_with_the_last_reference(self):
+        user = self.user_with_avatar("thumbnailed", png_bytes("red"))
+        name = user.avatar.name
+        written = thumbnails.generate_thumbnails(name)
+        self.assertEqual(len(written), len(thumbnails.SIZES))
+        self.assertTrue(all(thumb.startswith("thumbnails/blobs/") for thumb in written))
+        with self.captureOnCommitCallbacks(execute=True):
+            user.delete()
+        self.assertFalse(blob_storage().exists(name))
+        self.assertFalse(any(blob_storage().exists(thumb) for thumb in written))
+
+    def test_only_blob_paths_are_served_as_immutable(self):
+        digest = "ab" + "0" * 62
+        media = settings.MEDIA_URL
+        for path in (f"blobs/ab/{digest}.png", f"blobs/ab/{digest}", f"thumbnails/blobs/ab/{digest}-96.webp"):
+            with self.subTest(path=path):
+                self.assertEqual(resolve(media + path).url_name, "media_blob")
+        for path in ("blobs/avatar.png", f"blobs/ab/{digest}.png/../x", f"thumbnails/blobs/ab/{digest}.webp", "blobs/ab/cd.png"):
+            with self.subTest(path=path):
+                try:
+                    self.assertNotEqual(resolve(media + path).url_name, "media_blob")
+                except Resolver404:
+                    pass
+
+    def test_dedupe_media_moves_old_uploads_into_blobs(self):
+        users = [User.objects.create(username=f"old{i}") for i in range(3)]
+        for i, user in enumerate(users):
+            name = default_storage.save(f"avatars/old{i}.png", ContentFile(png_bytes("red")))
+            User.objects.filter(pk=user.pk).update(avatar=name)
+        call_command("dedupe_media", stdout=StringIO())
+        names = set(User.objects.filter(username__startswith="old").values_list("avatar", flat=True))
+        self.assertEqual(len(names), 1)
+        self.assertEqual(MediaBlob.objects.get(pk=names.pop()).references, 3)
+        self.assertFalse(default_storage.exists("avatars/old0.png"))
+
+
+@override_settings(STORAGES=PLAIN_STATIC_STORAGES)
+class DefaultImageTests(TestCase):
+    def test_defaults_are_stable_per_id(self):
+        users = [User(id=uuid.UUID(int=i), username=f"user{i}") for i in range(30)]
+        for user in users:
+            again = User(id=user.id, username=user.username)
+            self.assertEqual(user.avatar_medium, again.avatar_medium)
+            self.assertEqual(user.avatar_or_random, again.avatar_or_random)
+        # Every default is used by someone.
+        self.assertEqual(len({user.avatar_or_random for user in users}), len(USER_ICON_CHOICES))
+
+    def test_default_derivatives_are_committed(self):
+        for path in USER_ICON_CHOICES + SERVER_ICON_CHOICES:
+            for size in thumbnails.SIZES:
+                with self.subTest(path=path, size=size):
+                    self.assertIsNotNone(finders.find(thumbnails.default_thumbnail_path(path, size)))
@@ -0,0 +1,189 @@
+# Copyright (C) 2025 TG11
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps, features
+
+from .storage import blob_storage
+
+logger = logging.getLogger(__name__)
+
+# Square edge in pixels of each derivative: twice the largest size it is shown
+# at (small: 32 px sidebar icons, medium: 36-48 px avatars and server lists,
+# large: 64-80 px icons and profile pictures), for high-density screens.
+SIZES = {"small": 64, "medium": 96, "large": 160}
+
+# The default avatars and icons are static files whose derivatives are
+# committed next to them (manage.py build_thumbnails --defaults), so they are
+# served with hashed, immutable URLs like any other static file.
+DEFAULT_FORMAT = "webp"
+
+SAVE_OPTIONS = {
+    "webp": {"quality": 80, "method": 4},
+    "avif": {"quality": 60},
+    "png": {"optimize": True},
+}
+
+# Derivatives known to exist, and sources that could not be processed; both per process.
+_ready = set()
+_failed = set()
+
+
+@lru_cache(maxsize=None)
+def _can_encode(fmt):
+    return fmt == "png" or bool(features.check(fmt))
+
+
+def thumbnail_format():
+    """THUMBNAIL_FORMAT, or png when this Pillow build cannot encode it."""
+    fmt = getattr(settings, "THUMBNAIL_FORMAT", "webp").lower()
+    return fmt if fmt in SAVE_OPTIONS and _can_encode(fmt) else "png"
+
+
+def thumbnail_name(name, size, fmt=None):
+    """Storage name of the ``size`` derivative of the image stored as ``name``."""
+    stem = os.path.splitext(name)[0]
+    return f"thumbnails/{stem}-{SIZES[size]}.{fmt or thumbnail_format()}"
+
+
+def thumbnail_url(name, size):
+    """
+    URL of the ``size`` ("small", "medium" or "large") derivative of the image
+    stored as ``name``. Until it has been generated this is the URL of the
+    image itself, and generating it is queued.
+    """
+    storage = blob_storage()
+    thumb = thumbnail_name(name, size)
+    if thumb in _ready:
+        return storage.url(thumb)
+    if name not in _failed:
+        if storage.exists(thumb):
+            _ready.add(thumb)
+            return storage.url(thumb)
+        schedule_thumbnails(name)
+    return storage.url(name)
+
+
+def render_thumbnails(source, edges, fmt):
+    """Returns ``{edge: encoded image}``: ``source`` (a file) cropped square and scaled to each edge."""
+    rendered = {}
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        transparent = "A" in image.getbands() or "transparency" in image.info
+        image = image.convert("RGBA" if transparent else "RGB")
+        # Crop to a square once at the largest edge, then scale that down.
+        largest = max(edges)
+        image = ImageOps.fit(image, (largest, largest), Image.Resampling.LANCZOS)
+        for edge in sorted(edges, reverse=True):
+            resized = image if edge == largest else image.resize((edge, edge), Image.Resampling.LANCZOS)
+            buffer = BytesIO()
+            resized.save(buffer, fmt.upper(), **SAVE_OPTIONS[fmt])
+            rendered[edge] = buffer.getvalue()
+    return rendered
+
+
+def generate_thumbnails(name):
+    """Writes the derivatives of ``name`` that do not exist yet; returns their names."""
+    storage = blob_storage()
+    missing = {SIZES[size]: thumbnail_name(name, size) for size in SIZES}
+    missing = {edge: thumb for edge, thumb in missing.items() if not storage.exists(thumb)}
+    if missing:
+        with storage.open(name) as source:
+            rendered = render_thumbnails(source, missing, thumbnail_format())
+        for edge, thumb in missing.items():
+            # Another process writing the same derivative meanwhile writes the same bytes.
+            storage.save_derivative(thumb, ContentFile(rendered[edge]))
+    _ready.update(thumbnail_name(name, size) for size in SIZES)
+    return list(missing.values())
+
+
+def delete_thumbnails(name):
+    """Deletes every derivative of ``name``, in any format it may have been written in."""
+    storage = blob_storage()
+    for fmt in SAVE_OPTIONS:
+        for size in SIZES:
+            thumb = thumbnail_name(name, size, fmt)
+            _ready.discard(thumb)
+            storage.delete_derivative(thumb)
+
+
+def default_thumbnail_path(path, size):
+    """Static path of the ``size`` derivative of the default image at static ``path``."""
+    stem = os.path.splitext(path)[0]
+    return f"{stem}-{SIZES[size]}.{DEFAULT_FORMAT}"
+
+
+class ThumbnailPool:
+    """
+    Generates derivatives on ``workers`` background threads, so requests
+    never wait on Pillow. Pillow releases the GIL while it decodes, resizes
+    and encodes, so the threads run in parallel. A source already queued is
+    not queued again. Futures resolve to the names written, or None when the
+    source could not be processed.
+    """
+
+    def __init__(self, workers):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbnails")
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, name):
+        with self._lock:
+            future = self._pending.get(name)
+            if future is None:
+                future = self._pending[name] = self._executor.submit(self._generate, name)
+        return future
+
+    def _generate(self, name):
+        try:
+            return generate_thumbnails(name)
+        except Exception:
+            logger.exception("Could not generate thumbnails of %s", name)
+            _failed.add(name)
+            return None
+        finally:
+            with self._lock:
+                self._pending.pop(name, None)
+
+
+_thumbnail_pool = None
+_thumbnail_pool_lock = threading.Lock()
+
+
+def get_thumbnail_pool():
+    """Returns the process-wide pool, or None when THUMBNAIL_WORKERS is 0."""
+    global _thumbnail_pool
+    workers = getattr(settings, "THUMBNAIL_WORKERS", 0)
+    if workers <= 0:
+        return None
+    if _thumbnail_pool is None:
+        with _thumbnail_pool_lock:
+            if _thumbnail_pool is None:
+                _thumbnail_pool = ThumbnailPool(workers)
+    return _thumbnail_pool
+
+
+def schedule_thumbnails(name):
+    """Queues generating the derivatives of ``name``; returns the Future, or None without a pool."""
+    pool = get_thumbnail_pool()
+    return pool.submit(name) if pool is not None else None
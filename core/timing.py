@@ -0,0 +1,194 @@
+# Copyright (C) 2025 TG11
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import contextvars
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.template.backends.django import DjangoTemplates
+from django.utils.functional import SimpleLazyObject
+
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Phases reported in Server-Timing, in header order. They may overlap: the
+# database time spent loading the session also counts towards "db".
+PHASES = ("session", "auth", "db", "tpl")
+
+REQUEST_DURATION = registry.histogram(
+    "boundless_http_request_duration_seconds", "Time from the first middleware to the response.", ["view", "method"]
+)
+REQUEST_PHASE_DURATION = registry.histogram(
+    "boundless_http_request_phase_seconds", "Time spent per request phase.", ["view", "phase"]
+)
+REQUEST_QUERIES = registry.histogram(
+    "boundless_http_request_queries",
+    "Database queries per request.",
+    ["view"],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200),
+)
+REQUESTS = registry.counter("boundless_http_requests_total", "Requests served.", ["view", "method", "status"])
+
+_current = contextvars.ContextVar("request_timing", default=None)
+
+
+class RequestTiming:
+    """Phase durations (seconds) and query count of the request being served."""
+
+    __slots__ = ("phases", "queries")
+
+    def __init__(self):
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.queries = 0
+
+    def server_timing(self, total, phases=True):
+        entries = [f"{phase};dur={self.phases[phase] * 1000:.2f}" for phase in PHASES] if phases else []
+        entries.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(entries)
+
+
+@contextmanager
+def timed(phase):
+    """Adds the time spent in the block to ``phase`` of the current request, if one is being timed."""
+    record = _current.get()
+    if record is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record.phases[phase] += time.perf_counter() - started
+
+
+def record_query(execute, sql, params, many, context):
+    """Connection execute wrapper installed on every connection; see core.signals."""
+    record = _current.get()
+    if record is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        record.phases["db"] += time.perf_counter() - started
+        record.queries += 1
+
+
+class ServerTimingMiddleware:
+    """
+    Times each request and its phases, adds a Server-Timing header and feeds
+    the per-view histograms exported by the metrics view. Goes first in
+    MIDDLEWARE; RequestPhaseMiddleware, after AuthenticationMiddleware,
+    times the session and user loads.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not getattr(settings, "SERVER_TIMING", True):
+            return self.get_response(request)
+        record = RequestTiming()
+        token = _current.set(record)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        total = time.perf_counter() - started
+
+        match = request.resolver_match
+        view = match.view_name if match is not None else "<unresolved>"
+        response["Server-Timing"] = record.server_timing(total, getattr(settings, "SERVER_TIMING_PHASES", True))
+        REQUESTS.inc(view=view, method=request.method, status=response.status_code)
+        REQUEST_DURATION.observe(total, view=view, method=request.method)
+        REQUEST_QUERIES.observe(record.queries, view=view)
+        for phase, seconds in record.phases.items():
+            REQUEST_PHASE_DURATION.observe(seconds, view=view, phase=phase)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                json.dumps(
+                    {
+                        "view": view,
+                        "method": request.method,
+                        "path": request.path,
+                        "status": response.status_code,
+                        "total_ms": round(total * 1000, 2),
+                        "queries": record.queries,
+                        **{f"{phase}_ms": round(seconds * 1000, 2) for phase, seconds in record.phases.items()},
+                    }
+                )
+            )
+        return response
+
+
+class RequestPhaseMiddleware:
+    """
+    Counts loading the session and the user as the "session" and "auth"
+    phases, whenever the code that touches them first does. Neither is loaded
+    for a request that does not use it, so such responses carry no
+    ``Vary: Cookie``.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if _current.get() is not None:
+            if hasattr(request, "session"):
+                load = request.session.load
+
+                def timed_load():
+                    with timed("session"):
+                        return load()
+
+                # SessionBase._get_session() calls self.load() on first access.
+                request.session.load = timed_load
+            if hasattr(request, "user"):
+
+                def timed_get_user():
+                    with timed("auth"):
+                        return get_user(request)
+
+                # As AuthenticationMiddleware does, with the load timed.
+                request.user = SimpleLazyObject(timed_get_user)
+        return self.get_response(request)
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """The Django template backend, with rendering time counted as the "tpl" phase."""
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
+
+
+class TimedTemplate:
+    def __init__(self, template):
+        self._template = template
+
+    def __getattr__(self, name):
+        return getattr(self._template, name)
+
+    def render(self, context=None, request=None):
+        with timed("tpl"):
+            return self._template.render(context, request)
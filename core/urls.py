@@ -40,6 +40,7 @@ urlpatterns = [
     path("servers/<uuid:server_id>/<uuid:category_id>/", views.category_detail, name="category_detail",),
     path('servers/<uuid:server_id>/<uuid:category_id>/create_channel/', views.create_channel, name='create_channel'),
     path("servers/<uuid:server_id>/<uuid:category_id>/<uuid:channel_id>/", views.channel_detail,name="channel_detail",),
+    path("servers/<uuid:server_id>/<uuid:category_id>/<uuid:channel_id>/messages/", views.channel_messages, name="channel_messages"),
     path("servers/<uuid:server_id>/<uuid:category_id>/<uuid:channel_id>/<uuid:message_id>/edit/", views.edit_message, name="edit_message"),
     path("servers/<uuid:server_id>/<uuid:category_id>/<uuid:channel_id>/<uuid:message_id>/delete/", views.delete_message, name="delete_message"),
     path('servers/<uuid:server_id>/<uuid:category_id>/<uuid:channel_id>/<uuid:message_id>/history/', views.message_history, name='message_history',),
@@ -1,27 +1,44 @@
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from .models import Server, Channel, Message, User, FriendRequest, Category, MessageEditHistory, Role, GuardianEmailVerificationToken
 from django.contrib.auth.forms import UserCreationForm
 from .forms import CustomUserCreationForm, ProfileEditForm, ServerSettingsForm, ParentalControlsForm, GuardianSettingsForm
-from django.http import HttpResponseForbidden
+from .access import get_server_permissions, is_server_member
+from .permissions import Permission
+from .profiles import attach_profile_cards
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, registry as metrics_registry
+from .querybudget import query_budget
+from .sidebar import get_server_sidebar
+from .slowqueries import recent_slow_queries
+from .storage import IMMUTABLE_CACHE_CONTROL
+from django.http import Http404, HttpResponse, HttpResponseForbidden, HttpResponseBadRequest, JsonResponse
+from django.template.loader import render_to_string
+from django.views.static import serve as serve_file
 import uuid
 from django.core.exceptions import ValidationError, PermissionDenied
 import logging
 from django import forms
 from django.utils import timezone
 from django.contrib import messages as django_messages
+from django.conf import settings
 from datetime import date, timedelta
 import secrets
 logger = logging.getLogger(__name__)
 
+# Number of messages rendered on the first load of a channel and per "load older" page.
+MESSAGE_PAGE_SIZE = 50
+
 # Create your views here.
 
 
+@query_budget(queries=2, duplicates=0)
 def home(request):
     return render(request, "home.html")
 
 
 @login_required
+@query_budget(queries=5, duplicates=1)
 def server_list(request):
     # servers = Server.objects.all()
     servers = request.user.servers.all()  # Only servers the user is a member of
@@ -29,23 +46,27 @@ def server_list(request):
 
 
 @login_required
+@query_budget(queries=3, duplicates=0)
 def discover_community_servers(request):
     servers = Server.objects.filter(community=True).exclude(members=request.user)
     return render(request, "core/server/discover_community.html", {"servers": servers})
 
 
 @login_required
+@query_budget(queries=10, duplicates=1)
 def server_detail(request, server_id):
     server = get_object_or_404(Server, id=server_id)
     # Check if user is a member or if community=True
-    if not server.community and request.user not in server.members.all():
-        return PermissionDenied("You do not have access to this server.")
-    categories = server.categories.prefetch_related("channels").all()
-    user_roles = server.roles.filter(users=request.user)
-    channels = server.channels.filter(allowed_roles__in=user_roles).distinct()
+    if not server.community and not is_server_member(request.user, server.id):
+        raise PermissionDenied("You do not have access to this server.")
+    permissions = get_server_permissions(request.user, server.id)
+    if permissions.has(Permission.VIEW_CHANNELS):
+        channels = server.channels.exclude(id__in=permissions.hidden_channel_ids)
+    else:
+        channels = server.channels.none()
     user = request.user
 
-    if request.method == "POST" and user in server.members.all():
+    if request.method == "POST" and permissions.has(Permission.SEND_MESSAGES):
         # Use the first channel as default for sending
         channel = channels.first()
         Message.objects.create(
@@ -57,7 +78,7 @@ def server_detail(request, server_id):
         "core/server/server_detail.html",
         {
             "server": server,
-            "categories": categories,
+            "sidebar": get_server_sidebar(server.id, permissions),
             "channels": channels,  # Optional: if you want to show non-categorized channels separately
         },
     )
@@ -105,6 +126,7 @@ def decline_friend_request(request, request_id):
 
 
 @login_required
+@query_budget(queries=6, duplicates=1)
 def profile(request, user_id=None):
     if user_id:
         try:
@@ -133,6 +155,7 @@ def profile(request, user_id=None):
 
 
 @login_required
+@query_budget(queries=2, duplicates=0)
 def edit_profile(request):
     if request.method == "POST":
         form = ProfileEditForm(request.POST, request.FILES, instance=request.user)
@@ -144,6 +167,7 @@ def edit_profile(request):
     return render(request, "core/profile/edit_profile.html", {"form": form})
 
 
+@query_budget(queries=2, duplicates=0)
 def signup(request):
     if request.method == "POST":
         form = CustomUserCreationForm(request.POST, request.FILES)
@@ -194,6 +218,7 @@ class ServerCreationForm(forms.ModelForm):
 
 
 @login_required
+@query_budget(queries=2, duplicates=0)
 def create_server(request):
     if request.method == "POST":
         form = ServerCreationForm(request.POST, request.FILES)
@@ -227,6 +252,7 @@ class CategoryCreationForm(forms.ModelForm):
 
 
 @login_required
+@query_budget(queries=3, duplicates=0)
 def create_category(request, server_id):
     server = get_object_or_404(Server, id=server_id, owner=request.user)
     if request.method == "POST":
@@ -248,6 +274,7 @@ class ChannelCreationForm(forms.ModelForm):
 
 
 @login_required
+@query_budget(queries=4, duplicates=0)
 def create_channel(request, server_id, category_id=None):
     server = get_object_or_404(Server, id=server_id, owner=request.user)
 
@@ -272,6 +299,7 @@ def create_channel(request, server_id, category_id=None):
 
 
 @login_required
+@query_budget(queries=13, duplicates=0)
 def channel_detail(request, server_id, category_id, channel_id):
     server = get_object_or_404(Server, id=server_id)
     category = get_object_or_404(Category, id=category_id, server=server)
@@ -279,7 +307,10 @@ def channel_detail(request, server_id, category_id, channel_id):
         Channel, id=channel_id, server=server, category=category
     )
 
-    if request.method == "POST" and request.user in server.members.all():
+    permissions = get_server_permissions(request.user, server.id)
+    if not permissions.has(Permission.VIEW_CHANNELS, channel.id):
+        raise Http404("No such channel.")
+    if request.method == "POST" and permissions.has(Permission.SEND_MESSAGES, channel.id):
         Message.objects.create(
             sender=request.user, channel=channel, content=request.POST["content"]
         )
@@ -290,7 +321,8 @@ def channel_detail(request, server_id, category_id, channel_id):
             channel_id=channel.id,
         )
 
-    messages = channel.messages.order_by("created_at")
+    messages, older_cursor = _message_page(_visible_messages(channel, request.user))
+    attach_profile_cards(messages)
     return render(
         request,
         "core/server/category/channel/channel_detail.html",
@@ -298,13 +330,86 @@ def channel_detail(request, server_id, category_id, channel_id):
             "server": server,
             "category": category,
             "channel": channel,
-            "messages": messages,
+            "sidebar": get_server_sidebar(server.id, permissions),
+            # Not "messages": base.html renders that name as the flash message list.
+            "chat_messages": messages,
+            "older_cursor": older_cursor,
             "user": request.user,
         },
     )
 
 
 @login_required
+@query_budget(queries=12, duplicates=0)
+def channel_messages(request, server_id, category_id, channel_id):
+    """Returns the page of messages older than the ``before`` cursor as rendered HTML."""
+    server = get_object_or_404(Server, id=server_id)
+    category = get_object_or_404(Category, id=category_id, server=server)
+    channel = get_object_or_404(
+        Channel, id=channel_id, server=server, category=category
+    )
+    # Hidden channels look like missing ones, as they do to the chat consumers.
+    if not get_server_permissions(request.user, server.id).has(Permission.VIEW_CHANNELS, channel.id):
+        raise Http404("No such channel.")
+
+    try:
+        before = _decode_cursor(request.GET.get("before"))
+    except ValueError:
+        return HttpResponseBadRequest("Invalid cursor.")
+
+    messages, older_cursor = _message_page(_visible_messages(channel, request.user), before=before)
+    attach_profile_cards(messages)
+    html = render_to_string(
+        "core/server/category/channel/message/message_list.html",
+        {
+            "server": server,
+            "category": category,
+            "channel": channel,
+            # Not "messages": base.html renders that name as the flash message list.
+            "chat_messages": messages,
+            "user": request.user,
+        },
+        request=request,
+    )
+    return JsonResponse({"html": html, "older_cursor": older_cursor})
+
+
+def _visible_messages(channel, user):
+    """Soft-deleted messages are only shown to staff; everyone else reads the live partial index."""
+    messages = channel.messages.all()
+    if not (user.is_staff or user.is_superuser):
+        messages = messages.filter(deleted=False)
+    return messages
+
+
+def _message_page(queryset, before=None, limit=MESSAGE_PAGE_SIZE):
+    """
+    Keyset pagination over the per-channel message sequence, newest page first.
+
+    Returns the page in chronological order together with the cursor for the
+    next older page, or None when there is nothing older to load.
+    """
+    if before is not None:
+        queryset = queryset.filter(sequence__lt=before)
+    page = list(queryset.order_by("-sequence")[: limit + 1])
+    has_older = len(page) > limit
+    page = page[:limit]
+    page.reverse()
+    older_cursor = page[0].sequence if has_older else None
+    return page, older_cursor
+
+
+def _decode_cursor(cursor):
+    if not cursor:
+        return None
+    before = int(cursor)
+    if before < 1:
+        raise ValueError("Message cursor must be a positive sequence number")
+    return before
+
+
+@login_required
+@query_budget(queries=5, duplicates=0)
 def category_detail(request, server_id, category_id):
     server = get_object_or_404(Server, id=server_id)
     category = get_object_or_404(Category, id=category_id, server=server)
@@ -324,8 +429,9 @@ def category_detail(request, server_id, category_id):
 
 
 @login_required
+@query_budget(queries=3, duplicates=0)
 def edit_message(request, server_id, category_id, channel_id, message_id):
-    message = get_object_or_404(Message, id=message_id, sender=request.user)
+    message = get_object_or_404(Message.objects.select_related("channel"), id=message_id, sender=request.user)
 
     if request.method == "POST":
         new_content = request.POST.get("content")
@@ -351,15 +457,16 @@ def edit_message(request, server_id, category_id, channel_id, message_id):
 
 
 @login_required
+@query_budget(queries=7, duplicates=0)
 def message_history(request, server_id, category_id, channel_id, message_id):
     server = get_object_or_404(Server, id=server_id)
     category = get_object_or_404(Category, id=category_id, server=server)
     channel = get_object_or_404(
         Channel, id=channel_id, server=server, category=category
     )
-    message = get_object_or_404(Message, id=message_id, channel=channel)
+    message = get_object_or_404(Message.objects.select_related("sender"), id=message_id, channel=channel)
 
-    history = message.edit_history.all().order_by("-edited_at")
+    history = message.edit_history.select_related("editor").order_by("-edited_at")
 
     return render(
         request,
@@ -391,6 +498,7 @@ def delete_message(request, server_id, category_id, channel_id, message_id):
 
 
 @login_required
+@query_budget(queries=4, duplicates=0)
 def roles_list(request, server_id):
     server = get_object_or_404(Server, id=server_id, owner=request.user)
     roles = server.roles.all()
@@ -416,6 +524,7 @@ class RoleForm(forms.ModelForm):
 
 
 @login_required
+@query_budget(queries=3, duplicates=0)
 def create_role(request, server_id):
     server = get_object_or_404(Server, id=server_id, owner=request.user)
 
@@ -433,6 +542,7 @@ def create_role(request, server_id):
 
 
 @login_required
+@query_budget(queries=4, duplicates=0)
 def edit_role(request, server_id, role_id):
     server = get_object_or_404(Server, id=server_id, owner=request.user)
     role = get_object_or_404(Role, id=role_id, server=server)
@@ -451,6 +561,7 @@ def edit_role(request, server_id, role_id):
 
 
 @login_required
+@query_budget(queries=5, duplicates=0)
 def assign_role(request, server_id, role_id):
     server = get_object_or_404(Server, id=server_id, owner=request.user)
     role = get_object_or_404(Role, id=role_id, server=server)
@@ -472,18 +583,21 @@ def assign_role(request, server_id, role_id):
 
 
 @login_required
+@query_budget(queries=2, duplicates=0)
 def friend_requests(request, user_id):
     requests = FriendRequest.objects.filter(to_user=request.user, status="pending")
     return render(request, "core/profile/friend_requests.html", {"requests": requests})
 
 
 @login_required
+@query_budget(queries=4, duplicates=1)
 def friends_list(request, user_id):
     profile_user = get_object_or_404(User, id=user_id)
     return render(request, "core/profile/friends_list.html", {"friends": profile_user.friends.all()})
 
 
 @login_required
+@query_budget(queries=3, duplicates=0)
 def server_settings(request, server_id):
     server = get_object_or_404(Server, id=server_id, owner=request.user)
 
@@ -503,6 +617,7 @@ def server_settings(request, server_id):
 # === Parental Controls ===
 
 @login_required
+@query_budget(queries=2, duplicates=0)
 def parental_controls(request):
     user = request.user
     if request.method == "POST":
@@ -522,6 +637,7 @@ def parental_controls(request):
 
 
 @login_required
+@query_budget(queries=2, duplicates=0)
 def guardian_settings(request):
     user = request.user
     if not user.is_minor_account or not user.parental_controls_enabled:
@@ -593,3 +709,34 @@ def _send_guardian_verification(request, user):
         )
     except Exception:
         logger.exception("Failed to send guardian verification email for user=%s", user.id)
+
+
+def metrics(request):
+    """Prometheus scrape endpoint for this worker process's metrics."""
+    token = settings.METRICS_TOKEN
+    if token:
+        if not secrets.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+            return HttpResponseForbidden()
+    elif not settings.DEBUG:
+        return HttpResponseForbidden()
+    return HttpResponse(metrics_registry.render(), content_type=METRICS_CONTENT_TYPE)
+
+
+@staff_member_required
+def slow_queries(request):
+    """The slow queries this worker process logged most recently, with their plans."""
+    return JsonResponse({"threshold_ms": settings.SLOW_QUERY_MS, "queries": recent_slow_queries()})
+
+
+def media_blob(request, path):
+    """
+    A content-addressed upload or one of its derivatives; the URL changes
+    whenever the content does. Like the rest of MEDIA_URL this is only served
+    with DEBUG on, since django.views.static is not hardened for production;
+    see MEDIA_URL in the settings for what the front proxy must do instead.
+    """
+    if not settings.DEBUG:
+        raise Http404("Media files are served by the front proxy.")
+    response = serve_file(request, path, document_root=settings.MEDIA_ROOT)
+    response["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+    return response
@@ -0,0 +1,171 @@
+# Copyright (C) 2025 TG11
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import atexit
+import logging
+import threading
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError
+
+from .models import Channel, Message
+
+logger = logging.getLogger(__name__)
+
+
+class SequenceAllocator:
+    """
+    Hands out channel sequence numbers to write-behind messages on the event
+    loop. Messages arriving for a channel while a reservation for it is
+    running wait for the next one, which reserves a block for all of them
+    with a single UPDATE. A busy channel thus costs one round trip per burst
+    rather than per message, and an idle one the same single round trip.
+
+    Only numbers for messages already waiting are reserved. Reserving ahead
+    would save the round trip entirely, but a process holding 1..100 while
+    another hands out 101.. breaks the order clients resume and detect gaps
+    by, and numbers a process never used on exit would be gaps for good.
+    """
+
+    def __init__(self):
+        self._waiting = {}
+        # The event loop only keeps weak references to tasks.
+        self._tasks = set()
+
+    async def allocate(self, channel_id):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiting = self._waiting.get(channel_id)
+        if waiting is None:
+            self._waiting[channel_id] = [future]
+            task = loop.create_task(self._reserve(channel_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            waiting.append(future)
+        return await future
+
+    async def _reserve(self, channel_id):
+        # The entry stays while reserving, so late arrivals queue up behind it.
+        try:
+            while self._waiting[channel_id]:
+                futures, self._waiting[channel_id] = self._waiting[channel_id], []
+                try:
+                    last = await sync_to_async(Channel.allocate_sequences)(channel_id, count=len(futures))
+                except Exception as exc:
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(exc)
+                    continue
+                for sequence, future in enumerate(futures, start=last - len(futures) + 1):
+                    if not future.done():
+                        future.set_result(sequence)
+        finally:
+            del self._waiting[channel_id]
+
+
+class MessageWriteBuffer:
+    """
+    Per-process write-behind buffer for chat messages.
+
+    Messages are collected in memory and written with a single bulk_create
+    once ``max_batch`` messages are pending or ``interval`` seconds after the
+    first pending message, whichever comes first. Whatever is still pending
+    when the process exits is written synchronously from an atexit hook.
+    Sequence numbers are reserved up front through ``sequences``.
+    """
+
+    def __init__(self, interval, max_batch):
+        self.interval = interval
+        self.max_batch = max_batch
+        self.sequences = SequenceAllocator()
+        self._pending = []
+        self._lock = threading.Lock()
+        self._timer = None
+        # The event loop only keeps weak references to tasks.
+        self._tasks = set()
+
+    async def add(self, message):
+        with self._lock:
+            self._pending.append(message)
+            full = len(self._pending) >= self.max_batch
+        if full:
+            self._spawn(self.flush())
+        elif self._timer is None or self._timer.done():
+            self._timer = self._spawn(self._flush_later())
+
+    def _spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def flush(self):
+        batch = self._take()
+        if batch:
+            await sync_to_async(self._write)(batch)
+
+    async def drain(self):
+        """Writes what is pending and waits for the writes already under way."""
+        await self.flush()
+        await asyncio.gather(*self._tasks)
+
+    def flush_sync(self):
+        batch = self._take()
+        if batch:
+            self._write(batch)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        await self.flush()
+
+    def _take(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+        return batch
+
+    def _write(self, batch):
+        try:
+            Message.objects.bulk_create(batch)
+        except DatabaseError:
+            # One bad row (e.g. its channel was deleted meanwhile) must not cost the whole batch.
+            logger.warning("Bulk write of %d chat messages failed, retrying row by row", len(batch))
+            for message in batch:
+                try:
+                    message.save(force_insert=True)
+                except DatabaseError:
+                    logger.exception("Dropping buffered chat message %s", message.id)
+
+
+_message_buffer = None
+_message_buffer_lock = threading.Lock()
+
+
+def get_message_buffer():
+    """Returns the process-wide buffer, or None when write-behind is disabled."""
+    global _message_buffer
+    if not getattr(settings, "CHAT_WRITE_BEHIND", False):
+        return None
+    if _message_buffer is None:
+        with _message_buffer_lock:
+            if _message_buffer is None:
+                _message_buffer = MessageWriteBuffer(
+                    interval=settings.CHAT_WRITE_BEHIND_INTERVAL_MS / 1000,
+                    max_batch=settings.CHAT_WRITE_BEHIND_MAX_BATCH,
+                )
+                atexit.register(_message_buffer.flush_sync)
+    return _message_buffer
@@ -13,5 +13,7 @@ echo "==> Collecting static files…"
 rm -rf /app/staticfiles/*
 python manage.py collectstatic --noinput --clear
 
-echo "==> Starting Daphne (ASGI)…"
-exec daphne -b 0.0.0.0 -p 8000 boundless.asgi:application
+echo "==> Starting Uvicorn (ASGI)…"
+# The websockets-sansio protocol waits for the socket to drain on every send,
+# so a client that stops reading fills its outbound queue (core.backpressure).
+exec uvicorn boundless.asgi:application --host 0.0.0.0 --port 8000 --ws websockets-sansio --lifespan off
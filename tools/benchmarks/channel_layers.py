@@ -0,0 +1,140 @@
+# Copyright (C) 2025 TG11
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Group fan-out benchmark: channels_redis RedisChannelLayer and
+RedisPubSubChannelLayer vs core.layers.LocalFanoutChannelLayer.
+
+Simulates ``--workers`` worker processes (one layer instance each) sharing
+``--members`` member connections of one chat group, sends ``--messages``
+group messages and reports delivery throughput, delivery latency and the
+number of Redis commands each group_send cost. Commands run inside
+RedisChannelLayer's Lua scripts (one ZADD per member) do not show up in
+INFO commandstats, so its count is a lower bound. The stock pub/sub layer
+("pubsub") is the baseline LocalFanoutChannelLayer has to beat: it also
+publishes once per group_send, but decodes the message once per member.
+
+Usage (from the project root, with Redis running):
+    python -m tools.benchmarks.channel_layers --redis redis://localhost:6379/0
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import redis
+from channels_redis.core import RedisChannelLayer
+from channels_redis.pubsub import RedisPubSubChannelLayer
+
+from core.layers import LocalFanoutChannelLayer
+
+GROUP = "bench_fanout"
+
+LAYERS = {
+    "redis": RedisChannelLayer,
+    "pubsub": RedisPubSubChannelLayer,
+    "fanout": LocalFanoutChannelLayer,
+}
+
+
+def redis_command_count(client):
+    stats = client.info("commandstats")
+    return sum(entry["calls"] for entry in stats.values())
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run_layer(name, redis_url, members, workers, messages):
+    layers = [LAYERS[name](hosts=[redis_url]) for _ in range(workers)]
+    connections = []
+    for i in range(members):
+        layer = layers[i % workers]
+        channel = await layer.new_channel()
+        await layer.group_add(GROUP, channel)
+        connections.append((layer, channel))
+    # Let pub/sub subscriptions settle before measuring.
+    await asyncio.sleep(0.2)
+
+    latencies = []
+
+    async def drain(layer, channel):
+        for _ in range(messages):
+            message = await layer.receive(channel)
+            latencies.append(time.perf_counter() - message["sent_at"])
+
+    client = redis.Redis.from_url(redis_url)
+    commands_before = redis_command_count(client)
+    receivers = [asyncio.create_task(drain(layer, channel)) for layer, channel in connections]
+    started = time.perf_counter()
+    for sequence in range(messages):
+        await layers[0].group_send(
+            GROUP,
+            {"type": "chat_message", "sequence": sequence, "message": "x" * 64, "sent_at": time.perf_counter()},
+        )
+    await asyncio.gather(*receivers)
+    elapsed = time.perf_counter() - started
+    # Subtract the INFO call made to read the counters.
+    commands = redis_command_count(client) - commands_before - 1
+
+    for layer, channel in connections:
+        await layer.group_discard(GROUP, channel)
+    for layer in layers:
+        await layer.flush()
+    client.close()
+
+    deliveries = members * messages
+    return {
+        "layer": name,
+        "members": members,
+        "workers": workers,
+        "messages": messages,
+        "elapsed_s": round(elapsed, 4),
+        "deliveries_per_s": round(deliveries / elapsed, 1),
+        "redis_commands": commands,
+        "redis_commands_per_group_send": round(commands / messages, 1),
+        "latency_ms": {
+            "p50": round(statistics.median(latencies) * 1000, 3),
+            "p95": round(percentile(latencies, 95) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+        },
+    }
+
+
+async def main(args):
+    results = []
+    for name in args.layers:
+        results.append(await run_layer(name, args.redis, args.members, args.workers, args.messages))
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis", default="redis://localhost:6379/0", help="Redis URL used by both layers")
+    parser.add_argument("--members", type=int, default=1000, help="member connections in the group")
+    parser.add_argument("--workers", type=int, default=4, help="simulated worker processes")
+    parser.add_argument("--messages", type=int, default=20, help="group messages to send (<= 100, the channel capacity)")
+    parser.add_argument("--layers", nargs="+", choices=sorted(LAYERS), default=["redis", "pubsub", "fanout"])
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,377 @@
+# Copyright (C) 2025 TG11
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Load test: simulated users driving boundless.asgi.application in-process.
+
+Each of ``--users`` users logs in through the login form, loads the channel
+page, opens a ChatConsumer socket, posts ``--messages`` messages while
+receiving everyone else's, then pages ``--pages`` pages back through the
+channel history. The run is repeated per channel layer (``memory`` is
+InMemoryChannelLayer, ``redis`` is RedisChannelLayer on ``--redis``) and
+reports throughput and p50/p95/p99 latency per step, plus the fan-out delay
+from a message being sent to each member receiving it. ``--write-behind``
+runs with CHAT_WRITE_BEHIND on, so the two ways of storing messages can be
+compared.
+
+The application runs in this process, as one ASGI worker would, against the
+configured database; the users, server and history it needs are created up
+front and deleted afterwards. Deleting removes every server owned by a user
+whose name starts with "loadtest-" and every such user, so the command only
+runs with DEBUG on or when passed --allow-destructive.
+
+Results can be saved as a JSON baseline and later runs compared against it;
+regressions beyond ``--tolerance`` make the command exit with status 1.
+
+Usage (from the project root, with the database configured as for runserver):
+    python -m tools.benchmarks.load --users 20 --messages 10 --output tools/benchmarks/baselines/load.json
+    python -m tools.benchmarks.load --users 20 --messages 10 --compare tools/benchmarks/baselines/load.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+import sys
+import time
+import uuid
+from collections import defaultdict
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "boundless.settings")
+
+from boundless.asgi import application  # noqa: E402  (sets Django up)
+
+from asgiref.sync import sync_to_async  # noqa: E402
+from channels.testing import HttpCommunicator, WebsocketCommunicator  # noqa: E402
+from django.conf import settings  # noqa: E402
+from django.contrib.auth.hashers import make_password  # noqa: E402
+from django.db import transaction  # noqa: E402
+from django.test import override_settings  # noqa: E402
+from django.urls import reverse  # noqa: E402
+
+from core.models import Category, Channel, Message, Server, User  # noqa: E402
+from core.writebehind import get_message_buffer  # noqa: E402
+
+from .channel_layers import percentile  # noqa: E402
+
+USERNAME_PREFIX = "loadtest-"
+PASSWORD = "loadtest-password"
+CSRF_INPUT = re.compile(rb'name="csrfmiddlewaretoken" value="([^"]+)"')
+
+LAYERS = {
+    "memory": lambda redis_url: {"BACKEND": "channels.layers.InMemoryChannelLayer"},
+    "redis": lambda redis_url: {
+        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "CONFIG": {"hosts": [{"address": redis_url, "socket_timeout": settings.CHANNEL_LAYER_SOCKET_TIMEOUT}]},
+    },
+}
+
+# Lower is better for latencies, higher for throughput; compared by --compare.
+LATENCY_KEYS = ("p50", "p95", "p99")
+THROUGHPUT_KEYS = ("http_requests_per_s", "deliveries_per_s")
+STEPS = ("login", "channel_page", "ws_connect", "echo", "history_page")
+
+
+def summarize(values):
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "p50": round(statistics.median(values) * 1000, 3),
+        "p95": round(percentile(values, 95) * 1000, 3),
+        "p99": round(percentile(values, 99) * 1000, 3),
+    }
+
+
+@sync_to_async
+def create_fixture(users, history):
+    """The server, channel, history and members the simulated users share."""
+    password = make_password(PASSWORD)
+    owner = User.objects.create(username=f"{USERNAME_PREFIX}owner", password=password)
+    members = User.objects.bulk_create(
+        User(username=f"{USERNAME_PREFIX}{i}", password=password) for i in range(users)
+    )
+    server = Server.objects.create(owner=owner, name="Load test")
+    server.members.add(owner, *members)
+    category = Category.objects.create(server=server, name="Load test")
+    channel = Channel.objects.create(server=server, category=category, name="load-test")
+    with transaction.atomic():
+        first = Channel.allocate_sequences(channel.id, history) - history + 1
+        Message.objects.bulk_create(
+            Message(sender=members[i % users], channel=channel, content=f"history {i}", sequence=first + i)
+            for i in range(history)
+        )
+    return members, server, category, channel
+
+
+@sync_to_async
+def delete_fixture():
+    """Removes the fixture, including one left behind by an interrupted run."""
+    Server.objects.filter(owner__username__startswith=USERNAME_PREFIX).delete()
+    User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+
+
+class SimulatedUser:
+    def __init__(self, user, host):
+        self.user = user
+        self.host = host.encode()
+        self.cookies = SimpleCookie()
+
+    def headers(self, extra=()):
+        headers = [(b"host", self.host), *extra]
+        if self.cookies:
+            cookie = "; ".join(f"{name}={morsel.value}" for name, morsel in self.cookies.items())
+            headers.append((b"cookie", cookie.encode()))
+        return headers
+
+    async def request(self, method, path, body=b"", extra_headers=(), timeout=30):
+        communicator = HttpCommunicator(application, method, path, body=body, headers=self.headers(extra_headers))
+        response = await communicator.get_response(timeout=timeout)
+        # As a server would once the response is out; lets the handler finish.
+        await communicator.send_input({"type": "http.disconnect"})
+        await communicator.wait(timeout)
+        for name, value in response["headers"]:
+            if name.lower() == b"set-cookie":
+                self.cookies.load(value.decode())
+        if response["status"] >= 400:
+            raise RuntimeError(f"{method} {path} returned {response['status']}")
+        return response
+
+    async def log_in(self):
+        page = await self.request("GET", reverse("login"))
+        token = CSRF_INPUT.search(page["body"]).group(1).decode()
+        body = urlencode({"username": self.user.username, "password": PASSWORD, "csrfmiddlewaretoken": token})
+        response = await self.request(
+            "POST",
+            reverse("login"),
+            body=body.encode(),
+            extra_headers=[(b"content-type", b"application/x-www-form-urlencoded")],
+        )
+        if response["status"] != 302:
+            raise RuntimeError(f"{self.user.username} could not log in")
+
+    async def connect(self, path):
+        self.socket = WebsocketCommunicator(application, path, headers=self.headers())
+        connected, _ = await self.socket.connect(timeout=30)
+        if not connected:
+            raise RuntimeError(f"{self.user.username} could not open {path}")
+
+
+class StartLine:
+    """Holds each user back until every user has reached it."""
+
+    def __init__(self, users):
+        self.waiting_for = users
+        self.event = asyncio.Event()
+
+    async def wait(self):
+        self.waiting_for -= 1
+        if self.waiting_for == 0:
+            self.event.set()
+        await self.event.wait()
+
+
+class LoadRun:
+    """Measurements shared by the simulated users of one run."""
+
+    def __init__(self, args, urls):
+        self.args = args
+        self.urls = urls
+        self.timings = defaultdict(list)
+        self.sent = {}
+        self.received = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.logged_in = StartLine(args.users)
+        self.connected = StartLine(args.users)
+        self.expected = args.users * args.messages
+
+    async def timed(self, step, coroutine):
+        started = time.perf_counter()
+        result = await coroutine
+        self.timings[step].append(time.perf_counter() - started)
+        return result
+
+    async def user(self, sim):
+        await self.timed("login", sim.log_in())
+        await self.timed("channel_page", sim.request("GET", self.urls["page"]))
+        # Logins are slow on purpose (password hashing); nobody connects until
+        # they are all done so no socket idles through them.
+        await self.logged_in.wait()
+        await self.timed("ws_connect", sim.connect(self.urls["socket"]))
+
+        # Everyone is subscribed before anyone posts, so every member sees every message.
+        await self.connected.wait()
+        receiver = asyncio.create_task(self.receive(sim))
+        for i in range(self.args.messages):
+            content = f"load {sim.user.pk} {i} {uuid.uuid4().hex}"
+            self.sent[content] = (sim.user.pk, time.perf_counter())
+            await sim.socket.send_to(text_data=json.dumps({"message": content}))
+            await asyncio.sleep(self.args.think_ms / 1000)
+        if await receiver:
+            await sim.socket.disconnect()
+
+        cursor = None
+        for _ in range(self.args.pages):
+            path = self.urls["history"] + (f"?{urlencode({'before': cursor})}" if cursor else "")
+            response = await self.timed("history_page", sim.request("GET", path))
+            cursor = json.loads(response["body"])["older_cursor"]
+            if not cursor:
+                break
+
+    async def receive(self, sim):
+        """Reads chat frames until every message arrived; False if the socket died first."""
+        while self.received[sim.user.pk] < self.expected:
+            try:
+                frame = json.loads(await sim.socket.receive_from(timeout=self.args.timeout))
+            except asyncio.TimeoutError:
+                # Dropped somewhere on the way; counted as missed deliveries.
+                # The timeout also stopped the consumer, so there is nothing to close.
+                return False
+            except Exception as exc:
+                # The consumer crashed; its remaining deliveries count as missed too.
+                self.errors[f"{type(exc).__module__}.{type(exc).__name__}: {exc}"] += 1
+                return False
+            now = time.perf_counter()
+            # Coalesced or backpressured deliveries arrive as arrays of frames.
+            for event in frame if isinstance(frame, list) else [frame]:
+                if event.get("op") != "message":
+                    continue
+                self.received[sim.user.pk] += 1
+                sender, sent_at = self.sent[event["message"]]
+                self.timings["echo" if sender == sim.user.pk else "fanout_delay"].append(now - sent_at)
+        return True
+
+    def report(self, layer, elapsed):
+        timings = self.timings
+        delivered = sum(self.received.values())
+        # A login is two requests: the form and the POST.
+        http_requests = 2 * len(timings["login"]) + len(timings["channel_page"]) + len(timings["history_page"])
+        return {
+            "layer": layer,
+            "write_behind": self.args.write_behind,
+            "users": self.args.users,
+            "messages_per_user": self.args.messages,
+            "elapsed_s": round(elapsed, 4),
+            "http_requests_per_s": round(http_requests / elapsed, 1),
+            "deliveries_per_s": round(delivered / elapsed, 1),
+            "missed_deliveries": self.expected * self.args.users - delivered,
+            "consumer_errors": dict(self.errors),
+            "latency_ms": {step: summarize(timings[step]) for step in STEPS},
+            "fanout_delay_ms": summarize(timings["fanout_delay"]),
+        }
+
+
+async def run_layer(name, args):
+    await delete_fixture()
+    members, server, category, channel = await create_fixture(args.users, args.history)
+    ids = [server.id, category.id, channel.id]
+    run = LoadRun(
+        args,
+        {
+            "page": reverse("core:channel_detail", args=ids),
+            "history": reverse("core:channel_messages", args=ids),
+            "socket": "/ws/servers/{}/{}/{}/".format(*ids),
+        },
+    )
+    try:
+        with override_settings(
+            CHANNEL_LAYERS={"default": LAYERS[name](args.redis)}, CHAT_WRITE_BEHIND=args.write_behind
+        ):
+            started = time.perf_counter()
+            await asyncio.gather(*(run.user(SimulatedUser(user, args.host)) for user in members))
+            elapsed = time.perf_counter() - started
+            buffer = get_message_buffer()
+            if buffer is not None:
+                # Buffered messages must be written before their channel is deleted.
+                await buffer.drain()
+    finally:
+        await delete_fixture()
+    return run.report(name, elapsed)
+
+
+def compare(results, baseline, tolerance):
+    """Lists the measurements that got worse than the baseline by more than ``tolerance``."""
+    regressions = []
+    previous_runs = {(run["layer"], run.get("write_behind", False)): run for run in baseline}
+    for run in results:
+        previous = previous_runs.get((run["layer"], run["write_behind"]))
+        if previous is None:
+            continue
+        for key in THROUGHPUT_KEYS:
+            if run[key] < previous[key] * (1 - tolerance):
+                regressions.append(f"{run['layer']} {key}: {run[key]} (baseline {previous[key]})")
+        missed_before = previous.get("missed_deliveries", 0)
+        if run["missed_deliveries"] > missed_before:
+            regressions.append(f"{run['layer']} missed_deliveries: {run['missed_deliveries']} (baseline {missed_before})")
+        timings = {**run["latency_ms"], "fanout_delay": run["fanout_delay_ms"]}
+        previous_timings = {**previous["latency_ms"], "fanout_delay": previous["fanout_delay_ms"]}
+        for step, summary in timings.items():
+            for key in LATENCY_KEYS:
+                before = previous_timings.get(step, {}).get(key)
+                if before is not None and key in summary and summary[key] > before * (1 + tolerance):
+                    regressions.append(f"{run['layer']} {step} {key}: {summary[key]} ms (baseline {before} ms)")
+    return regressions
+
+
+async def main(args):
+    results = []
+    for name in args.layers:
+        results.append(await run_layer(name, args))
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="simulated users, all members of one channel")
+    parser.add_argument("--messages", type=int, default=10, help="messages each user posts")
+    parser.add_argument("--think-ms", type=float, default=50, help="pause between a user's messages")
+    parser.add_argument("--history", type=int, default=500, help="messages already in the channel")
+    parser.add_argument("--pages", type=int, default=3, help="history pages each user loads")
+    parser.add_argument("--layers", nargs="+", choices=sorted(LAYERS), default=["memory", "redis"])
+    parser.add_argument("--write-behind", action="store_true", help="store messages with CHAT_WRITE_BEHIND on")
+    parser.add_argument("--redis", default="redis://localhost:6379/0", help="Redis URL for the redis layer")
+    parser.add_argument("--host", default="localhost", help="Host header sent; must be in ALLOWED_HOSTS")
+    parser.add_argument("--timeout", type=float, default=10, help="seconds without a chat frame before giving up")
+    parser.add_argument("--output", help="also write the JSON results (a baseline) to this file")
+    parser.add_argument("--compare", help="baseline JSON to compare against; exits 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before a regression")
+    parser.add_argument(
+        "--allow-destructive",
+        action="store_true",
+        help=f"run with DEBUG off, deleting {USERNAME_PREFIX}* users and their servers from the configured database",
+    )
+    args = parser.parse_args()
+    if not (settings.DEBUG or args.allow_destructive):
+        parser.error(
+            f"DEBUG is off: this may be a production database, and the run deletes every {USERNAME_PREFIX}* "
+            "user and their servers. Pass --allow-destructive to run anyway."
+        )
+    sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,233 @@
+# Copyright (C) 2025 TG11
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Microbenchmarks: the per-call cost of pure-Python hot paths.
+
+Covers the age checks on User (get_effective_age, allows_nsfw_content and
+allows_16plus_content, for each way a minor's age can be recorded), the JSON
+the chat consumers encode and decode per frame, tools.debugtool.debug.log
+(filtered out, printed, and printed with its file:line trace) and the
+docgen highlighter. Nothing touches the database: users are unsaved model
+instances and Django is only set up for the model classes.
+
+Each benchmark is timed ``--repeat`` times for at least ``--min-time``
+seconds and the fastest run is reported in nanoseconds per call, which is
+the least noisy figure for code this small. Results can be saved as a JSON
+baseline and later runs compared against it; calls slower than the baseline
+by more than ``--tolerance`` make the command exit with status 1. The
+baseline is read before ``--output`` is written, so passing the same file to
+both compares against the previous run and then replaces it.
+
+Baselines only compare runs on the same machine and Python version.
+
+Usage (from the project root):
+    python -m tools.benchmarks.micro --output tools/benchmarks/baselines/micro.json
+    python -m tools.benchmarks.micro --compare tools/benchmarks/baselines/micro.json --output tools/benchmarks/baselines/micro.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import timeit
+import uuid
+from datetime import timedelta
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "boundless.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.utils import timezone  # noqa: E402
+
+from core.coalescing import chat_event, message_frame  # noqa: E402
+from core.models import User  # noqa: E402
+from core.profiles import ProfileCard  # noqa: E402
+from tools.debugtool import debug  # noqa: E402
+from tools.docgen.highlighting import highlight  # noqa: E402
+
+DOCSTRING = """
+    Shows the message box and waits for the user to close it.
+
+    :param hwnd: HWND of the owner window, or NULL for none.
+    :param flags: Combination of MB.OK, MB.ICONERROR and friends (see `MB`).
+    :return: The ID of the button pressed, e.g. "IDOK".
+    :raises OSError: if the call fails [rare] with {details} in <em>errno</em>.
+"""
+
+
+def users():
+    """One unsaved user per branch of get_effective_age."""
+    now = timezone.now()
+    minor = {"is_minor_account": True}
+    return {
+        "adult": User(username="adult"),
+        "age_range": User(
+            username="range",
+            minor_birthdate_precision=User.MinorBirthdatePrecision.AGE_RANGE,
+            minor_age_range=User.MinorAgeRange.BETWEEN_13_AND_15,
+            **minor,
+        ),
+        "age_years": User(
+            username="years",
+            minor_birthdate_precision=User.MinorBirthdatePrecision.AGE_YEARS,
+            minor_age_years=14,
+            minor_age_recorded_at=now - timedelta(days=400),
+            **minor,
+        ),
+        "month_year": User(
+            username="month",
+            minor_birthdate_precision=User.MinorBirthdatePrecision.MONTH_YEAR,
+            minor_birth_year=now.year - 15,
+            minor_birth_month=6,
+            **minor,
+        ),
+        "full_date": User(
+            username="full",
+            minor_birthdate_precision=User.MinorBirthdatePrecision.FULL_DATE,
+            minor_birth_year=now.year - 17,
+            minor_birth_month=6,
+            minor_birth_day=15,
+            guardian_allows_16plus=True,
+            **minor,
+        ),
+    }
+
+
+def benchmarks():
+    """Benchmark name -> zero-argument callable."""
+    cases = {}
+    for kind, user in users().items():
+        cases[f"user.get_effective_age[{kind}]"] = user.get_effective_age
+        cases[f"user.allows_nsfw_content[{kind}]"] = user.allows_nsfw_content
+        cases[f"user.allows_16plus_content[{kind}]"] = user.allows_16plus_content
+
+    card = ProfileCard(uuid.uuid4(), "sender", "Sender", "/static/images/user/icon-1.png")
+    channel_id = uuid.uuid4()
+    content = "Hello everyone, this is a chat message of an ordinary length."
+    event = chat_event(channel_id, 1, content, card)
+    events = [chat_event(channel_id, sequence, content, card) for sequence in range(20)]
+    incoming = json.dumps({"op": "message", "channel": str(channel_id), "message": content})
+    cases["chat.chat_event"] = lambda: chat_event(channel_id, 1, content, card)
+    cases["chat.message_frame"] = lambda: message_frame(event)
+    cases["chat.batch_frame[20]"] = lambda: "[" + ",".join(item["text"] for item in events) + "]"
+    cases["chat.send_op"] = lambda: json.dumps({"op": "subscribed", "channel": str(channel_id)})
+    cases["chat.decode_frame"] = lambda: json.loads(incoming)
+
+    message = "Generated docs for core/models.py"
+    cases["debug.log[filtered]"] = lambda: debug.log(message, level=4)
+    cases["debug.log[printed]"] = lambda: debug.log(message, level=1)
+    cases["debug.log[traced]"] = lambda: debug.log(message, level=1, show_trace=True)
+
+    cases["docgen.highlight[line]"] = lambda: highlight("Returns the `HWND` of the window (or NULL).")
+    cases["docgen.highlight[docstring]"] = lambda: highlight(DOCSTRING)
+    return cases
+
+
+def measure(func, repeat, min_time):
+    """Fastest of ``repeat`` timings, in nanoseconds per call."""
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    if elapsed < min_time:
+        number = max(number, int(number * min_time / elapsed))
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return {"ns_per_call": round(best / number * 1e9, 1), "calls": number}
+
+
+@contextlib.contextmanager
+def quiet_debug_log(log_dir):
+    """Lets debug.log print and write as it does at DEBUG_LEVEL 3, into the void and a scratch file."""
+    level, log_file = debug.DEBUG_LEVEL, debug.LOG_FILE_PATH
+    debug.set_debug_level(3)
+    debug.set_log_file(os.path.join(log_dir, "micro.log"))
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            yield
+    finally:
+        debug.DEBUG_LEVEL, debug.LOG_FILE_PATH = level, log_file
+
+
+def run(args):
+    cases = benchmarks()
+    if args.only:
+        cases = {name: func for name, func in cases.items() if any(part in name for part in args.only)}
+    results = {}
+    with tempfile.TemporaryDirectory() as log_dir, quiet_debug_log(log_dir):
+        for name, func in cases.items():
+            results[name] = measure(func, args.repeat, args.min_time)
+            # Each benchmark starts from an empty log file.
+            open(debug.LOG_FILE_PATH, "w").close()
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "benchmarks": results,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Lists the benchmarks that got slower per call than the baseline by more than ``tolerance``."""
+    regressions = []
+    for name, result in results["benchmarks"].items():
+        previous = baseline.get("benchmarks", {}).get(name)
+        if previous is None:
+            continue
+        if result["ns_per_call"] > previous["ns_per_call"] * (1 + tolerance):
+            change = result["ns_per_call"] / previous["ns_per_call"] - 1
+            regressions.append(
+                f"{name}: {result['ns_per_call']} ns/call (baseline {previous['ns_per_call']} ns/call, +{change:.0%})"
+            )
+    return regressions
+
+
+def main(args):
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    results = run(args)
+    for name, result in results["benchmarks"].items():
+        line = f"{name:<42} {result['ns_per_call']:>12,.1f} ns/call"
+        previous = (baseline or {}).get("benchmarks", {}).get(name)
+        if previous:
+            line += f"  ({result['ns_per_call'] / previous['ns_per_call'] - 1:+.0%})"
+        print(line)
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(json.dumps(results, indent=2) + "\n")
+    if baseline is None:
+        return 0
+    if baseline.get("python") != results["python"]:
+        print(f"warning: baseline is from Python {baseline.get('python')}, this is {results['python']}", file=sys.stderr)
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", nargs="+", help="run only benchmarks whose name contains one of these")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per benchmark; the fastest counts")
+    parser.add_argument("--min-time", type=float, default=0.2, help="minimum seconds per timed run")
+    parser.add_argument("--output", help="also write the JSON results (a baseline) to this file")
+    parser.add_argument("--compare", help="baseline JSON to compare against; exits 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown per call before a regression")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,144 @@
+# Copyright (C) 2025 TG11
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Docstring highlighting for the generated API docs. Kept apart from
+generate_docs, which builds the docs as it is imported, so the helpers can
+be imported (and benchmarked) on their own.
+"""
+
+import html
+import re
+from typing import List
+
+
+def safe_html_escape(text: str, allow_tags: List[str] = ["em"]) -> str:
+    """
+    Escapes HTML in the text except for allowed tags like em.
+    """
+    tag_pattern = re.compile(rf"</?({'|'.join(allow_tags)})[^>]*>", re.IGNORECASE)
+    placeholders = []
+
+    # Temporarily replace allowed tags with placeholders
+    def replace_tag(match):
+        placeholders.append(match.group(0))
+        return f"__HTML_TAG_{len(placeholders)-1}__"
+
+    temp_text = tag_pattern.sub(replace_tag, text)
+    escaped = html.escape(temp_text)
+
+    # Restore allowed tags
+    for i, tag in enumerate(placeholders):
+        escaped = escaped.replace(f"__HTML_TAG_{i}__", tag)
+
+    return escaped
+
+
+def highlight(text: str) -> str:
+    """
+    Processes docstring text and applies syntax highlighting to:
+        - Quoted strings ("...")
+        - Code snippets (`...`)
+        - Brackets: (parentheses), [square brackets], {curly brackets}, <angle brackets>
+        - Parameters (:param name:)
+        - Common Windows API types (HWND, etc.)
+    Returns: HTML-formatted string with <span>/<code> tags for styling.
+    """
+    text = safe_html_escape(text, allow_tags=["em"])
+
+    # Highlight quoted strings: "..."
+    text = re.sub(
+        r"&quot;([^&]+)&quot;", r'<span class="highlight-string">"\1"</span>', text
+    )
+
+    # Highlight backtick code blocks
+    text = re.sub(r"`([^`]+)`", r"<code>\1</code>", text)
+
+    # Highlight :param, :return:, :raises:
+    text = re.sub(
+        r":(param|return|raises?)\b(?: ([^:<]+))?:",
+        lambda m: f'<span class="highlight-param">:{m.group(1)}{f" {m.group(2)}" if m.group(2) else ""}:</span>',
+        text,
+    )
+
+    # Highlight API types
+    win_types = [
+        'HWND', 'UINT', 'LPARAM', 'WPARAM', 'DWORD', 'LRESULT', 'LPCWSTR', 'HANDLE',
+        'BOOL', 'BYTE', 'CHAR', 'WCHAR', 'WORD', 'LONG', 'ULONG', 'WNDCLASS',
+        'HINSTANCE', 'CSIDL', 'MRU', 'URL', 'AST', 'API', 'WNDCLASSEX', 'TOC',
+        'WS', 'BORDER', 'CAPTION', 'CHILD', 'CHILDWINDOW', 'CLIPCHILDREN',
+        'CLIPSIBLINGS', 'DISABLED', 'DLGFRAME', 'GROUP', 'HSCROLL', 'ICONIC', 'ICONERROR'
+        'MAXIMIZE', 'MAXIMIZEBOX', 'MINIMIZE', 'MINIMIZEBOX', 'OVERLAPPED', 'POPUP',
+        'SIZEBOX', 'SYSMENU', 'TABSTOP', 'THICKFRAME', 'TILED', 'TILEDWINDOW',
+        'POPUPWINDOW', 'OVERLAPPEDWINDOW', 'VISIBLE', 'VSCROLL', 'WS_EX',
+        'ACCEPTFILES', 'WINDOWEDGE', 'APPWINDOW', 'CLIENTEDGE', 'COMPOSITED',
+        'CONTEXTHELP', 'CONTROLPARENT', 'DLGMODALFRAME', 'LAYERED', 'LAYOUTRTL',
+        'LEFT', 'LEFTSCROLLBAR', 'LTRREADING', 'MDICHILD', 'NOACTIVATE',
+        'NOINHERITLAYOUT', 'NOPARENTNOTIFY', 'NOREDIRECTIONBITMAP', 'TRANSPARENT',
+        'TOOLWINDOW', 'TOPMOST', 'PALETTEWINDOW', 'RIGHT', 'RIGHTSCROLLBAR',
+        'RTLREADING', 'STATICEDGE', 'SW', 'HIDE', 'RESTORE', 'SHOW', 'SHOWDEFAULT',
+        'SHOWMAXIMIZED', 'SHOWMINIMIZED', 'SHOWMINNOACTIVE', 'SHOWNA',
+        'SHOWNOACTIVATE', 'SHOWNORMAL', 'ERROR', 'ZERO', 'FILE_NOT_FOUND',
+        'PATH_NOT_FOUND', 'BAD_FORMAT', 'ACCESS_DENIED', 'ASSOC_INCOMPLETE',
+        'DDE_BUSY', 'DDE_FAIL', 'DDE_TIMEOUT', 'DLL_NOT_FOUND', 'NO_ASSOC',
+        'OOM', 'SHARE', 'MB', 'OK', 'OK_CANCEL', 'ABORT_RETRY_IGNORE',
+        'YES_NO_CANCEL', 'YES_NO', 'RETRY_CANCEL', 'CANCEL_RETRY_CONTINUE',
+        'REDX', 'QMRK', 'WARN', 'INFO', 'USERICON', 'MASKICON', 'DEFAULT_MASK',
+        'TYPEMASK', 'DEFAULT_BUTTON_1', 'DEFAULT_BUTTON_2', 'DEFAULT_BUTTON_3',
+        'DEFAULT_BUTTON_4', 'SYSTEMMODAL', 'TASKMODAL', 'MASK_MODE', 'HELP',
+        'NOFOCUS', 'MISC_MASK', 'SET_AS_FOREGROUND_WINDOW', 'DEFAULT_DESKTOP_ONLY',
+        'RIGHT_JUSTIFIED_TEXT', 'WS_EX_TOPMOST', 'RIGHT_TO_LEFT_READING',
+        'SERVICE_NOTIFICATION', 'BEEP', 'ID', 'NULL', 'CANCEL', 'ABORT', 'RETRY',
+        'IGNORE', 'YES', 'NO', '_8', '_9', 'TRY_AGAIN', 'CONTINUE', 'DT', 'CENTER',
+        'TOP', 'VCENTER', 'BOTTOM', 'SINGLELINE', 'NOCLIP', 'WORDBREAK', 'CALCRECT',
+        'EDITCONTROL', 'NOPREFIX', 'END_ELLIPSIS', 'PATH_ELLIPSIS', 'WORD_ELLIPSIS',
+        'NOFULLWIDTHCHARBREAK', 'HIDEPREFIX', 'PREFIXONLY', 'WM', 'CREATE',
+        'DESTROY', 'MOVE', 'SIZE', 'ACTIVATE', 'SETFOCUS', 'KILLFOCUS', 'ENABLE',
+        'SETREDRAW', 'SETTEXT', 'GETTEXT', 'GETTEXTLENGTH', 'PAINT', 'CLOSE',
+        'QUERYENDSESSION', 'QUIT', 'QUERYOPEN', 'ERASEBKGND', 'SYSCOLORCHANGE',
+        'ENDSESSION', 'SHOWWINDOW', 'SETCURSOR', 'MOUSEACTIVATE',
+        'WINDOWPOSCHANGING', 'WINDOWPOSCHANGED', 'CONTEXTMENU', 'CS', 'VREDRAW',
+        'HREDRAW', 'DBLCLKS', 'OWNDC', 'CLASSDC', 'PARENTDC', 'NOCLOSE', 'SAVEBITS',
+        'BYTEALIGNCLIENT', 'BYTEALIGNWINDOW', 'GLOBALCLASS', 'SM', 'CXSCREEN',
+        'CYSCREEN', 'CXVSCROLL', 'CYHSCROLL', 'CXCAPTION', 'CYCAPTION', 'CXBORDER',
+        'CYBORDER', 'CXDLGFRAME', 'CYDLGFRAME', 'CYVTHUMB', 'CXHTHUMB', 'CXICON',
+        'CYICON', 'CXCURSOR', 'CYCURSOR', 'MOUSEPRESENT', 'CYMENU', 'CMONITORS',
+        'REMOTESESSION', 'IDC', 'APPSTARTING', 'ARROW', 'CROSS', 'HAND', 'IBEAM',
+        'SIZEALL', 'SIZENESW', 'SIZENS', 'SIZENWSE', 'SIZEWE', 'UPARROW', 'WAIT',
+        'MF', 'INSERT', 'CHANGE', 'APPEND', 'DELETE', 'REMOVE', 'BYCOMMAND',
+        'BYPOSITION', 'SEPARATOR', 'ENABLED', 'GRAYED', 'UNCHECKED', 'CHECKED',
+        'USECHECKBITMAPS', 'STRING', 'BITMAP', 'OWNERDRAW', 'MENUBARBREAK',
+        'MENUBREAK', 'HILITE', 'DEFAULT', 'RIGHTJUSTIFY', 'DEBUG_LEVEL', 'ICONERROR',
+        'IP', 'PHP', "HTML", "XHTM", "XHTML"]
+    type_regex = r"\b(" + "|".join(win_types) + r")\b"
+    text = re.sub(type_regex, r'<span class="highlight-type">\1</span>', text)
+
+    # Highlight bracket types
+    text = re.sub(r"\(([^\(\)]+)\)", r'<span class="highlight-paren">(\1)</span>', text)
+    text = re.sub(
+        r"\[([^\[\]]+)\]", r'<span class="highlight-bracket">[\1]</span>', text
+    )
+    text = re.sub(r"\{([^\{\}]+)\}", r'<span class="highlight-brace">{\1}</span>', text)
+    text = re.sub(
+        r"&lt;([^&<>]+)&gt;", r'<span class="highlight-angle">&lt;\1&gt;</span>', text
+    )
+
+    # Indentation and newlines
+    text = text.replace("  ", "&nbsp;&nbsp;")
+    text = text.replace("    ", "&nbsp;&nbsp;&nbsp;&nbsp;")
+    text = text.replace("\t", "&nbsp;&nbsp;&nbsp;&nbsp;")
+    text = text.replace("\n", "<br>")
+
+    return text